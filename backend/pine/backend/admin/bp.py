@@ -1,7 +1,6 @@
 # (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
 
 from flask import Blueprint, jsonify, request
-import requests
 from werkzeug import exceptions
 
 from .. import auth
@@ -149,8 +148,8 @@ def system_import():
     :return: Response
     """
     return service.convert_response(
-        requests.request(request.method, service.url("system", "import"), data = request.get_data(),
-                         headers = request.headers))
+        service.get_session().request(request.method, service.url("system", "import"),
+                                      data = request.get_data(), headers = request.headers))
 
 def init_app(app):
     app.register_blueprint(bp)
@@ -247,10 +247,7 @@ def save_annotations(doc_id):
     resp = _add_or_update_annotation(new_annotation)
     
     if update_iaa:
-        logger.info("Updating IAA report for " + document["collection_id"])
-        success = pineiaa.update_iaa_report_by_collection_id(document["collection_id"])
-        if not success:
-            logger.error("Unable to update IAA report but will not return an error")
+        pineiaa.schedule_iaa_report_update(document["collection_id"])
     
     return jsonify(resp)
 
@@ -317,9 +314,7 @@ def save_collection_annotations(collection_id: str):
                                                       new_annotations[0]["creator_id"])
             log.access_flask_annotate_documents(new_annotations)
             if update_iaa:
-                success = pineiaa.update_iaa_report_by_collection_id(collection_id)
-                if not success:
-                    logger.error("Unable to update IAA report but will not return an error")
+                pineiaa.schedule_iaa_report_update(collection_id)
             return jsonify([annotation["_id"] for annotation in new_annotations])
 
     # fall back on individual mode
@@ -329,9 +324,7 @@ def save_collection_annotations(collection_id: str):
         if added_id:
             added_ids.append(added_id)
     if update_iaa:
-        success = pineiaa.update_iaa_report_by_collection_id(collection_id)
-        if not success:
-            logger.error("Unable to update IAA report but will not return an error")
+        pineiaa.schedule_iaa_report_update(collection_id)
     return jsonify(added_ids)
 
 def init_app(app):
@@ -7,7 +7,7 @@ import sys
 from . import log
 log.setup_logging()
 
-from flask import Flask, abort, jsonify, redirect, render_template, request, send_file
+from flask import Flask, Response, abort, g, jsonify, redirect, render_template, request, send_file
 from flask import __version__ as flask_version
 from werkzeug import exceptions
 
@@ -78,6 +78,38 @@ def create_app(test_config = None):
         LOGGER.info(about)
         return jsonify(about)
 
+    @app.before_request
+    def start_route_metrics():
+        route = request.url_rule.rule if request.url_rule else "<unmatched>"
+        g.metrics_labels = (request.method, route)
+        g.metrics_start = service.PERFORMANCE_HISTORY.start("route", g.metrics_labels)
+
+    @app.after_request
+    def record_route_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_route_metrics(e):
+        if "metrics_start" not in g:
+            return
+        error = type(e).__name__ if e is not None else g.get("metrics_status")
+        if isinstance(error, int) and error < 400:
+            error = None
+        service.PERFORMANCE_HISTORY.finish("route", g.metrics_labels, g.metrics_start, error=error)
+
+    from .data import performance
+    performance.start_publisher(app)
+
+    # like /ping and /about, this is deliberately not behind a login so that prometheus can scrape it; it
+    # only has route and resource names, timings and counts (restrict it at the proxy if that's too much)
+    @app.route("/metrics")
+    def metrics():
+        snapshots = performance.get_snapshots(app.config["METRICS_PUBLISH_INTERVAL"])
+        if request.args.get("format") == "json":
+            return jsonify(snapshots)
+        return Response(service.PERFORMANCE_HISTORY.prometheus(snapshots), mimetype="text/plain; version=0.0.4")
+
     @app.route("/openapi.yaml", methods=["GET"])
     def openapi_spec():
         # Specify statically where the openapi file is, relative path
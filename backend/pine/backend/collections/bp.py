@@ -1,5 +1,6 @@
 # (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
 
+import collections
 import csv
 import io
 import json
@@ -7,11 +8,14 @@ import logging
 import os
 import random
 import sys
+import threading
+import time
 import traceback
 import typing
 import unicodedata
 
-from flask import abort, Blueprint, current_app, jsonify, request, safe_join, send_file, send_from_directory
+from flask import abort, Blueprint, current_app, jsonify, request, Response, safe_join, send_file, send_from_directory, \
+    stream_with_context
 from werkzeug import exceptions
 
 from .. import auth, log, models
@@ -23,15 +27,6 @@ LOGGER = logging.getLogger(__name__)
 
 DOCUMENTS_PER_TRANSACTION = 500
 
-# Cache this info for uploading large numbers of images sequentially
-LAST_COLLECTION_FOR_IMAGE = None
-def is_cached_last_collection(collection_id):
-    global LAST_COLLECTION_FOR_IMAGE
-    return LAST_COLLECTION_FOR_IMAGE and LAST_COLLECTION_FOR_IMAGE[0] == collection_id and LAST_COLLECTION_FOR_IMAGE[1] == auth.get_logged_in_user()["id"]
-def update_cached_last_collection(collection_id):
-    global LAST_COLLECTION_FOR_IMAGE
-    LAST_COLLECTION_FOR_IMAGE = [collection_id, auth.get_logged_in_user()["id"]]
-
 def user_permissions_projection():
     return {
         "creator_id": 1,
@@ -39,6 +34,46 @@ def user_permissions_projection():
         "viewers": 1
     }
 
+class PermissionsCache(object):
+    """Bounded LRU cache of collection permission projections (see user_permissions_projection),
+    keyed by collection ID.  Entries expire after a TTL so that changes made by other backend
+    processes are eventually picked up; changes made through this process invalidate immediately.
+    """
+
+    def __init__(self):
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, collection_id: str) -> typing.Optional[dict]:
+        with self.lock:
+            entry = self.entries.get(collection_id)
+            if entry is None:
+                return None
+            (expires, projection) = entry
+            if expires < time.monotonic():
+                del self.entries[collection_id]
+                return None
+            self.entries.move_to_end(collection_id)
+            return projection
+
+    def put(self, collection: dict):
+        ttl = current_app.config["COLLECTION_PERMISSIONS_CACHE_TTL"]
+        size = current_app.config["COLLECTION_PERMISSIONS_CACHE_SIZE"]
+        if ttl <= 0 or size <= 0:
+            return
+        projection = {key: collection[key] for key in user_permissions_projection() if key in collection}
+        with self.lock:
+            self.entries[collection["_id"]] = (time.monotonic() + ttl, projection)
+            self.entries.move_to_end(collection["_id"])
+            while len(self.entries) > size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, collection_id: str):
+        with self.lock:
+            self.entries.pop(collection_id, None)
+
+PERMISSIONS_CACHE = PermissionsCache()
+
 def get_user_permissions(collection: dict) -> models.CollectionUserPermissions:
     user_id = auth.get_logged_in_user()["id"]
     is_creator = collection["creator_id"] == user_id
@@ -60,18 +95,33 @@ def get_user_permissions(collection: dict) -> models.CollectionUserPermissions:
         delete_documents = is_creator)
 
 def get_user_permissions_by_id(collection_id: str) -> models.CollectionUserPermissions:
-    collection = service.get_item_by_id("/collections", collection_id, service.params({
-        "projection": user_permissions_projection()
-    }))
+    collection = PERMISSIONS_CACHE.get(collection_id)
+    if collection is None:
+        collection = service.get_item_by_id("/collections", collection_id, service.params({
+            "projection": user_permissions_projection()
+        }))
+        PERMISSIONS_CACHE.put(collection)
     return get_user_permissions(collection)
 
 def get_user_permissions_by_ids(collection_ids: typing.Iterable[str]) -> typing.List[models.CollectionUserPermissions]:
-    collections = service.get_all_items("collections", params=service.params({
-        "where": {
-            "_id": {"$in": collection_ids}
-        }, "projection": user_permissions_projection()
-    }))
-    return [get_user_permissions(c) for c in collections]
+    cached = []
+    missing = []
+    for collection_id in collection_ids:
+        collection = PERMISSIONS_CACHE.get(collection_id)
+        if collection is None:
+            missing.append(collection_id)
+        else:
+            cached.append(collection)
+    fetched = []
+    if missing:
+        fetched = service.get_all_items("collections", params=service.params({
+            "where": {
+                "_id": {"$in": missing}
+            }, "projection": user_permissions_projection()
+        }))
+        for collection in fetched:
+            PERMISSIONS_CACHE.put(collection)
+    return [get_user_permissions(c) for c in cached + fetched]
 
 
 def get_user_collections(archived, page):
@@ -141,6 +191,7 @@ def archive_or_unarchive_collection(collection_id, archive):
         headers = {"If-Match": collection["_etag"]}
         service.remove_nonupdatable_fields(collection)
         resp = service.put(["collections", collection_id], json = collection, headers = headers)
+        PERMISSIONS_CACHE.invalidate(collection_id)
         if not resp.ok:
             abort(resp.status_code)
     return get_collection(collection_id)
@@ -183,33 +234,8 @@ def get_collection(collection_id):
     else:
         raise exceptions.Unauthorized()
 
-@bp.route("/by_id/<collection_id>/download", methods = ["GET"])
-@auth.login_required
-def download_collection(collection_id):
-    resp = service.get(["collections", collection_id])
-    if not resp.ok:
-        abort(resp.status_code)
-    collection = resp.json()
-    if not get_user_permissions(collection).download_data:
-        return exceptions.Unauthorized()
-    
-    def flag(name): return name not in request.args or json.loads(request.args[name])
-    include_collection_metadata = flag("include_collection_metadata")
-    include_document_metadata = flag("include_document_metadata")
-    include_document_text = flag("include_document_text")
-    include_annotations = flag("include_annotations")
-    include_annotation_latest_version_only = flag("include_annotation_latest_version_only")
-    as_file = flag("as_file")
-
-    if include_collection_metadata:
-        col = dict(collection)
-        service.remove_eve_fields(col)
-        data = col
-    else:
-        data = {
-            "_id": collection["_id"]
-        }
-
+def _get_download_documents_params(collection_id: str, include_document_metadata: bool,
+                                   include_document_text: bool) -> dict:
     params = service.where_params({
         "collection_id": collection_id
     })
@@ -231,58 +257,115 @@ def download_collection(collection_id):
         params["projection"] = json.dumps({
             "collection_id": 0
         })
+    return params
 
-    data["documents"] = service.get_all_items("documents", params)
+def _group_download_annotations(annotations: typing.Iterable[dict]) -> typing.Dict[str, typing.List[dict]]:
+    annotations_by_document = {}
+    for annotation in annotations:
+        doc_id = annotation["document_id"]
+        del annotation["document_id"]
+        if doc_id not in annotations_by_document:
+            annotations_by_document[doc_id] = []
+        annotations_by_document[doc_id].append(annotation)
+    return annotations_by_document
+
+def _get_download_annotations_of_documents(document_ids: typing.List[str], include_annotation_latest_version_only: bool
+                                           ) -> typing.Dict[str, typing.List[dict]]:
+    # looked up in chunks, since there can be too many document IDs for one URL
+    path = "annotations" if include_annotation_latest_version_only else ["versions", "annotations"]
+    annotations = service.get_all_items_by_ids(path, document_ids, field="document_id", params=service.params({
+        "projection": {
+            "collection_id": 0
+        }
+    }))
+    return _group_download_annotations(annotations)
+
+def _get_download_annotations(where: dict, page_size: int,
+                              include_annotation_latest_version_only: bool) -> typing.Dict[str, typing.List[dict]]:
+    params = service.params({
+        "where": where,
+        "projection": {
+            "collection_id": 0
+        }
+    })
+    if include_annotation_latest_version_only:
+        annotations = service.get_all_items("annotations", params, max_results=page_size)
+    else:
+        # every version of every annotation, in bulk rather than one request per annotation
+        annotations = service.get_all_versions_of_items("annotations", params, max_results=page_size)
+    return _group_download_annotations(annotations)
+
+def _finish_download_documents(documents: typing.List[dict], annotations_by_document: dict,
+                               include_document_metadata: bool, include_document_text: bool,
+                               include_annotations: bool, include_annotation_latest_version_only: bool):
     if include_document_metadata or include_document_text:
         # add dict key if missing
-        for document in data["documents"]:
+        for document in documents:
             if include_document_metadata and "metadata" not in document:
                 document["metadata"] = {}
             if include_document_text and "text" not in document:
                 document["text"] = None
 
-    annotations_by_document = {}
-    if include_annotations:
-        params = service.params({
-            "where": {
-                "collection_id": collection_id
-            },
-            "projection": {
-                "collection_id": 0
-            }
-        })
-        annotations = service.get_all_items("annotations", params)
-        for annotation in annotations:
-            doc_id = annotation["document_id"]
-            del annotation["document_id"]
-            if doc_id not in annotations_by_document:
-                annotations_by_document[doc_id] = []
-            annotations_by_document[doc_id].append(annotation)
-
-    for document in data["documents"]:
+    for document in documents:
         service.remove_eve_fields(document)
         if include_annotations and document["_id"] in annotations_by_document:
-            annotations = annotations_by_document[document["_id"]]
-            if include_annotation_latest_version_only:
-                document["annotations"] = annotations
-            else:
-                params = service.params({
-                    "projection": {
-                        "collection_id": 0,
-                        "document_id": 0
-                    }
-                })
-                document["annotations"] = []
-                for annotation in annotations:
-                    all_versions = service.get_all_versions_of_item_by_id("annotations", annotation["_id"],
-                                                                          params=params)
-                    document["annotations"] += all_versions["_items"]
+            document["annotations"] = annotations_by_document[document["_id"]]
             for annotation in document["annotations"]:
                 service.remove_eve_fields(annotation,
                                           remove_versions = include_annotation_latest_version_only)
         elif include_annotations:
             document["annotations"] = []
 
+@bp.route("/by_id/<collection_id>/download", methods = ["GET"])
+@auth.login_required
+def download_collection(collection_id):
+    resp = service.get(["collections", collection_id])
+    if not resp.ok:
+        abort(resp.status_code)
+    collection = resp.json()
+    if not get_user_permissions(collection).download_data:
+        return exceptions.Unauthorized()
+    
+    def flag(name): return name not in request.args or json.loads(request.args[name])
+    include_collection_metadata = flag("include_collection_metadata")
+    include_document_metadata = flag("include_document_metadata")
+    include_document_text = flag("include_document_text")
+    include_annotations = flag("include_annotations")
+    include_annotation_latest_version_only = flag("include_annotation_latest_version_only")
+    as_file = flag("as_file")
+    download_format = request.args.get("format", "json")
+    if download_format not in ["json", "ndjson"]:
+        raise exceptions.BadRequest("Unknown download format \"{}\".".format(download_format))
+
+    if include_collection_metadata:
+        col = dict(collection)
+        service.remove_eve_fields(col)
+        data = col
+    else:
+        data = {
+            "_id": collection["_id"]
+        }
+
+    params = _get_download_documents_params(collection_id, include_document_metadata, include_document_text)
+    page_size = current_app.config["EVE_PAGINATION_LIMIT"]
+
+    if download_format == "ndjson":
+        return _stream_collection_ndjson(collection_id, data, params, page_size, as_file,
+                                         include_document_metadata, include_document_text,
+                                         include_annotations, include_annotation_latest_version_only)
+
+    data["documents"] = service.get_all_items("documents", params, max_results=page_size)
+
+    annotations_by_document = {}
+    if include_annotations:
+        annotations_by_document = _get_download_annotations({
+            "collection_id": collection_id
+        }, page_size, include_annotation_latest_version_only)
+
+    _finish_download_documents(data["documents"], annotations_by_document,
+                               include_document_metadata, include_document_text,
+                               include_annotations, include_annotation_latest_version_only)
+
     if as_file:
         data_bytes = io.BytesIO()
         data_bytes.write(json.dumps(data).encode())
@@ -298,6 +381,36 @@ def download_collection(collection_id):
     else:
         return jsonify(data)
 
+def _stream_collection_ndjson(collection_id: str, collection: dict, params: dict, page_size: int, as_file: bool,
+                              include_document_metadata: bool, include_document_text: bool,
+                              include_annotations: bool, include_annotation_latest_version_only: bool) -> Response:
+    """
+    Streams the collection as newline-delimited JSON: the first line is the collection itself and
+    every following line is one document (with its annotations, if requested).  Documents are read
+    one page at a time and only the annotations for the documents in that page are fetched, so
+    memory use does not grow with the size of the collection.
+    """
+    # a stable order is needed so that pages don't overlap or skip documents
+    params = dict(params, sort="_id")
+
+    def generate():
+        yield json.dumps(collection) + "\n"
+        for documents in service.iter_pages("documents", params, max_results=page_size):
+            annotations_by_document = {}
+            if include_annotations and documents:
+                annotations_by_document = _get_download_annotations_of_documents(
+                    [document["_id"] for document in documents], include_annotation_latest_version_only)
+            _finish_download_documents(documents, annotations_by_document,
+                                       include_document_metadata, include_document_text,
+                                       include_annotations, include_annotation_latest_version_only)
+            for document in documents:
+                yield json.dumps(document) + "\n"
+
+    headers = {}
+    if as_file:
+        headers["Content-Disposition"] = "attachment; filename=collection_{}.ndjson".format(collection_id)
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson", headers=headers)
+
 # def get_doc_and_overlap_ids(collection_id):
     # """
     # Return lists of ids for overlapping and non-overlapping documents for the collection matching the provided
@@ -341,6 +454,7 @@ def add_annotator_to_collection(collection_id):
             }
         headers = {'Content-Type': 'application/json', 'If-Match': collection["_etag"]}
         resp = service.patch(["collections", collection["_id"]], json=to_patch, headers=headers)
+        PERMISSIONS_CACHE.invalidate(collection["_id"])
         if not resp.ok:
             abort(resp.status_code, resp.content)
         return service.convert_response(resp)
@@ -366,6 +480,7 @@ def add_viewer_to_collection(collection_id):
         }
         headers = {'Content-Type': 'application/json', 'If-Match': collection["_etag"]}
         resp = service.patch(["collections", collection["_id"]], json=to_patch, headers=headers)
+        PERMISSIONS_CACHE.invalidate(collection["_id"])
         if not resp.ok:
             abort(resp.status_code, resp.content)
         return service.convert_response(resp)
@@ -631,9 +746,8 @@ def create_collection():
 
 def _check_collection_and_get_image_dir(collection_id, path):
     # make sure user can view collection
-    if not is_cached_last_collection(collection_id):
-        if not get_user_permissions_by_id(collection_id).view:
-            raise exceptions.Unauthorized()
+    if not get_user_permissions_by_id(collection_id).view:
+        raise exceptions.Unauthorized()
 
     image_dir = current_app.config["DOCUMENT_IMAGE_DIR"]
     if image_dir == None or len(image_dir) == 0:
@@ -721,14 +835,11 @@ def _upload_collection_image_file(collection_id, path, image_file):
 @bp.route("/image/<collection_id>/<path:path>", methods=["POST"])
 @auth.login_required
 def post_collection_image(collection_id, path):
-    if not is_cached_last_collection(collection_id):
-        if not get_user_permissions_by_id(collection_id).add_images:
-            raise exceptions.Unauthorized()
+    if not get_user_permissions_by_id(collection_id).add_images:
+        raise exceptions.Unauthorized()
     if "file" not in request.files:
         raise exceptions.BadRequest("Missing file form part.")
 
-    update_cached_last_collection(collection_id)
-
     return jsonify(_upload_collection_image_file(collection_id, path, request.files["file"]))
 
 def init_app(app):
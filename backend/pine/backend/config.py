@@ -24,6 +24,44 @@ else:
 
 REDIS_PORT = int(os.environ.get("REDIS_PORT", 6479))
 
+# connection pooling for requests to eve; each worker thread gets its own pooled session
+EVE_POOL_CONNECTIONS = int(os.environ.get("EVE_POOL_CONNECTIONS", 10))
+EVE_POOL_MAXSIZE = int(os.environ.get("EVE_POOL_MAXSIZE", 10))
+EVE_KEEP_ALIVE = os.environ.get("EVE_KEEP_ALIVE", "true").lower() in ("true", "1")
+EVE_MAX_RETRIES = int(os.environ.get("EVE_MAX_RETRIES", 3))
+EVE_RETRY_BACKOFF_FACTOR = float(os.environ.get("EVE_RETRY_BACKOFF_FACTOR", 0.1))
+# read timeouts aren't retried, so that a hung request to eve fails cleanly well before gunicorn kills the
+# worker after its 60-second timeout
+EVE_CONNECT_TIMEOUT = float(os.environ.get("EVE_CONNECT_TIMEOUT", 5))
+EVE_READ_TIMEOUT = float(os.environ.get("EVE_READ_TIMEOUT", 20))
+# paginated reads fetch the remaining pages concurrently using this many threads
+EVE_PAGE_FETCH_WORKERS = int(os.environ.get("EVE_PAGE_FETCH_WORKERS", 4))
+# should match PAGINATION_LIMIT in eve's settings
+EVE_PAGINATION_LIMIT = int(os.environ.get("EVE_PAGINATION_LIMIT", 5000))
+
+# collection permissions (creator/annotators/viewers) are cached per backend process; changes made
+# through another process are picked up once the entry expires.  set either to 0 to disable
+COLLECTION_PERMISSIONS_CACHE_SIZE = int(os.environ.get("COLLECTION_PERMISSIONS_CACHE_SIZE", 1000))
+COLLECTION_PERMISSIONS_CACHE_TTL = float(os.environ.get("COLLECTION_PERMISSIONS_CACHE_TTL", 30))
+
+# every gunicorn worker publishes its performance metrics to redis every this many seconds for /metrics
+METRICS_PUBLISH_INTERVAL = float(os.environ.get("METRICS_PUBLISH_INTERVAL", 15))
+
+# next-document queues live in redis and changes are written back to eve every this many seconds
+NEXT_INSTANCES_PERSIST_INTERVAL = float(os.environ.get("NEXT_INSTANCES_PERSIST_INTERVAL", 10))
+
+# IAA reports are updated in the background this many seconds after annotations are saved, with
+# bursts of saves to the same collection coalesced into one update
+IAA_UPDATE_DELAY = float(os.environ.get("IAA_UPDATE_DELAY", 2))
+IAA_UPDATE_WORKERS = int(os.environ.get("IAA_UPDATE_WORKERS", 2))
+# number of gunicorn worker processes (set in the Docker image); each one has its own IAA process pool
+WORKERS = int(os.environ.get("WORKERS", 1))
+# documents are evaluated on this many processes (per gunicorn worker) when an IAA report update has at
+# least IAA_PARALLEL_MIN_DOCUMENTS of them to evaluate; by default the CPUs are split between the
+# workers.  set IAA_PROCESSES to 1 to always evaluate in-process
+IAA_PROCESSES = int(os.environ.get("IAA_PROCESSES", max(1, (os.cpu_count() or 1) // WORKERS)))
+IAA_PARALLEL_MIN_DOCUMENTS = int(os.environ.get("IAA_PARALLEL_MIN_DOCUMENTS", 200))
+
 AUTH_MODULE = os.environ.get("AUTH_MODULE", "vegas")
 if not AUTH_MODULE: AUTH_MODULE = "vegas"
 
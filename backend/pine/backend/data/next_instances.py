@@ -0,0 +1,300 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+"""Redis-backed queues of the next documents to annotate for each classifier.
+
+Eve's ``next_instances`` objects hold the full lists of remaining document IDs, so reading and
+updating them is O(collection size) and concurrent annotators conflict on the ETag.  Instead, the
+first time a classifier's queues are needed they are loaded from eve into redis sorted sets (one
+for the shared documents and one per annotator for the overlap documents) and from then on every
+operation is a single atomic redis command.  Changed classifiers are written back to eve
+periodically by a background thread (see start_persister) so that eve stays the durable copy.
+
+Writes are made with the ETag eve had when the queues were loaded or last persisted.  If something
+else changed the object in the meantime (the pipelines write a new ranking after every training),
+the write fails and the shared queue is reloaded from eve instead.  The pipelines also set the
+classifier's "reload" key after writing a ranking so that it's picked up right away.
+
+The lists in eve are treated as stacks (the next document is the last element), so each ID is
+scored by its position and the highest score is the next document.
+"""
+
+import atexit
+import logging
+import threading
+import typing
+
+from flask import abort
+
+from . import service
+from ..job_manager.service import ServiceManager, config
+
+LOGGER = logging.getLogger(__name__)
+
+class NextInstanceQueues(object):
+
+    def __init__(self, r_conn, key_prefix: str):
+        self.r_conn = r_conn
+        self.key_prefix = key_prefix
+        self.dirty_key = key_prefix + "dirty"
+
+    def _key(self, classifier_id: str, *parts: str) -> str:
+        return self.key_prefix + ":".join((classifier_id,) + parts)
+
+    def _documents_key(self, classifier_id: str) -> str:
+        return self._key(classifier_id, "documents")
+
+    def _overlap_key(self, classifier_id: str, user_id: str) -> str:
+        return self._key(classifier_id, "overlap", user_id)
+
+    def _annotators_key(self, classifier_id: str) -> str:
+        return self._key(classifier_id, "annotators")
+
+    def _instance_key(self, classifier_id: str) -> str:
+        # holds the eve _id of the next_instances object; its existence means the queues are loaded
+        return self._key(classifier_id, "instance")
+
+    def _sequence_key(self, classifier_id: str) -> str:
+        return self._key(classifier_id, "sequence")
+
+    def _etag_key(self, classifier_id: str) -> str:
+        # the _etag of the next_instances object in eve that the queues were loaded from or last persisted to
+        return self._key(classifier_id, "etag")
+
+    def _reload_key(self, classifier_id: str) -> str:
+        # set (by the pipelines) when eve has a newer ranking than the queues
+        return self._key(classifier_id, "reload")
+
+    def _lock(self, classifier_id: str):
+        return self.r_conn.lock(self._key(classifier_id, "lock"), timeout=60, blocking_timeout=60)
+
+    @staticmethod
+    def _get_eve_instance(classifier_id: str) -> typing.Optional[dict]:
+        items = service.get_all_items("/next_instances", params=service.where_params({"classifier_id": classifier_id}))
+        return items[0] if len(items) > 0 else None
+
+    def is_loaded(self, classifier_id: str) -> bool:
+        return self.r_conn.exists(self._instance_key(classifier_id)) > 0
+
+    def _needs_load(self, classifier_id: str) -> bool:
+        with self.r_conn.pipeline(transaction=False) as pipe:
+            pipe.exists(self._instance_key(classifier_id))
+            pipe.exists(self._reload_key(classifier_id))
+            (loaded, reload) = pipe.execute()
+        return not loaded or reload > 0
+
+    def load(self, classifier_id: str) -> bool:
+        """Loads the classifier's queues from eve if they aren't already in redis, or reloads the shared
+        queue if eve has a newer ranking.
+
+        :return: False if eve has no next_instances object for the classifier
+        :rtype: bool
+        """
+        if not self._needs_load(classifier_id):
+            return True
+        with self._lock(classifier_id):
+            if not self._needs_load(classifier_id):
+                return True
+            instance = self._get_eve_instance(classifier_id)
+            if instance is None:
+                return False
+            if self.is_loaded(classifier_id):
+                self._reload_documents(classifier_id, instance)
+                return True
+            with self.r_conn.pipeline() as pipe:
+                if instance["document_ids"]:
+                    pipe.zadd(self._documents_key(classifier_id),
+                              {doc_id: i for (i, doc_id) in enumerate(instance["document_ids"])})
+                for (user_id, doc_ids) in instance["overlap_document_ids"].items():
+                    pipe.sadd(self._annotators_key(classifier_id), user_id)
+                    if doc_ids:
+                        pipe.zadd(self._overlap_key(classifier_id, user_id),
+                                  {doc_id: i for (i, doc_id) in enumerate(doc_ids)})
+                pipe.set(self._sequence_key(classifier_id),
+                         max([len(instance["document_ids"])] + [len(ids) for ids in instance["overlap_document_ids"].values()]))
+                pipe.set(self._etag_key(classifier_id), instance["_etag"])
+                pipe.set(self._instance_key(classifier_id), instance["_id"])
+                pipe.delete(self._reload_key(classifier_id))
+                pipe.execute()
+            LOGGER.info("Loaded next instances for classifier {} into redis".format(classifier_id))
+            return True
+
+    def _reload_documents(self, classifier_id: str, instance: dict):
+        """Replaces the order of the shared queue with the one in eve's next_instances object.  The caller
+        must hold the classifier's lock.
+
+        The queue stays authoritative for which documents are left: documents that were taken off it since
+        eve's list was written stay off, and documents that were added to it but aren't in eve's list are
+        kept (last).  The overlap queues only ever change through redis, so they're left alone.
+        """
+        queued_ids = self.r_conn.zrange(self._documents_key(classifier_id), 0, -1)
+        queued = set(queued_ids)
+        ranked_ids = [doc_id for doc_id in instance["document_ids"] if doc_id in queued]
+        ranked = set(ranked_ids)
+        document_ids = [doc_id for doc_id in queued_ids if doc_id not in ranked] + ranked_ids
+        sequence = int(self.r_conn.get(self._sequence_key(classifier_id)) or 0)
+        with self.r_conn.pipeline() as pipe:
+            pipe.delete(self._documents_key(classifier_id))
+            if document_ids:
+                pipe.zadd(self._documents_key(classifier_id), {doc_id: i for (i, doc_id) in enumerate(document_ids)})
+            pipe.set(self._sequence_key(classifier_id), max(sequence, len(document_ids)))
+            pipe.set(self._etag_key(classifier_id), instance["_etag"])
+            pipe.delete(self._reload_key(classifier_id))
+            if document_ids != instance["document_ids"]:
+                pipe.sadd(self.dirty_key, classifier_id)
+            pipe.execute()
+        LOGGER.info("Reloaded next instances for classifier {} from eve".format(classifier_id))
+
+    def has_annotator(self, classifier_id: str, user_id: str) -> bool:
+        return self.r_conn.sismember(self._annotators_key(classifier_id), user_id)
+
+    def add_annotator(self, classifier_id: str, user_id: str, overlap_document_ids: typing.List[str]):
+        """Gives an annotator their own queue of overlap documents, unless they already have one."""
+        with self._lock(classifier_id):
+            if self.has_annotator(classifier_id, user_id):
+                return
+            with self.r_conn.pipeline() as pipe:
+                if overlap_document_ids:
+                    pipe.zadd(self._overlap_key(classifier_id, user_id),
+                              {doc_id: i for (i, doc_id) in enumerate(overlap_document_ids)})
+                pipe.sadd(self._annotators_key(classifier_id), user_id)
+                pipe.sadd(self.dirty_key, classifier_id)
+                pipe.execute()
+
+    def peek(self, classifier_id: str, user_id: str) -> typing.Tuple[typing.Optional[str], typing.Optional[str]]:
+        """Returns the next shared document and the next overlap document for the given annotator,
+        either of which may be None if that queue is empty.  Nothing is removed.
+        """
+        with self.r_conn.pipeline(transaction=False) as pipe:
+            pipe.zrevrange(self._documents_key(classifier_id), 0, 0)
+            pipe.zrevrange(self._overlap_key(classifier_id, user_id), 0, 0)
+            (documents, overlap) = pipe.execute()
+        return (documents[0] if documents else None, overlap[0] if overlap else None)
+
+    def remove(self, classifier_id: str, user_id: str, document_id: str) -> bool:
+        """Removes a document from the annotator's overlap queue or, if it isn't there, from the
+        shared queue.
+
+        :return: whether the document was in either queue
+        :rtype: bool
+        """
+        removed = self.r_conn.zrem(self._overlap_key(classifier_id, user_id), document_id) or \
+                  self.r_conn.zrem(self._documents_key(classifier_id), document_id)
+        if removed:
+            self.r_conn.sadd(self.dirty_key, classifier_id)
+        return bool(removed)
+
+    def add_documents(self, classifier_id: str, document_ids: typing.List[str], overlap: bool):
+        """Adds documents to the front of the queue(s), if the classifier's queues are loaded.  If
+        they aren't, the documents will be picked up from eve when they are.
+        """
+        if not document_ids:
+            return
+        with self._lock(classifier_id):
+            if not self.is_loaded(classifier_id):
+                return
+            end = self.r_conn.incrby(self._sequence_key(classifier_id), len(document_ids))
+            scores = {doc_id: end - len(document_ids) + i for (i, doc_id) in enumerate(document_ids)}
+            with self.r_conn.pipeline() as pipe:
+                if overlap:
+                    for user_id in self.r_conn.smembers(self._annotators_key(classifier_id)):
+                        pipe.zadd(self._overlap_key(classifier_id, user_id), scores)
+                else:
+                    pipe.zadd(self._documents_key(classifier_id), scores)
+                pipe.sadd(self.dirty_key, classifier_id)
+                pipe.execute()
+
+    def remove_documents(self, classifier_id: str, document_ids: typing.List[str]):
+        """Removes documents from all of the classifier's queues, if they are loaded."""
+        if not document_ids:
+            return
+        with self._lock(classifier_id):
+            if not self.is_loaded(classifier_id):
+                return
+            with self.r_conn.pipeline() as pipe:
+                pipe.zrem(self._documents_key(classifier_id), *document_ids)
+                for user_id in self.r_conn.smembers(self._annotators_key(classifier_id)):
+                    pipe.zrem(self._overlap_key(classifier_id, user_id), *document_ids)
+                pipe.sadd(self.dirty_key, classifier_id)
+                pipe.execute()
+
+    def persist(self, classifier_id: str):
+        """Writes the classifier's queues back to its next_instances object in eve."""
+        with self._lock(classifier_id):
+            instance_id = self.r_conn.get(self._instance_key(classifier_id))
+            if instance_id is None:
+                return
+            user_ids = list(self.r_conn.smembers(self._annotators_key(classifier_id)))
+            with self.r_conn.pipeline(transaction=False) as pipe:
+                pipe.zrange(self._documents_key(classifier_id), 0, -1)
+                for user_id in user_ids:
+                    pipe.zrange(self._overlap_key(classifier_id, user_id), 0, -1)
+                results = pipe.execute()
+            to_patch = {
+                "document_ids": results[0],
+                "overlap_document_ids": dict(zip(user_ids, results[1:]))
+            }
+            etag = self.r_conn.get(self._etag_key(classifier_id))
+            if etag is not None:
+                resp = service.patch(["next_instances", instance_id], json=to_patch, headers={"If-Match": etag})
+                if resp.ok:
+                    self.r_conn.set(self._etag_key(classifier_id), resp.json()["_etag"])
+                    return
+                if resp.status_code != 412:
+                    abort(resp.status_code, resp.content)
+            # eve's object changed since it was loaded (e.g. a new ranking, or documents were added to it), so
+            # take that instead of overwriting it; the merged queues (including the overlap queues, which only
+            # change in redis) are written back with the new ETag the next time
+            LOGGER.info("Next instances for classifier {} changed in eve; reloading them".format(classifier_id))
+            instance = self._get_eve_instance(classifier_id)
+            if instance is not None:
+                self._reload_documents(classifier_id, instance)
+                self.r_conn.sadd(self.dirty_key, classifier_id)
+
+    def persist_dirty(self):
+        """Persists every classifier whose queues changed since they were last persisted.  Classifiers that
+        are marked as changed again meanwhile (e.g. after reloading them) are left for the next time.
+        """
+        for _ in range(self.r_conn.scard(self.dirty_key)):
+            classifier_id = self.r_conn.spop(self.dirty_key)
+            if classifier_id is None:
+                return
+            try:
+                self.persist(classifier_id)
+            except Exception:
+                LOGGER.exception("Unable to persist next instances for classifier {}".format(classifier_id))
+                self.r_conn.sadd(self.dirty_key, classifier_id)
+                return
+
+QUEUES = NextInstanceQueues(ServiceManager.r_conn, config.REDIS_PREFIX + "next-instances:")
+
+_PERSISTER = None
+
+def start_persister(app):
+    """Starts the background thread that periodically persists changed queues to eve."""
+    global _PERSISTER
+    if _PERSISTER is not None:
+        return
+    interval = app.config["NEXT_INSTANCES_PERSIST_INTERVAL"]
+    stop = threading.Event()
+
+    def persist():
+        with app.app_context():
+            QUEUES.persist_dirty()
+
+    def run():
+        while not stop.wait(interval):
+            try:
+                persist()
+            except Exception:
+                LOGGER.exception("Unable to persist next instances")
+
+    def shutdown():
+        stop.set()
+        try:
+            persist()
+        except Exception:
+            LOGGER.exception("Unable to persist next instances")
+
+    _PERSISTER = threading.Thread(target=run, name="next-instances-persister", daemon=True)
+    _PERSISTER.start()
+    atexit.register(shutdown)
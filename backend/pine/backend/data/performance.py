@@ -0,0 +1,74 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+"""Performance metrics of all the backend's worker processes.
+
+Every gunicorn worker has its own PerformanceHistory, so on its own /metrics would only describe
+whichever worker handled the request.  Instead, each worker publishes a snapshot of its metrics to
+redis every METRICS_PUBLISH_INTERVAL seconds (and whenever it serves /metrics), and /metrics returns
+the snapshots of all live workers.  Snapshots of workers that stopped expire after a few intervals.
+
+Every series has a worker label (host name and process ID), so each one only ever goes up (a
+restarted worker is a new worker).  Sum over it for the totals of the whole backend, e.g.
+``sum without (worker) (rate(pine_route_duration_seconds_count[5m]))``.
+"""
+
+import atexit
+import json
+import logging
+import os
+import platform
+import threading
+import typing
+
+from .service import PERFORMANCE_HISTORY
+from ..job_manager.service import ServiceManager, config
+
+LOGGER = logging.getLogger(__name__)
+
+KEY_PREFIX = config.REDIS_PREFIX + "metrics:"
+
+def _worker() -> str:
+    return "{}:{}".format(platform.node(), os.getpid())
+
+def publish(interval: float):
+    """Publishes this worker's metrics, to be kept for a few intervals."""
+    ServiceManager.r_conn.setex(KEY_PREFIX + _worker(), max(1, int(3 * interval)),
+                                json.dumps(PERFORMANCE_HISTORY.snapshot()))
+
+def get_snapshots(interval: float) -> typing.Dict[str, dict]:
+    """Returns the latest metrics snapshot of every live worker, by worker."""
+    publish(interval)
+    keys = sorted(ServiceManager.r_conn.scan_iter(match=KEY_PREFIX + "*"))
+    snapshots = {}
+    for (key, snapshot) in zip(keys, ServiceManager.r_conn.mget(keys) if keys else []):
+        if snapshot is not None:
+            snapshots[key[len(KEY_PREFIX):]] = json.loads(snapshot)
+    return snapshots
+
+_PUBLISHER = None
+
+def start_publisher(app):
+    """Starts the background thread that periodically publishes this worker's metrics."""
+    global _PUBLISHER
+    if _PUBLISHER is not None:
+        return
+    interval = app.config["METRICS_PUBLISH_INTERVAL"]
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            try:
+                publish(interval)
+            except Exception:
+                LOGGER.exception("Unable to publish performance metrics")
+
+    def shutdown():
+        stop.set()
+        try:
+            ServiceManager.r_conn.delete(KEY_PREFIX + _worker())
+        except Exception:
+            LOGGER.exception("Unable to remove performance metrics")
+
+    _PUBLISHER = threading.Thread(target=run, name="metrics-publisher", daemon=True)
+    _PUBLISHER.start()
+    atexit.register(shutdown)
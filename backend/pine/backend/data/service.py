@@ -1,15 +1,24 @@
 # (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
 
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import copy
+import functools
 import json
 import logging
 import math
+import os
 from pprint import pformat, pprint
 import sys
 import threading
+import time
 import typing
 
 from flask import abort, current_app, Response
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__name__)
 
@@ -18,9 +27,48 @@ PATH_TYPE = typing.Union[typing.List[str], typing.Tuple[str], typing.Set[str], s
 type of strings that is combined with a '/'.
 """
 
+class LatencyStats(object):
+    """Running count and total of durations, plus a window of the most recent durations that is
+    used to estimate quantiles.
+    """
+
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, window: int):
+        self.count = 0
+        self.total = 0.0
+        self.recent = collections.deque(maxlen=window)
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.recent.append(seconds)
+
+    def quantiles(self) -> typing.Dict[float, float]:
+        if not self.recent:
+            return {q: 0.0 for q in self.QUANTILES}
+        ordered = sorted(self.recent)
+        return {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in self.QUANTILES}
+
 class PerformanceHistory(object):
+    """Instrumentation for the backend.
+
+    Besides the per-verb call counts and byte sizes for eve requests (``data``), this keeps
+    latencies, error counts, and in-flight gauges for three kinds of operations, each keyed by a
+    tuple of labels:
+
+    * ``"eve"``: requests to eve, labelled by method and eve resource
+    * ``"route"``: requests to the backend itself, labelled by method and flask route
+    * ``"redis"``: job manager operations, labelled by operation name
+    """
+
+    KINDS = {
+        "eve": ("method", "resource"),
+        "route": ("method", "route"),
+        "redis": ("operation",)
+    }
 
-    def __init__(self):
+    def __init__(self, latency_window: int = 1000):
         self.data = {
             "get": {},
             "post": {},
@@ -28,6 +76,10 @@ class PerformanceHistory(object):
             "delete": {},
             "patch": {}
         }
+        self.latency_window = latency_window
+        self.latencies = {kind: {} for kind in self.KINDS}
+        self.errors = {kind: {} for kind in self.KINDS}
+        self.in_flight = {kind: {} for kind in self.KINDS}
         self.lock = threading.Lock()
 
     def pformat(self, **kwargs):
@@ -61,6 +113,109 @@ class PerformanceHistory(object):
         finally:
             self.lock.release()
 
+    def start(self, kind: str, labels: tuple) -> float:
+        """Marks an operation as in flight and returns its start time, to be passed to finish."""
+        with self.lock:
+            self.in_flight[kind][labels] = self.in_flight[kind].get(labels, 0) + 1
+        return time.perf_counter()
+
+    def finish(self, kind: str, labels: tuple, start: float, error: str = None):
+        """Records the latency of an operation begun with start, and an error if one is given
+        (e.g. an HTTP status code or exception name).
+        """
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.in_flight[kind][labels] -= 1
+            if labels not in self.latencies[kind]:
+                self.latencies[kind][labels] = LatencyStats(self.latency_window)
+            self.latencies[kind][labels].add(elapsed)
+            if error is not None:
+                key = labels + (str(error),)
+                self.errors[kind][key] = self.errors[kind].get(key, 0) + 1
+
+    @contextlib.contextmanager
+    def track(self, kind: str, *labels: str):
+        """Context manager that records the latency of the enclosed block, counting an error if it
+        raises.
+        """
+        start = self.start(kind, labels)
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.finish(kind, labels, start, error=error)
+
+    def timed(self, kind: str, *labels: str):
+        """Decorator version of track."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.track(kind, *labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self) -> dict:
+        """Returns a JSON-serializable copy of all the recorded metrics."""
+        with self.lock:
+            snapshot = {"eve_requests": copy.deepcopy(self.data)}
+            for kind, label_names in self.KINDS.items():
+                snapshot[kind] = []
+                for labels, stats in self.latencies[kind].items():
+                    entry = dict(zip(label_names, labels))
+                    entry["count"] = stats.count
+                    entry["total_seconds"] = stats.total
+                    for q, value in stats.quantiles().items():
+                        entry["p{}".format(int(q * 100))] = value
+                    entry["in_flight"] = self.in_flight[kind].get(labels, 0)
+                    entry["errors"] = {key[-1]: count for (key, count) in self.errors[kind].items()
+                                       if key[:-1] == labels}
+                    snapshot[kind].append(entry)
+            return snapshot
+
+    @classmethod
+    def prometheus(cls, snapshots: typing.Dict[str, dict]) -> str:
+        """Returns the given snapshots (by worker) in the prometheus text exposition format, with a
+        worker label on every series.
+        """
+        def fmt_labels(names, values):
+            return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                                  for (name, value) in zip(names, values)) + "}"
+        lines = []
+        for kind, label_names in cls.KINDS.items():
+            label_names = ("worker",) + label_names
+            entries = [(((worker,) + tuple(entry[name] for name in label_names[1:])), entry)
+                       for (worker, snapshot) in snapshots.items() for entry in snapshot[kind]]
+            name = "pine_{}_duration_seconds".format(kind)
+            lines.append("# TYPE {} summary".format(name))
+            for labels, entry in entries:
+                for q in LatencyStats.QUANTILES:
+                    value = entry["p{}".format(int(q * 100))]
+                    lines.append("{}{} {}".format(name, fmt_labels(label_names + ("quantile",), labels + (q,)), value))
+                lines.append("{}_sum{} {}".format(name, fmt_labels(label_names, labels), entry["total_seconds"]))
+                lines.append("{}_count{} {}".format(name, fmt_labels(label_names, labels), entry["count"]))
+            name = "pine_{}_errors_total".format(kind)
+            lines.append("# TYPE {} counter".format(name))
+            for labels, entry in entries:
+                for error, count in entry["errors"].items():
+                    lines.append("{}{} {}".format(name, fmt_labels(label_names + ("error",), labels + (error,)), count))
+            name = "pine_{}_in_flight".format(kind)
+            lines.append("# TYPE {} gauge".format(name))
+            for labels, entry in entries:
+                lines.append("{}{} {}".format(name, fmt_labels(label_names, labels), entry["in_flight"]))
+        for (metric, field) in [("pine_eve_response_bytes_total", "response_content_size"),
+                                ("pine_eve_request_bytes_total", "request_body_size")]:
+            lines.append("# TYPE {} counter".format(metric))
+            for (worker, snapshot) in snapshots.items():
+                for rest_type, data_types in snapshot["eve_requests"].items():
+                    for data_type, p in data_types.items():
+                        lines.append("{}{} {}".format(metric, fmt_labels(("worker", "method", "resource"),
+                                                                         (worker, rest_type, data_type)), p[field]))
+        return "\n".join(lines) + "\n"
+
 PERFORMANCE_HISTORY = PerformanceHistory()
 
 def _standardize_path(path: PATH_TYPE, *additional_paths: typing.List[str]) -> typing.List[str]:
@@ -108,70 +263,114 @@ def params(params: dict) -> dict:
     return {key: json.dumps(value) if type(value) == dict else value for (key, value) in params.items()}
 
 
+RETRY_STATUSES = (502, 503, 504)
+"""Eve response statuses that are retried (with backoff) for idempotent requests."""
+
+_THREAD_LOCAL = threading.local()
+
+def _create_session() -> requests.Session:
+    config = current_app.config
+    # read errors (including read timeouts) aren't retried: eve may have received the request, and the
+    # retries would outlast gunicorn's worker timeout
+    retries = Retry(total=config["EVE_MAX_RETRIES"],
+                    read=0,
+                    backoff_factor=config["EVE_RETRY_BACKOFF_FACTOR"],
+                    status_forcelist=RETRY_STATUSES,
+                    raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=config["EVE_POOL_CONNECTIONS"],
+                          pool_maxsize=config["EVE_POOL_MAXSIZE"],
+                          max_retries=retries)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if not config["EVE_KEEP_ALIVE"]:
+        session.headers["Connection"] = "close"
+    return session
+
+def get_session() -> requests.Session:
+    """Returns the pooled session used to talk to eve.
+    
+    Sessions aren't guaranteed to be thread-safe, so one is lazily created for each thread (and
+    re-created in a forked worker process) and then reused so that connections are kept alive.
+    
+    :return: the session for the current thread
+    :rtype: requests.Session
+    """
+    pid = os.getpid()
+    if getattr(_THREAD_LOCAL, "session", None) is None or _THREAD_LOCAL.pid != pid:
+        _THREAD_LOCAL.session = _create_session()
+        _THREAD_LOCAL.pid = pid
+    return _THREAD_LOCAL.session
+
+def _request(method: str, path: PATH_TYPE, **kwargs: dict) -> requests.Response:
+    global PERFORMANCE_HISTORY
+    if "timeout" not in kwargs:
+        kwargs["timeout"] = (current_app.config["EVE_CONNECT_TIMEOUT"], current_app.config["EVE_READ_TIMEOUT"])
+    labels = (method, _standardize_path(path)[0])
+    start = PERFORMANCE_HISTORY.start("eve", labels)
+    error = None
+    try:
+        resp = get_session().request(method, url(path), **kwargs)
+        if resp.status_code >= 400:
+            error = resp.status_code
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        PERFORMANCE_HISTORY.finish("eve", labels, start, error=error)
+    PERFORMANCE_HISTORY.add(method, path, resp)
+    return resp
+
+
 def get(path: PATH_TYPE, **kwargs: dict) -> requests.Response:
-    """Wraps requests.get for the given eve-relative path.
+    """Wraps requests.get for the given eve-relative path using the pooled session.
     
     :param path: list[str]|str: eve-relative path (e.g. ["collections", id] or "/collections")
     :param **kwargs: dict: any additional arguments to pass to requests.get
     :return: server response
     :rtype: requests.Response
     """
-    global PERFORMANCE_HISTORY
-    resp = requests.get(url(path), **kwargs)
-    PERFORMANCE_HISTORY.add("get", path, resp)
-    return resp
+    return _request("get", path, **kwargs)
 
 def post(path: PATH_TYPE, **kwargs: dict) -> requests.Response:
-    """Wraps requests.post for the given eve-relative path.
+    """Wraps requests.post for the given eve-relative path using the pooled session.
     
     :param path: list[str]|str: eve-relative path (e.g. ["collections", id] or "/collections")
     :param **kwargs: dict: any additional arguments to pass to requests.post
     :return: server response
     :rtype: requests.Response
     """
-    global PERFORMANCE_HISTORY
-    resp = requests.post(url(path), **kwargs)
-    PERFORMANCE_HISTORY.add("post", path, resp)
-    return resp
+    return _request("post", path, **kwargs)
 
 def put(path: PATH_TYPE, **kwargs: dict) -> requests.Response:
-    """Wraps requests.put for the given eve-relative path.
+    """Wraps requests.put for the given eve-relative path using the pooled session.
     
     :param path: list[str]|str: eve-relative path (e.g. ["collections", id] or "/collections")
     :param **kwargs: dict: any additional arguments to pass to requests.put
     :return: server response
     :rtype: requests.Response
     """
-    global PERFORMANCE_HISTORY
-    resp = requests.put(url(path), **kwargs)
-    PERFORMANCE_HISTORY.add("put", path, resp)
-    return resp
+    return _request("put", path, **kwargs)
 
 def delete(path: PATH_TYPE, **kwargs: dict) -> requests.Response:
-    """Wraps requests.delete for the given eve-relative path.
+    """Wraps requests.delete for the given eve-relative path using the pooled session.
     
     :param path: list[str]|str: eve-relative path (e.g. ["collections", id] or "/collections")
     :param **kwargs: dict: any additional arguments to pass to requests.delete
     :return: server response
     :rtype: requests.Response
     """
-    global PERFORMANCE_HISTORY
-    resp = requests.delete(url(path), **kwargs)
-    PERFORMANCE_HISTORY.add("delete", path, resp)
-    return resp
+    return _request("delete", path, **kwargs)
 
 def patch(path: PATH_TYPE, **kwargs: dict) -> requests.Response:
-    """Wraps requests.patch for the given eve-relative path.
+    """Wraps requests.patch for the given eve-relative path using the pooled session.
     
     :param path: list[str]|str: eve-relative path (e.g. ["collections", id] or "/collections")
     :param **kwargs: dict: any additional arguments to pass to requests.patch
     :return: server response
     :rtype: requests.Response
     """
-    global PERFORMANCE_HISTORY
-    resp = requests.patch(url(path), **kwargs)
-    PERFORMANCE_HISTORY.add("patch", path, resp)
-    return resp
+    return _request("patch", path, **kwargs)
 
 
 def get_item_by_id(path: PATH_TYPE, item_id: str, params: dict = {}) -> dict:
@@ -205,15 +404,57 @@ def get_all_versions_of_item_by_id(path: PATH_TYPE, item_id: str, params: dict =
     return resp.json()
 
 
-def get_all(path: PATH_TYPE, params={}) -> dict:
+def get_all_versions_of_items(path: PATH_TYPE, params: dict = {}, max_results: int = None) -> typing.List[dict]:
+    """Gets all versions of all items matching the given "where" parameter.  This is the bulk
+    equivalent of calling get_all_versions_of_item_by_id for each item, but it only takes one
+    request to eve per page rather than one request per item.
+    
+    :param path: list[str]|str: eve-relative path of a versioned resource (e.g. "annotations")
+    :param params: dict: optional additional parameters (e.g. "where" and "projection")
+    :param max_results: int: optional page size, capped at EVE_PAGINATION_LIMIT
+    :return: the versions as a list of dicts, sorted by item ID and then version
+    :rtype: list[dict]
+    """
+    return get_all_items(["versions"] + _standardize_path(path), params=params, max_results=max_results)
+
+_PAGE_EXECUTOR = None
+_PAGE_EXECUTOR_PID = None
+_PAGE_EXECUTOR_LOCK = threading.Lock()
+
+def _get_page_executor() -> ThreadPoolExecutor:
+    # shared so that the threads (and their pooled sessions) are reused between calls
+    global _PAGE_EXECUTOR, _PAGE_EXECUTOR_PID
+    with _PAGE_EXECUTOR_LOCK:
+        if _PAGE_EXECUTOR is None or _PAGE_EXECUTOR_PID != os.getpid():
+            _PAGE_EXECUTOR = ThreadPoolExecutor(max_workers=current_app.config["EVE_PAGE_FETCH_WORKERS"],
+                                                thread_name_prefix="eve-page-fetch")
+            _PAGE_EXECUTOR_PID = os.getpid()
+        return _PAGE_EXECUTOR
+
+def _get_page(app, path: PATH_TYPE, params: dict) -> dict:
+    with app.app_context():
+        resp = get(path, params=params)
+        if not resp.ok:
+            abort(resp.status_code)
+        return resp.json()
+
+def get_all(path: PATH_TYPE, params={}, max_results: int = None) -> dict:
     """Returns ALL database items, using pagination if needed.  This returns the "normal" eve
     JSON with "_items", "_meta", etc.
     
+    The first page is fetched to find the total number of items; any remaining pages are then
+    fetched concurrently and merged in page order.
+    
     :param path: list[str]|str: eve-relative path (e.g. ["collections", id] or "/collections")
     :param params: dict: optional additional parameters to send in with GET
+    :param max_results: int: optional page size, capped at EVE_PAGINATION_LIMIT; larger pages
+                             mean fewer round-trips to eve
     :return: an eve collections dict with, e.g., _items
     :rtype: dict
     """
+    params = dict(params)
+    if max_results:
+        params["max_results"] = min(max_results, current_app.config["EVE_PAGINATION_LIMIT"])
     resp = get(path, params=params)
     if not resp.ok:
         abort(resp.status_code)
@@ -225,30 +466,87 @@ def get_all(path: PATH_TYPE, params={}) -> dict:
 
     page = body["_meta"]["page"]
     total_pages = math.ceil(body["_meta"]["total"] / body["_meta"]["max_results"])
+    if page >= total_pages:
+        return all_items
 
-    while page < total_pages:
-        page += 1
-        params["page"] = page
-        resp = get(path, params=params)
-        if not resp.ok:
-            abort(resp.status_code)
-        body = resp.json()
-        all_items["_items"] += body["_items"]
-        page = body["_meta"]["page"]
-        total_pages = math.ceil(body["_meta"]["total"] / body["_meta"]["max_results"])
+    app = current_app._get_current_object()
+    executor = _get_page_executor()
+    futures = [executor.submit(_get_page, app, path, dict(params, page=next_page))
+               for next_page in range(page + 1, total_pages + 1)]
+    for future in futures:
+        all_items["_items"] += future.result()["_items"]
 
     return all_items
 
 
-def get_all_items(path: PATH_TYPE, params={}) -> typing.List[dict]:
+def get_all_items(path: PATH_TYPE, params={}, max_results: int = None) -> typing.List[dict]:
     """Returns ALL database items, using pagination if needed.
     
     :param path: list[str]|str: eve-relative path (e.g. ["collections", id] or "/collections")
     :param params: dict: optional additional parameters to send in with GET
+    :param max_results: int: optional page size, capped at EVE_PAGINATION_LIMIT
     :return: the items as a list of dicts
     :rtype: list[dict]
     """
-    return get_all(path, params=params)["_items"]
+    return get_all(path, params=params, max_results=max_results)["_items"]
+
+
+def iter_pages(path: PATH_TYPE, params={}, max_results: int = None) -> typing.Iterator[typing.List[dict]]:
+    """Yields database items one page at a time, so that only a single page needs to be held in
+    memory.  Pages are fetched lazily, as the caller asks for them.
+
+    :param path: list[str]|str: eve-relative path (e.g. ["collections", id] or "/collections")
+    :param params: dict: optional additional parameters to send in with GET
+    :param max_results: int: optional page size, capped at EVE_PAGINATION_LIMIT
+    :return: a generator of the items in each page as a list of dicts
+    :rtype: iterator[list[dict]]
+    """
+    params = dict(params)
+    if max_results:
+        params["max_results"] = min(max_results, current_app.config["EVE_PAGINATION_LIMIT"])
+    page = 1
+    while True:
+        resp = get(path, params=dict(params, page=page))
+        if not resp.ok:
+            abort(resp.status_code)
+        body = resp.json()
+        yield body["_items"]
+        if "_meta" not in body or \
+           page >= math.ceil(body["_meta"]["total"] / body["_meta"]["max_results"]):
+            return
+        page += 1
+
+
+def _get_all_items_in_app(app, path: PATH_TYPE, params: dict, max_results: int) -> typing.List[dict]:
+    # pages are fetched one after the other so that this can itself run on the page executor
+    with app.app_context():
+        return [item for page in iter_pages(path, params=params, max_results=max_results) for item in page]
+
+def get_all_items_by_ids(path: PATH_TYPE, ids: typing.List[str], field: str = "_id", params: dict = {},
+                         chunk_size: int = 100) -> typing.List[dict]:
+    """Returns ALL database items whose given field is one of the given IDs.
+
+    The IDs are looked up in chunks so that the URLs stay reasonably short, and the chunks are
+    fetched concurrently.
+
+    :param path: list[str]|str: eve-relative path (e.g. "documents")
+    :param ids: list[str]: the IDs to look up
+    :param field: str: the field to match the IDs against (e.g. "document_id"), by default "_id"
+    :param params: dict: optional additional parameters other than "where" (e.g. "projection"),
+                         in eve format (see params)
+    :param chunk_size: int: the number of IDs to look up per request
+    :return: the items as a list of dicts, in chunk order
+    :rtype: list[dict]
+    """
+    if not ids:
+        return []
+    app = current_app._get_current_object()
+    executor = _get_page_executor()
+    max_results = current_app.config["EVE_PAGINATION_LIMIT"]
+    futures = [executor.submit(_get_all_items_in_app, app, path,
+                               dict(params, where=json.dumps({field: {"$in": ids[i:i + chunk_size]}})), max_results)
+               for i in range(0, len(ids), chunk_size)]
+    return [item for future in futures for item in future.result()]
 
 
 def convert_response(requests_response: requests.Response) -> Response:
@@ -5,12 +5,12 @@ import random
 import re
 import typing
 
-from flask import abort, Blueprint, jsonify, request
+from flask import abort, Blueprint, current_app, jsonify, request
 import lxml.html.clean
 from werkzeug import exceptions
 
 from .. import auth, collections, log, models
-from ..data import service
+from ..data import next_instances as next_instance_queues, service
 
 bp = Blueprint("documents", __name__, url_prefix = "/documents")
 
@@ -117,7 +117,8 @@ def get_all_documents_in_collection(col_id):
             })
             params["truncate"] = truncate_length
 
-    return jsonify(service.get_all("documents", params=params))
+    return jsonify(service.get_all("documents", params=params,
+                                   max_results=current_app.config["EVE_PAGINATION_LIMIT"]))
 
 @bp.route("/by_collection_id_paginated/<collection_id>", methods = ["GET"])
 @auth.login_required
@@ -216,32 +217,6 @@ def _get_collection_classifiers(collection_ids):
             collection_classifiers[collection_id] = classifier_obj[0]
     return collection_classifiers
 
-def _get_classifier_next_instances(collection_classifiers: dict):
-    # documents objects must have _id and collection_id
-    classifier_next_instances = {}
-    for collection_id in collection_classifiers:
-        classifier = collection_classifiers[collection_id]
-        classifier_id = classifier["_id"]
-        
-        if classifier_id not in classifier_next_instances:
-            # Get next_instances to which we'll add document
-            next_instances_params = service.params({
-                "where": {
-                    "classifier_id": classifier_id
-                }, "projection": {
-                    "overlap_document_ids": 1,
-                    "document_ids": 1
-                }
-            })
-            resp = service.get("next_instances", params=next_instances_params)
-            if not resp.ok:
-                abort(resp.status_code)
-            next_instances_obj = resp.json()["_items"]
-            if len(next_instances_obj) != 1:
-                raise exceptions.BadRequest()
-            classifier_next_instances[classifier_id] = next_instances_obj[0]
-    return classifier_next_instances
-
 @bp.route("/", strict_slashes = False, methods = ["POST"])
 @auth.login_required
 def add_document():
@@ -284,30 +259,32 @@ def add_document():
         doc_ids = [doc_resp_json["_id"]]
 
     # Update next instances for added documents
-    classifier_next_instances = _get_classifier_next_instances(collection_classifiers)
+    classifier_added_ids = {classifier["_id"]: ([], []) for classifier in collection_classifiers.values()}
     for (i, document) in enumerate(docs):
         doc_id = doc_ids[i]
-
-        classifier = collection_classifiers[document["collection_id"]]
-        classifier_id = classifier["_id"]
-        next_instances = classifier_next_instances[classifier_id]
-
+        classifier_id = collection_classifiers[document["collection_id"]]["_id"]
         if document["overlap"] == 1:
             # Add document to overlap IDs for each annotator if it's an overlap document
-            for annotator in next_instances["overlap_document_ids"]:
-                next_instances["overlap_document_ids"][annotator].append(doc_id)
+            classifier_added_ids[classifier_id][1].append(doc_id)
         else:
             # Add document to document_ids if it's not an overlap document
-            next_instances["document_ids"].append(doc_id)
-
-    # Patch next_instances with new documents
-    for next_instances in classifier_next_instances.values():
-        headers = {"If-Match": next_instances["_etag"]}
-        service.remove_nonupdatable_fields(next_instances)
-        resp = service.patch(["next_instances", next_instances["_id"]], json=next_instances, headers=headers)
+            classifier_added_ids[classifier_id][0].append(doc_id)
+
+    # Append to next_instances in place rather than re-writing the whole lists
+    for (classifier_id, (added_ids, added_overlap_ids)) in classifier_added_ids.items():
+        resp = service.post(["next_instances", "add_documents"], json={
+            "classifier_id": classifier_id,
+            "document_ids": added_ids,
+            "overlap_document_ids": added_overlap_ids
+        })
         if not resp.ok:
             raise exceptions.BadRequest()
 
+    # and the redis queues, if they've been loaded
+    for (classifier_id, (added_ids, added_overlap_ids)) in classifier_added_ids.items():
+        next_instance_queues.QUEUES.add_documents(classifier_id, added_ids, overlap=False)
+        next_instance_queues.QUEUES.add_documents(classifier_id, added_overlap_ids, overlap=True)
+
     return service.convert_response(doc_resp)
 
 @bp.route("/user_permissions/<doc_id>", methods = ["GET"])
@@ -344,92 +321,26 @@ def update_metadata(doc_id):
         service.patch(["documents", doc_id], json = document, headers = headers))
 
 def _delete_documents_by_id(doc_ids: typing.List[str]) -> bool:
-    for perm in get_user_permissions_by_ids(doc_ids):
+    collection_ids = get_collection_ids_for(doc_ids)
+    for perm in collections.get_user_permissions_by_ids(collection_ids):
         if not perm.delete_documents:
             raise exceptions.Unauthorized()
-    
-    documents = []
-    for doc_id in doc_ids:
-        doc_resp = service.get(["documents", doc_id], params=service.params({
-            "projection": {
-                "_id": 1,
-                "collection_id": 1
-            }
-        }))
-        if not doc_resp.ok:
-            abort(doc_resp.status_code)
-        documents.append(doc_resp.json())
 
-    changed_objects = {
-        "next_instances": {
-            "updated": []
-        },
-        "annotations": {
-            "deleted": []
-        },
-        "documents": {
-            "deleted": []
-        }
-    }
-    
     # iaa_reports will get updated on the next annotation call
     # metrics will get updated on the next train call
-    
-    # next_instances
-    collection_classifiers = _get_collection_classifiers([doc["collection_id"] for doc in documents])
-    classifier_next_instances = _get_classifier_next_instances(collection_classifiers)
-    for classifier_id in classifier_next_instances:
-        next_instances = classifier_next_instances[classifier_id]
-        
-        original_overlap_count = sum([len([next_instances["overlap_document_ids"][ann] for ann in next_instances["overlap_document_ids"]])])
-        for annotator in next_instances["overlap_document_ids"]:
-            next_instances["overlap_document_ids"][annotator] = [doc_id for doc_id in next_instances["overlap_document_ids"][annotator] if doc_id not in doc_ids]
-        modified_overlap_count = sum([len([next_instances["overlap_document_ids"][ann] for ann in next_instances["overlap_document_ids"]])])
-        
-        original_document_count = len(next_instances["document_ids"])
-        next_instances["document_ids"] = [doc_id for doc_id in next_instances["document_ids"] if doc_id not in doc_ids]
-        modified_document_count = len(next_instances["document_ids"])
-    
-        if original_overlap_count != modified_overlap_count or original_document_count != modified_document_count:
-            next_instance_id = next_instances["_id"]
-            headers = {"If-Match": next_instances["_etag"]}
-            service.remove_nonupdatable_fields(next_instances)
-            resp = service.patch(["next_instances", next_instance_id], json=next_instances, headers=headers)
-            if resp.ok:
-                changed_objects["next_instances"]["updated"].append(next_instance_id)
-            else:
-                raise exceptions.InternalServerError()
-    
-    # annotations
-    for doc_id in doc_ids:
-        annotations = service.get_all_items("annotations", params = service.params({
-            "where": {
-                "document_id": doc_id
-            }, "projection": {
-                "_id": 1
-            }
-        }))
-        for annotation in annotations:
-            annotation_id = annotation["_id"]
-            headers = {"If-Match": annotation["_etag"]}
-            service.remove_nonupdatable_fields(annotation)
-            resp = service.delete(["annotations", annotation_id], headers=headers)
-            if resp.ok:
-                changed_objects["annotations"]["deleted"].append(annotation_id)
-            else:
-                raise exceptions.InternalServerError()
-    
-    # delete actual documents
-    for doc in documents:
-        doc_id = doc["_id"]
-        headers = {"If-Match": doc["_etag"]}
-        service.remove_nonupdatable_fields(doc)
-        resp = service.delete(["documents", doc_id], headers=headers)
-        if resp.ok:
-            changed_objects["documents"]["deleted"].append(doc_id)
-        else:
-            raise exceptions.InternalServerError()
-    
+
+    # documents, annotations, and next_instances are all handled by eve in bulk
+    resp = service.post(["documents", "delete_by_ids"], json={
+        "document_ids": doc_ids
+    })
+    if not resp.ok:
+        abort(resp.status_code)
+    changed_objects = resp.json()
+
+    # next_instances that have been loaded into redis
+    for classifier in _get_collection_classifiers(collection_ids).values():
+        next_instance_queues.QUEUES.remove_documents(classifier["_id"], doc_ids)
+
     return (True, changed_objects)
 
 # note: this will not retrain any models that had used this document
@@ -29,6 +29,7 @@ import pydash
 import redis
 from pebble import ThreadPool
 
+from ..data.service import PERFORMANCE_HISTORY
 from ..shared.config import ConfigBuilder
 
 config = ConfigBuilder.get_config()
@@ -62,7 +63,7 @@ class ServiceManager(object):
     redis_reg_key_prefix = redis_key_prefix + "codex:"
     redis_channels_key = redis_key_prefix + "channels"
     redis_channel_ttl_key_prefix = redis_key_prefix + "channel-ttl:"  # not really ttl, but more like registered date
-    redis_work_queue_key_prefix = redis_key_prefix + "work-queue:"
+    redis_work_stream_key_prefix = redis_key_prefix + "work-stream:"  # jobs are XADDed here and read by a consumer group
     redis_work_mutex_key_prefix = redis_key_prefix + "work-mutex:"
     redis_handler_mutex_key_prefix = redis_key_prefix + "handler-mutex:"
     
@@ -70,6 +71,15 @@ class ServiceManager(object):
     def get_results_key(cls, service_name: str, job_id: str) -> str:
         return "{}{}:work-results:{}".format(config.REDIS_PREFIX, service_name, job_id)
 
+    @classmethod
+    def get_progress_key(cls, service_name: str, job_id: str) -> str:
+        return "{}{}:work-progress:{}".format(config.REDIS_PREFIX, service_name, job_id)
+
+    @classmethod
+    def get_work_stream_key(cls, service_name: str) -> str:
+        # ends with the service name like the other registration keys so it can be parsed back out
+        return cls.redis_work_stream_key_prefix + service_name
+
     @classmethod
     def get_running_jobs_key(cls, service_name: str) -> str:
         return "{}{}:running-jobs".format(config.REDIS_PREFIX, service_name)
@@ -79,7 +89,10 @@ class ServiceManager(object):
     # this is how long a registered-service will live unless it get's an update
     redis_reg_key_ttl = int(timedelta(seconds=config.SCHEDULER_REGISTRATION_TIMEOUT).total_seconds())
     redis_channels_key_ttl = int(timedelta(minutes=60).total_seconds())  # do not touch (this is how long the overall list of channels will live)
-    redis_work_queue_key_ttl = int(timedelta(seconds=config.SCHEDULER_QUEUE_TIMEOUT).total_seconds())  # how long a job can sit in the queue before it expires
+    redis_work_stream_maxlen = 10000  # (approximate) number of unacknowledged jobs a work stream holds before trimming the oldest
+
+    # Consumer group the pipelines read the work streams with (must match the pipelines' listener)
+    redis_work_stream_group = "pipelines"
 
     # Redis Mutex Key TTL (Use by locks)
     redis_work_mutex_key_ttl = int(timedelta(minutes=10).total_seconds())  # how long can this mutex be acquired
@@ -117,6 +130,7 @@ class ServiceManager(object):
         atexit.register(self.stop_listeners)
 
     @classmethod
+    @PERFORMANCE_HISTORY.timed("redis", "get_registered_channels")
     def get_registered_channels(cls, include_ttl=False):
         """
         Get list of registered channels, with registration time if requested.
@@ -141,6 +155,7 @@ class ServiceManager(object):
         return dict(zip(registered_channels, final_values))
 
     @classmethod
+    @PERFORMANCE_HISTORY.timed("redis", "get_registered_service_details")
     def get_registered_service_details(cls, service_name=None):
         """
         Get registration details of a service.
@@ -158,6 +173,7 @@ class ServiceManager(object):
         return service_details
 
     @classmethod
+    @PERFORMANCE_HISTORY.timed("redis", "get_registered_services")
     def get_registered_services(cls, include_details=True):
         """
         Get list of registered services and registration body if requested.
@@ -216,6 +232,21 @@ class ServiceManager(object):
         return service_channel
 
     @classmethod
+    def _has_stream_consumers(cls, stream_key: str) -> bool:
+        """
+        Whether any pipeline has joined the consumer group of the given work stream.
+        :type stream_key: str
+        :rtype: bool
+        """
+        try:
+            groups = cls.r_conn.xinfo_groups(stream_key)
+        except redis.ResponseError:
+            # the stream doesn't exist, so no pipeline has ever listened on it
+            return False
+        return any(group["name"] == cls.redis_work_stream_group and group["consumers"] > 0 for group in groups)
+
+    @classmethod
+    @PERFORMANCE_HISTORY.timed("redis", "send_service_request")
     def send_service_request(cls, service_name: str, data, job_id=None, encoder=None):
         """
         Queue's a job for the requested service.
@@ -226,35 +257,27 @@ class ServiceManager(object):
         :rtype: None | dict
         """
         service_channel = cls._get_service_channel(service_name)
-        if service_name == None:
+        if service_channel == None:
+            return None
+        redis_stream_key = cls.get_work_stream_key(service_name)
+        if not cls._has_stream_consumers(redis_stream_key):
+            # no-one would consume it
             return None
-        redis_queue_key = cls.redis_work_queue_key_prefix + service_name
         job_id_to_use = job_id if isinstance(job_id, str) else uuid.uuid4().hex
-        request_body = {"job_id": job_id_to_use, "job_type": "request", "job_queue": redis_queue_key}
-        request_body_publish = json.dumps(request_body.copy(), separators=(",", ":"), cls=encoder)
-        request_body.update({"job_data": data})
+        request_body = {"job_id": job_id_to_use, "job_type": "request", "job_queue": redis_stream_key,
+                        "job_data": data}
         try:
-            request_body_queue = json.dumps(request_body, separators=(",", ":"), cls=encoder)
+            request_body_stream = json.dumps(request_body, separators=(",", ":"), cls=encoder)
         except (json.JSONDecodeError, TypeError):
             logger.warning("Unable to encode data.")
             return None
         cls.r_conn.sadd(cls.get_running_jobs_key(service_name), job_id_to_use)
-        with cls.r_conn.pipeline() as pipe:
-            pipe.rpush(redis_queue_key, request_body_queue)
-            # if nothing is processed in "redis_queue_key_ttl" minutes since last insert, the queue will be deleted
-            pipe.expire(redis_queue_key, cls.redis_work_queue_key_ttl)
-            num_pushed, expire_is_set = pipe.execute()
-        if num_pushed < 1 or expire_is_set is not True:
-            return None
-        num_received = cls.r_conn.publish(service_channel, request_body_publish)
-        # no-one consumed it
-        if num_received <= 0:
-            # TODO: potential race-condition here due to popping potentially wrong thing in multi-process (we should use a lock)
-            cls.r_conn.rpop(redis_queue_key)
-            return None
+        cls.r_conn.xadd(redis_stream_key, {"job": request_body_stream},
+                        maxlen=cls.redis_work_stream_maxlen, approximate=True)
         return request_body
 
     @classmethod
+    @PERFORMANCE_HISTORY.timed("redis", "get_job_response")
     def get_job_response(cls, service_name: str, job_id: str, timeout_in_s: int):
         """
         Waits for a response for the given job and returns it.
@@ -270,6 +293,32 @@ class ServiceManager(object):
             response = json.loads(response[1])
         return response
 
+    @classmethod
+    @PERFORMANCE_HISTORY.timed("redis", "get_job_progress")
+    def get_job_progress(cls, service_name: str, job_id: str, last_id: str = "0", timeout_in_s: int = 0) -> typing.List[dict]:
+        """
+        Returns the progress updates the job reported after the given update ID, waiting for new ones if there
+        aren't any yet.  Each update has its ID under "id" so that the next call can continue from it.
+        :param service_name: str: service name
+        :param job_id: str: job ID
+        :param last_id: str: ID of the last update already seen, or "0" for all updates
+        :param timeout_in_s: int: how long to wait for an update, or 0 to not wait
+        :rtype list[dict]
+        """
+        block = int(timeout_in_s * 1000) if timeout_in_s and timeout_in_s > 0 else None
+        streams = cls.r_conn.xread({cls.get_progress_key(service_name, job_id): last_id}, block=block)
+        updates = []
+        for (_, entries) in streams or []:
+            for (entry_id, fields) in entries:
+                try:
+                    update = json.loads(fields["progress"])
+                except (KeyError, json.JSONDecodeError, TypeError):
+                    logger.warning("Invalid progress update %s for job %s", entry_id, job_id)
+                    continue
+                update["id"] = entry_id
+                updates.append(update)
+        return updates
+
     @classmethod
     def send_service_request_and_return_job(cls, service_name: str, data, job_id=None, encoder=None) -> ServiceJob:
         """
@@ -308,6 +357,7 @@ class ServiceManager(object):
         return job
 
     @classmethod
+    @PERFORMANCE_HISTORY.timed("redis", "get_running_jobs")
     def get_running_jobs(cls, service_name: str) -> typing.List[str]:
         """Returns running jobs.
         :param service_name: str: service name
@@ -1,4 +1,4 @@
 # (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
 
 from ..data import service
-from .bp import update_iaa_report_by_collection_id
+from .bp import schedule_iaa_report_update, update_iaa_report_by_collection_id
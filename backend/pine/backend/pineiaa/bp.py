@@ -1,8 +1,11 @@
 # (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
 
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import os
+import threading
 
-from flask import abort, Blueprint, jsonify
+from flask import abort, Blueprint, current_app, jsonify
 
 from .. import auth
 from ..data import service
@@ -44,7 +47,83 @@ def update_iaa_report_by_collection_id(collection_id: str) -> bool:
         else:
             return service.post("iaa_reports", json = new_report).ok
     else:
-        return jsonify(False)
+        return False
+
+class IaaReportUpdater(object):
+    """Updates IAA reports in the background so that saving annotations doesn't wait for them.
+
+    A report is only computed IAA_UPDATE_DELAY seconds after it's requested, and any further requests
+    for the same collection in the meantime are coalesced into that one update.  A request made
+    while an update is already running causes exactly one more update afterwards, so the final
+    report always reflects the latest annotations.  This coalescing is per backend process.
+    """
+
+    SCHEDULED = "scheduled"
+    RUNNING = "running"
+    RERUN = "rerun"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.states = {}
+        self.executor = None
+        self.executor_pid = None
+
+    def _get_executor(self, app) -> ThreadPoolExecutor:
+        if self.executor is None or self.executor_pid != os.getpid():
+            self.executor = ThreadPoolExecutor(max_workers=app.config["IAA_UPDATE_WORKERS"],
+                                               thread_name_prefix="iaa-update")
+            self.executor_pid = os.getpid()
+        return self.executor
+
+    def schedule(self, collection_id: str):
+        app = current_app._get_current_object()
+        with self.lock:
+            state = self.states.get(collection_id)
+            if state == self.RUNNING:
+                self.states[collection_id] = self.RERUN
+            if state is not None:
+                return
+            self.states[collection_id] = self.SCHEDULED
+        self._start_timer(app, collection_id)
+
+    def _start_timer(self, app, collection_id: str):
+        timer = threading.Timer(app.config["IAA_UPDATE_DELAY"], self._submit, (app, collection_id))
+        timer.daemon = True
+        timer.start()
+
+    def _submit(self, app, collection_id: str):
+        with self.lock:
+            executor = self._get_executor(app)
+        executor.submit(self._run, app, collection_id)
+
+    def _run(self, app, collection_id: str):
+        with self.lock:
+            self.states[collection_id] = self.RUNNING
+        try:
+            with app.app_context():
+                if not update_iaa_report_by_collection_id(collection_id):
+                    logger.error("Unable to update IAA report for collection {}".format(collection_id))
+        except Exception:
+            logger.exception("Unable to update IAA report for collection {}".format(collection_id))
+        finally:
+            with self.lock:
+                rerun = self.states[collection_id] == self.RERUN
+                if rerun:
+                    self.states[collection_id] = self.SCHEDULED
+                else:
+                    del self.states[collection_id]
+            if rerun:
+                self._start_timer(app, collection_id)
+
+IAA_REPORT_UPDATER = IaaReportUpdater()
+
+def schedule_iaa_report_update(collection_id: str):
+    """Updates the IAA report for the given collection in the background.
+
+    :param collection_id: str: the collection ID
+    """
+    logger.info("Scheduling IAA report update for collection " + collection_id)
+    IAA_REPORT_UPDATER.schedule(collection_id)
 
 @bp.route("/by_collection_id/<collection_id>", methods=["POST"])
 @auth.login_required
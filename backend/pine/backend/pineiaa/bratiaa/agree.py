@@ -10,10 +10,12 @@ from functools import partial
 from scipy.special import comb
 from tabulate import tabulate
 
+from ..bratiaa.counts import DenseCounts, SparseCounts
 from ..bratiaa.evaluation import *
-from ..bratiaa.utils import TokenOverlap
+from ..bratiaa.utils import token_overlap
 
 from collections import namedtuple, Counter
+from collections.abc import Mapping
 
 Annotation = namedtuple('Annotation', ['type', 'label', 'offsets'])
 AnnFile = namedtuple('AnnFile', ['annotator_id', 'annotations'])
@@ -58,26 +60,95 @@ def compute_f1(tp, fp, fn):
     return (2 * tp) / (2 * tp + fp + fn)
 
 
+def _count_labels(pair, annotations_by_kind, label2idx):
+    """
+    Returns (pair, label, tp, fp, fn) rows counting the given true positive, false positive and
+    false negative annotations by label.  Each kind is either the annotations themselves or their
+    number by label.
+    """
+    label_counts = {}
+    for kind, annotations in enumerate(annotations_by_kind):
+        if not isinstance(annotations, Mapping):
+            annotations = Counter(a.label for a in annotations)
+        for label, count in annotations.items():
+            try:
+                label_idx = label2idx[label]
+            except KeyError:
+                logging.error(
+                    f'Encountered unknown label "{label}"! Please make sure that your "annotation.conf" '
+                    f'(https://brat.nlplab.org/configuration.html#annotation-configuration) '
+                    f'is located under the project root and contains an exhaustive list of entities!'
+                )
+                raise
+            label_counts.setdefault(label_idx, [0, 0, 0])[kind] += count
+    return [(pair, label_idx) + tuple(counts) for label_idx, counts in label_counts.items()]
+
+
+def _evaluate_document(document, pair2idx, label2idx, eval_func, token_func, annotator=None):
+    """
+    Returns the (pair, label, tp, fp, fn) rows of one document.  If annotator is given, only pairs
+    involving that annotator are evaluated.
+    """
+    to = None
+    if token_func:
+        to = token_overlap(document.txt, token_func)
+    doc_counts = []
+    for anno_file_1, anno_file_2 in combinations(document.ann_files, 2):
+        if annotator is not None and annotator not in (anno_file_1.annotator_id, anno_file_2.annotator_id):
+            continue
+        tp, fp, fn = eval_func(anno_file_1.annotations, anno_file_2.annotations, tokens=to)
+        pair_idx = pair2idx[(anno_file_1.annotator_id, anno_file_2.annotator_id)]
+        doc_counts += _count_labels(pair_idx, (tp, fp, fn), label2idx)
+    return doc_counts
+
+
+def _evaluate_documents(documents, pair2idx, label2idx, eval_func, token_func, annotator=None):
+    """
+    Evaluates a shard of documents, e.g. in another process.
+    """
+    return [_evaluate_document(document, pair2idx, label2idx, eval_func, token_func, annotator)
+            for document in documents]
+
+
 class F1Agreement:
-    def __init__(self, annotators, documents, labels, eval_func=exact_match_instance_evaluation, token_func=None):
+    # number of documents evaluated at a time when an executor is used
+    SHARD_SIZE = 50
+
+    def __init__(self, annotators, documents, labels, eval_func=exact_match_instance_evaluation, token_func=None,
+                 sparse=False, executor=None):
         assert len(annotators) > 1, 'At least two annotators are necessary to compute agreement!'
         num_pairs = comb(len(annotators), 2, exact=True)
-        # (p, d, c, l) where p := annotator pairs, d := documents, c := counts (tp, fp, fn), l := labels
-        self._pdcl = np.zeros((num_pairs, len(documents), 3, len(labels)))
+        # counts by annotator pair, document, kind (tp, fp, fn) and label; sparse storage only keeps the
+        # pairs and labels that have counts in each document
+        counts_class = SparseCounts if sparse else DenseCounts
+        self._counts = counts_class(num_pairs, len(documents), len(labels))
         self._documents = list(documents)
-        self._doc2idx = {d: i for i, d in enumerate(documents)}
+        self._doc2idx = {d.doc_id: i for i, d in enumerate(documents)}
         self._labels = list(labels)
         self._label2idx = {l: i for i, l in enumerate(labels)}
         self._annotators = list(annotators)
-        self._pairs = [pair for pair in combinations(annotators, 2)]
-        self._pair2idx = {p: i for i, p in enumerate(self._pairs)}
-        # add pairs in reverse order (same index)
-        for (a1, a2), value in self._pair2idx.copy().items():
-            self._pair2idx[(a2, a1)] = value
+        self._set_pairs()
         self._eval_func = eval_func  # function used to extract true positives, false positives and false negatives
         self._token_func = token_func  # function used for tokenization
+        # optional concurrent.futures executor (e.g. a ProcessPoolExecutor) that documents are evaluated on in
+        # shards of SHARD_SIZE; the functions above must then be picklable
+        self._executor = executor
         self._compute_tp_fp_fn(documents)
 
+    @classmethod
+    def from_document_counts(cls, annotators, documents, labels, document_counts,
+                             eval_func=exact_match_instance_evaluation, token_func=None, sparse=False, executor=None):
+        """
+        Restores an agreement from per-document counts as returned by get_document_counts, without
+        evaluating any annotations.  document_counts maps document IDs to their counts.
+        """
+        f1_agreement = cls(annotators, [], labels, eval_func=eval_func, token_func=token_func, sparse=sparse,
+                           executor=executor)
+        f1_agreement._add_documents(documents)
+        for doc_id, counts in document_counts.items():
+            f1_agreement.set_document_counts(doc_id, counts)
+        return f1_agreement
+
     @property
     def annotators(self):
         return list(self._annotators)
@@ -90,39 +161,133 @@ class F1Agreement:
     def labels(self):
         return list(self._labels)
 
-    def _compute_tp_fp_fn(self, documents):
-        for doc_index, document in enumerate(documents):
-            assert doc_index < len(self._documents), 'Input generator yields more documents than expected!'
-            to = None
-            if self._token_func:
-                text = document.txt
-                tokens = list(self._token_func(text))
-                to = TokenOverlap(text, tokens)
-            for anno_file_1, anno_file_2 in combinations(document.ann_files, 2):
-                tp, fp, fn = self._eval_func(anno_file_1.annotations, anno_file_2.annotations, tokens=to)
-                pair_idx = self._pair2idx[(anno_file_1.annotator_id, anno_file_2.annotator_id)]
-                doc_idx = self._doc2idx[document]
-                self._increment_counts(tp, pair_idx, doc_idx, 0)
-                self._increment_counts(fp, pair_idx, doc_idx, 1)
-                self._increment_counts(fn, pair_idx, doc_idx, 2)
-
-    def _increment_counts(self, annotations, pair, doc, kind):
-        for a in annotations:
-            try:
-                self._pdcl[pair][doc][kind][self._label2idx[a.label]] += 1
-            except KeyError:
-                logging.error(
-                    f'Encountered unknown label "{a.label}"! Please make sure that your "annotation.conf" '
-                    f'(https://brat.nlplab.org/configuration.html#annotation-configuration) '
-                    f'is located under the project root and contains an exhaustive list of entities!'
-                )
-                raise
+    @property
+    def nbytes(self):
+        """
+        Memory used by the counts.
+        """
+        return self._counts.nbytes
+
+    def _set_pairs(self):
+        self._pairs = [pair for pair in combinations(self._annotators, 2)]
+        self._pair2idx = {p: i for i, p in enumerate(self._pairs)}
+        # add pairs in reverse order (same index)
+        for (a1, a2), value in self._pair2idx.copy().items():
+            self._pair2idx[(a2, a1)] = value
+
+    def _compute_tp_fp_fn(self, documents, annotator=None):
+        documents = list(documents)
+        for document in documents:
+            assert document.doc_id in self._doc2idx, 'Input generator yields more documents than expected!'
+        args = (self._pair2idx, self._label2idx, self._eval_func, self._token_func, annotator)
+        if self._executor is None or len(documents) <= self.SHARD_SIZE:
+            doc_counts = (_evaluate_document(document, *args) for document in documents)
+        else:
+            # every document is evaluated on its own, so adding up the shards' counts in document order
+            # gives exactly the same counts as evaluating them here
+            futures = [self._executor.submit(_evaluate_documents, documents[i:i + self.SHARD_SIZE], *args)
+                       for i in range(0, len(documents), self.SHARD_SIZE)]
+            doc_counts = (counts for future in futures for counts in future.result())
+        for document, counts in zip(documents, doc_counts):
+            self._counts.add(self._doc2idx[document.doc_id], counts)
+
+    def _add_annotators(self, annotators):
+        """
+        Adds unknown annotators, keeping all annotators sorted.  The counts of existing pairs are kept.
+        """
+        new_annotators = set(annotators) - set(self._annotators)
+        if not new_annotators:
+            return
+        old_pairs = self._pairs
+        self._annotators = sorted(set(self._annotators) | new_annotators)
+        self._set_pairs()
+        self._counts.reindex(len(self._pairs), [self._pair2idx[pair] for pair in old_pairs],
+                             len(self._labels), list(range(len(self._labels))))
+
+    def _add_labels(self, labels):
+        """
+        Adds unknown labels, keeping all labels sorted.  The counts of existing labels are kept.
+        """
+        new_labels = set(labels) - set(self._labels)
+        if not new_labels:
+            return
+        old_labels = self._labels
+        self._labels = sorted(set(self._labels) | new_labels)
+        self._label2idx = {l: i for i, l in enumerate(self._labels)}
+        self._counts.reindex(len(self._pairs), list(range(len(self._pairs))),
+                             len(self._labels), [self._label2idx[l] for l in old_labels])
+
+    def _add_documents(self, documents):
+        documents = [d for d in documents if d.doc_id not in self._doc2idx]
+        if not documents:
+            return
+        for document in documents:
+            self._doc2idx[document.doc_id] = len(self._documents)
+            self._documents.append(document)
+        self._counts.add_documents(len(documents))
+
+    def update_documents(self, documents, annotator=None):
+        """
+        Recomputes the counts of the given (new or changed) documents only, leaving all other documents
+        untouched.  If annotator is given, only that annotator's pairs are recomputed, which is all
+        that is needed after a single annotator saved their annotations.  New annotators and labels
+        are added as needed.
+        """
+        documents = list(documents)
+        self._add_annotators([f.annotator_id for d in documents for f in d.ann_files])
+        self._add_labels([a.label for d in documents for f in d.ann_files for a in f.annotations])
+        self._add_documents(documents)
+        for document in documents:
+            doc_idx = self._doc2idx[document.doc_id]
+            self._documents[doc_idx] = document
+            if annotator is None:
+                self._counts.clear(doc_idx)
+            else:
+                self._counts.clear(doc_idx, pairs=self._pairs_involving(annotator))
+        self._compute_tp_fp_fn(documents, annotator=annotator)
+
+    def remove_documents(self, doc_ids):
+        """
+        Removes the given documents and their counts.
+        """
+        indices = [self._doc2idx[doc_id] for doc_id in doc_ids if doc_id in self._doc2idx]
+        if not indices:
+            return
+        self._counts.remove_documents(indices)
+        removed = set(indices)
+        self._documents = [d for i, d in enumerate(self._documents) if i not in removed]
+        self._doc2idx = {d.doc_id: i for i, d in enumerate(self._documents)}
+
+    def get_document_counts(self, doc_id):
+        """
+        Returns the counts of one document as a list of [annotator_1, annotator_2, {label: [tp, fp, fn]}],
+        leaving out zero counts, so that they can be stored (e.g. as JSON) and restored later with
+        set_document_counts or from_document_counts.
+        """
+        counts = {}
+        for pair, label, tp, fp, fn in self._counts.get(self._doc2idx[doc_id]):
+            counts.setdefault(pair, {})[self._labels[label]] = [tp, fp, fn]
+        return [[a1, a2, counts[pair_idx]] for pair_idx, (a1, a2) in enumerate(self._pairs) if pair_idx in counts]
+
+    def set_document_counts(self, doc_id, counts):
+        """
+        Replaces the counts of one document with counts as returned by get_document_counts.
+        """
+        self._add_annotators([a for a1, a2, _ in counts for a in (a1, a2)])
+        self._add_labels([l for _, _, label_counts in counts for l in label_counts])
+        if doc_id not in self._doc2idx:
+            self._add_documents([Document(None, doc_id)])
+        doc_idx = self._doc2idx[doc_id]
+        self._counts.clear(doc_idx)
+        self._counts.add(doc_idx, [(self._pair2idx[(a1, a2)], self._label2idx[label]) + tuple(label_count)
+                                   for a1, a2, label_counts in counts
+                                   for label, label_count in label_counts.items()])
 
     def mean_sd_per_label(self):
         """
         Mean and standard deviation of all annotator combinations' F1 scores by label.
         """
-        pcl = np.sum(self._pdcl, axis=1)  # sum over documents
+        pcl = self._counts.sum_over_documents()
         f1_pairs = compute_f1(pcl[:, 0], pcl[:, 1], pcl[:, 2])
         avg, stddev = self._mean_sd(f1_pairs)
         return avg, stddev
@@ -131,16 +296,29 @@ class F1Agreement:
         """
         Mean and standard deviation of all annotator combinations' F1 scores per document.
         """
-        pdc = np.sum(self._pdcl, axis=3)  # sum over labels
-        f1_pairs = compute_f1(pdc[:, :, 0], pdc[:, :, 1], pdc[:, :, 2])
-        avg, stddev = self._mean_sd(f1_pairs)
+        pairs, docs, pdc = self._counts.sum_over_labels()
+        f1 = compute_f1(pdc[:, 0], pdc[:, 1], pdc[:, 2])
+        # a pair without counts for a document has an undefined F1 score, which makes the document's mean
+        # and standard deviation undefined too, so only documents that every pair has counts for are left
+        num_docs = len(self._documents)
+        complete_docs = np.flatnonzero(np.bincount(docs, minlength=num_docs) == len(self._pairs))
+        avg, stddev = np.full(num_docs, np.nan), np.full(num_docs, np.nan)
+        if len(complete_docs):
+            complete = np.isin(docs, complete_docs)
+            # numpy sums a single column pairwise but several columns row by row, so keep at least as many
+            # columns as there are documents for the results to be exactly those of all documents at once
+            num_columns = max(len(complete_docs), min(num_docs, 2))
+            f1_pairs = np.zeros((len(self._pairs), num_columns))
+            f1_pairs[pairs[complete], np.searchsorted(complete_docs, docs[complete])] = f1[complete]
+            f1_avg, f1_stddev = self._mean_sd(f1_pairs)
+            avg[complete_docs], stddev[complete_docs] = f1_avg[:len(complete_docs)], f1_stddev[:len(complete_docs)]
         return avg, stddev
 
     def mean_sd_total(self):
         """
         Mean and standard deviation of all annotator cominations' F1 scores.
         """
-        pc = np.sum(self._pdcl, axis=(1, 3))  # sum over documents and labels
+        pc = np.sum(self._counts.sum_over_documents(), axis=2)  # sum over labels
         f1_pairs = compute_f1(pc[:, 0], pc[:, 1], pc[:, 2])
         avg, stddev = self._mean_sd(f1_pairs)
         return avg, stddev
@@ -149,7 +327,7 @@ class F1Agreement:
         """
         Mean and standard deviation of all annotator combinations' F1 scores involving given annotator per label.
         """
-        pcl = np.sum(self._pdcl, axis=1)  # sum over documents
+        pcl = self._counts.sum_over_documents()
         pcl = pcl[self._pairs_involving(annotator)]
         f1_pairs = compute_f1(pcl[:, 0], pcl[:, 1], pcl[:, 2])
         avg, stddev = self._mean_sd(f1_pairs)
@@ -159,7 +337,7 @@ class F1Agreement:
         """
         Mean and standard deviation of all annotator combinations' F1 scores involving given annotator.
         """
-        pc = np.sum(self._pdcl, axis=(1, 3))  # sum over documents and labels
+        pc = np.sum(self._counts.sum_over_documents(), axis=2)  # sum over labels
         pc = pc[self._pairs_involving(annotator)]
         f1_pairs = compute_f1(pc[:, 0], pc[:, 1], pc[:, 2])
         if len(f1_pairs) > 1:
@@ -194,7 +372,7 @@ class F1Agreement:
 
         By definition, the matrix is symmetric and F1 = 1 on the main diagonal.
         """
-        pc = np.sum(self._pdcl, axis=(1, 3))  # sum over documents and labels
+        pc = np.sum(self._counts.sum_over_documents(), axis=2)  # sum over labels
         f1_pairs = compute_f1(pc[:, 0], pc[:, 1], pc[:, 2])
         num_annotators = len(self._annotators)
         f1_matrix = np.zeros((num_annotators, num_annotators))
@@ -238,7 +416,7 @@ class F1Agreement:
         plt.savefig(out_path)
 
 
-def compute_f1_agreement(annotators, documents, labels, token_func=None, eval_func=None):
+def compute_f1_agreement(annotators, documents, labels, token_func=None, eval_func=None, sparse=False, executor=None):
     if not eval_func:
         eval_func = exact_match_instance_evaluation
         if token_func:
@@ -247,7 +425,8 @@ def compute_f1_agreement(annotators, documents, labels, token_func=None, eval_fu
     #input_gen = partial(input_gen, project_root)
     #annotators, documents = _collect_annotators_and_documents(input_gen)
 
-    return F1Agreement(annotators, documents, sorted(labels), eval_func=eval_func, token_func=token_func)
+    return F1Agreement(annotators, documents, sorted(labels), eval_func=eval_func, token_func=token_func,
+                       sparse=sparse, executor=executor)
 
 
 def iaa_report(f1_agreement, precision=3):
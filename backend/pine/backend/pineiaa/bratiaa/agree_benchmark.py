@@ -0,0 +1,95 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+"""
+Compares the memory and time used by dense and sparse F1Agreement counts on synthetic data, e.g.:
+
+    python -m pine.backend.pineiaa.bratiaa.agree_benchmark --annotators 50 --documents 100000
+"""
+
+import argparse
+import logging
+import random
+import time
+import tracemalloc
+from itertools import combinations
+
+from scipy.special import comb
+from tabulate import tabulate
+
+from ..bratiaa.agree import Document, F1Agreement
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--annotators', type=int, default=50,
+                        help='Number of annotators in the collection')
+    parser.add_argument('--documents', type=int, default=100000,
+                        help='Number of documents in the collection')
+    parser.add_argument('--labels', type=int, default=20,
+                        help='Number of labels in the collection')
+    parser.add_argument('--annotators-per-document', type=int, default=3, dest='annotators_per_document',
+                        help='Number of annotators that annotate each document')
+    parser.add_argument('--labels-per-document', type=int, default=3, dest='labels_per_document',
+                        help='Number of labels that each annotator pair has counts for in each document')
+    parser.add_argument('--max-dense-gb', type=float, default=2, dest='max_dense_gb',
+                        help='Skip dense counts if they would need more memory than this')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def generate_document_counts(annotators, documents, labels, annotators_per_document, labels_per_document, seed):
+    rand = random.Random(seed)
+    document_counts = {}
+    for document in documents:
+        doc_annotators = sorted(rand.sample(annotators, annotators_per_document))
+        document_counts[document.doc_id] = [
+            [a1, a2, {label: [rand.randint(0, 20), rand.randint(0, 5), rand.randint(0, 5)]
+                      for label in rand.sample(labels, labels_per_document)}]
+            for a1, a2 in combinations(doc_annotators, 2)
+        ]
+    return document_counts
+
+
+def run(annotators, documents, labels, document_counts, sparse):
+    tracemalloc.start()
+    start = time.perf_counter()
+    f1_agreement = F1Agreement.from_document_counts(annotators, documents, labels, document_counts, sparse=sparse)
+    load_time = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    times = []
+    for method in (f1_agreement.mean_sd_per_label, f1_agreement.mean_sd_per_document,
+                   f1_agreement.mean_sd_total, f1_agreement.compute_total_f1_matrix):
+        start = time.perf_counter()
+        method()
+        times.append(time.perf_counter() - start)
+    return [f1_agreement.nbytes / 2 ** 20, peak / 2 ** 20, load_time] + times
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    annotators = [f'annotator{i:03}' for i in range(args.annotators)]
+    labels = [f'label{i:03}' for i in range(args.labels)]
+    documents = [Document(None, f'document{i:07}') for i in range(args.documents)]
+    document_counts = generate_document_counts(annotators, documents, labels, args.annotators_per_document,
+                                               args.labels_per_document, args.seed)
+
+    headers = ['Storage', 'Counts MiB', 'Peak MiB', 'Load s', 'Per label s', 'Per document s', 'Total s',
+               'F1 matrix s']
+    rows = [['sparse'] + run(annotators, documents, labels, document_counts, sparse=True)]
+    dense_bytes = comb(len(annotators), 2, exact=True) * len(documents) * 3 * len(labels) * 8
+    if dense_bytes <= args.max_dense_gb * 2 ** 30:
+        rows.append(['dense'] + run(annotators, documents, labels, document_counts, sparse=False))
+    else:
+        rows.append(['dense', dense_bytes / 2 ** 20] + [None] * (len(headers) - 2))
+
+    print(f'{args.annotators} annotators, {args.documents} documents, {args.labels} labels, '
+          f'{args.annotators_per_document} annotators per document\n')
+    print(tabulate(rows, headers=headers, tablefmt='github', floatfmt='.3f', missingval='skipped'))
+
+
+if __name__ == '__main__':
+    main()
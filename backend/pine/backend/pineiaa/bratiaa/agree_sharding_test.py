@@ -0,0 +1,113 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+"""
+Checks that evaluating documents in shards on a process pool gives exactly the same agreement as
+evaluating them in-process.  Runs with pytest, or on its own in the backend image, e.g.:
+
+    python -m pine.backend.pineiaa.bratiaa.agree_sharding_test
+"""
+
+import multiprocessing
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from ..bratiaa.agree import AnnFile, Annotation, Document, F1Agreement
+from ..bratiaa.evaluation import exact_match_instance_evaluation, exact_match_token_evaluation
+from ..bratiaa.utils import tokenize
+
+ANNOTATORS = ['ada', 'bob', 'cy', 'dee']
+LABELS = ['PER', 'ORG', 'LOC', 'MISC']
+# more than a few shards, and a last shard that isn't full
+NUM_DOCUMENTS = 3 * F1Agreement.SHARD_SIZE + 7
+
+
+def generate_documents(seed, num_documents=NUM_DOCUMENTS):
+    """
+    Documents annotated by two to four annotators, who mostly agree with the first one's annotations
+    but drop, add, relabel and shift some of them.
+    """
+    rand = random.Random(seed)
+    documents = []
+    for i in range(num_documents):
+        words = [rand.choice(['alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta']) for _ in range(rand.randint(5, 40))]
+        text = ' '.join(words)
+        starts = [0]
+        for word in words[:-1]:
+            starts.append(starts[-1] + len(word) + 1)
+        spans = [(starts[w], starts[w] + len(words[w])) for w in sorted(rand.sample(range(len(words)), len(words) // 3))]
+        reference = [Annotation('T', rand.choice(LABELS), ((start, end),)) for (start, end) in spans]
+        document = Document(text, f'document{i:04}')
+        for annotator in sorted(rand.sample(ANNOTATORS, rand.randint(2, len(ANNOTATORS)))):
+            annotations = []
+            for annotation in reference:
+                ((start, end),) = annotation.offsets
+                choice = rand.random()
+                if choice < 0.1:
+                    continue
+                elif choice < 0.2:
+                    annotation = Annotation('T', rand.choice(LABELS), ((start, end),))
+                elif choice < 0.3:
+                    annotation = Annotation('T', annotation.label, ((start + 1, end),))
+                annotations.append(annotation)
+            if rand.random() < 0.3:
+                start = rand.choice(starts)
+                annotations.append(Annotation('T', rand.choice(LABELS), ((start, min(start + 8, len(text))),)))
+            document.ann_files.append(AnnFile(annotator, annotations))
+        documents.append(document)
+    return documents
+
+
+def relabel_annotator(document, annotator):
+    """
+    Returns a copy of the document in which the annotator dropped every other annotation and changed
+    the labels of the rest.
+    """
+    changed = Document(document.txt, document.doc_id)
+    for ann_file in document.ann_files:
+        if ann_file.annotator_id == annotator:
+            ann_file = AnnFile(annotator, [Annotation('T', LABELS[(LABELS.index(a.label) + 1) % len(LABELS)], a.offsets)
+                                           for a in ann_file.annotations[::2]])
+        changed.ann_files.append(ann_file)
+    return changed
+
+
+def assert_same_agreement(expected, actual):
+    for method in ('mean_sd_per_label', 'mean_sd_per_document', 'mean_sd_total'):
+        for expected_values, actual_values in zip(getattr(expected, method)(), getattr(actual, method)()):
+            np.testing.assert_array_equal(actual_values, expected_values, err_msg=method)
+    np.testing.assert_array_equal(actual.compute_total_f1_matrix(), expected.compute_total_f1_matrix())
+
+
+def check_sharding(executor, sparse, token_evaluation):
+    kwargs = dict(sparse=sparse)
+    if token_evaluation:
+        kwargs.update(eval_func=exact_match_token_evaluation, token_func=tokenize)
+    else:
+        kwargs.update(eval_func=exact_match_instance_evaluation)
+    documents = generate_documents(seed=0)
+
+    serial = F1Agreement(ANNOTATORS, documents, LABELS, **kwargs)
+    sharded = F1Agreement(ANNOTATORS, documents, LABELS, executor=executor, **kwargs)
+    assert_same_agreement(serial, sharded)
+
+    # and after one annotator changed the annotations of more than a shard's worth of documents
+    changed = [relabel_annotator(document, 'ada') for document in documents
+               if 'ada' in [ann_file.annotator_id for ann_file in document.ann_files]][:F1Agreement.SHARD_SIZE + 1]
+    serial.update_documents(changed, annotator='ada')
+    sharded.update_documents(changed, annotator='ada')
+    assert_same_agreement(serial, sharded)
+
+
+def test_sharded_agreement_is_identical():
+    # spawned like the backend's IAA process pool
+    with ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context('spawn')) as executor:
+        for sparse in (False, True):
+            for token_evaluation in (False, True):
+                check_sharding(executor, sparse, token_evaluation)
+
+
+if __name__ == '__main__':
+    test_sharded_agreement_is_identical()
+    print('Sharded and in-process agreement are identical')
@@ -0,0 +1,181 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+"""
+Backing stores for the true positive, false positive and false negative counts of F1Agreement.
+
+Counts are kept per annotator pair, document and label.  DenseCounts holds every combination in a
+single array, which is simple and fast for small projects but grows with
+annotators² × documents × labels.  SparseCounts only stores the pairs and labels that actually
+have counts in each document, which is what matters for large collections where most annotator
+pairs never annotate the same documents.
+
+Both stores take and return counts as (pair, label, tp, fp, fn) rows of indices and integers.
+"""
+
+import numpy as np
+
+
+class DenseCounts:
+    """
+    Counts in a (p, d, c, l) array where p := annotator pairs, d := documents, c := counts (tp, fp, fn),
+    l := labels.
+    """
+
+    def __init__(self, num_pairs, num_documents, num_labels):
+        self._pdcl = np.zeros((num_pairs, num_documents, 3, num_labels))
+
+    @property
+    def nbytes(self):
+        return self._pdcl.nbytes
+
+    def add(self, doc, counts):
+        for pair, label, tp, fp, fn in counts:
+            self._pdcl[pair, doc, :, label] += (tp, fp, fn)
+
+    def clear(self, doc, pairs=None):
+        if pairs is None:
+            self._pdcl[:, doc] = 0
+        else:
+            self._pdcl[pairs, doc] = 0
+
+    def get(self, doc):
+        pcl = self._pdcl[:, doc]
+        pairs, labels = np.nonzero(pcl.any(axis=1))
+        return [(int(p), int(l)) + tuple(int(c) for c in pcl[p, :, l]) for p, l in zip(pairs, labels)]
+
+    def add_documents(self, num_documents):
+        shape = list(self._pdcl.shape)
+        shape[1] = num_documents
+        self._pdcl = np.concatenate((self._pdcl, np.zeros(shape)), axis=1)
+
+    def remove_documents(self, docs):
+        self._pdcl = np.delete(self._pdcl, docs, axis=1)
+
+    def reindex(self, num_pairs, pair_indices, num_labels, label_indices):
+        """
+        Resizes to num_pairs pairs and num_labels labels, moving the existing pairs and labels to the
+        given new indices.
+        """
+        num_documents = self._pdcl.shape[1]
+        pdcl = np.zeros((num_pairs, num_documents, 3, num_labels))
+        pdcl[np.ix_(pair_indices, range(num_documents), range(3), label_indices)] = self._pdcl
+        self._pdcl = pdcl
+
+    def sum_over_documents(self):
+        """
+        Returns the (p, c, l) array of counts summed over documents.
+        """
+        return np.sum(self._pdcl, axis=1)
+
+    def sum_over_labels(self):
+        """
+        Returns the pair indices, document indices and (n, c) counts summed over labels of every pair
+        and document with a non-zero count.
+        """
+        pdc = np.sum(self._pdcl, axis=3)
+        pairs, docs = np.nonzero(pdc.any(axis=2))
+        return pairs, docs, pdc[pairs, docs]
+
+
+class SparseCounts:
+    """
+    Counts stored per document as an (n, 5) array of [pair, label, tp, fp, fn] rows, one for each pair
+    and label with a non-zero count.
+    """
+
+    _EMPTY = np.zeros((0, 5), dtype=np.int64)
+
+    def __init__(self, num_pairs, num_documents, num_labels):
+        self._num_pairs = num_pairs
+        self._num_labels = num_labels
+        self._docs = [self._EMPTY] * num_documents
+
+    @property
+    def nbytes(self):
+        return sum(block.nbytes for block in self._docs)
+
+    def _merge(self, block):
+        """
+        Sums up rows with the same pair and label.
+        """
+        keys, inverse = np.unique(block[:, 0] * self._num_labels + block[:, 1], return_inverse=True)
+        merged = np.zeros((len(keys), 5), dtype=np.int64)
+        merged[:, 0], merged[:, 1] = np.divmod(keys, self._num_labels)
+        np.add.at(merged[:, 2:], inverse, block[:, 2:])
+        return merged
+
+    def add(self, doc, counts):
+        block = np.array(counts, dtype=np.int64).reshape(-1, 5)
+        block = block[block[:, 2:].any(axis=1)]
+        if not len(block):
+            return
+        if len(self._docs[doc]):
+            block = np.concatenate((self._docs[doc], block))
+        keys = (block[:, 0] * self._num_labels + block[:, 1]).tolist()
+        if len(set(keys)) < len(keys):
+            block = self._merge(block)
+        self._docs[doc] = block
+
+    def clear(self, doc, pairs=None):
+        if pairs is None:
+            self._docs[doc] = self._EMPTY
+        else:
+            block = self._docs[doc]
+            self._docs[doc] = block[~np.isin(block[:, 0], pairs)]
+
+    def get(self, doc):
+        return [tuple(int(c) for c in row) for row in self._docs[doc]]
+
+    def add_documents(self, num_documents):
+        self._docs.extend([self._EMPTY] * num_documents)
+
+    def remove_documents(self, docs):
+        removed = set(docs)
+        self._docs = [block for i, block in enumerate(self._docs) if i not in removed]
+
+    def reindex(self, num_pairs, pair_indices, num_labels, label_indices):
+        """
+        Resizes to num_pairs pairs and num_labels labels, moving the existing pairs and labels to the
+        given new indices.
+        """
+        pair_indices = np.asarray(pair_indices, dtype=np.int64)
+        label_indices = np.asarray(label_indices, dtype=np.int64)
+        for i, block in enumerate(self._docs):
+            if len(block):
+                block = block.copy()
+                block[:, 0] = pair_indices[block[:, 0]]
+                block[:, 1] = label_indices[block[:, 1]]
+                self._docs[i] = block
+        self._num_pairs = num_pairs
+        self._num_labels = num_labels
+
+    def _rows(self):
+        """
+        Returns the document index of every row and all rows in a single array.
+        """
+        lengths = [len(block) for block in self._docs]
+        docs = np.repeat(np.arange(len(self._docs)), lengths)
+        rows = np.concatenate(self._docs) if self._docs else self._EMPTY
+        return docs, rows
+
+    def sum_over_documents(self):
+        """
+        Returns the (p, c, l) array of counts summed over documents.
+        """
+        _, rows = self._rows()
+        keys = rows[:, 0] * self._num_labels + rows[:, 1]
+        size = self._num_pairs * self._num_labels
+        pcl = np.stack([np.bincount(keys, weights=rows[:, 2 + c], minlength=size) for c in range(3)])
+        return pcl.reshape(3, self._num_pairs, self._num_labels).transpose(1, 0, 2)
+
+    def sum_over_labels(self):
+        """
+        Returns the pair indices, document indices and (n, c) counts summed over labels of every pair
+        and document with a non-zero count.
+        """
+        docs, rows = self._rows()
+        keys, inverse = np.unique(docs * self._num_pairs + rows[:, 0], return_inverse=True)
+        pdc = np.stack([np.bincount(inverse, weights=rows[:, 2 + c], minlength=len(keys)) for c in range(3)],
+                       axis=1)
+        docs, pairs = np.divmod(keys, self._num_pairs)
+        return pairs, docs, pdc
@@ -6,10 +6,14 @@ Functions for computing the difference between two sets of annotations.
 """
 from collections import namedtuple, Counter
 
+import numpy as np
+
 Annotation = namedtuple('Annotation', ['type', 'label', 'offsets'])
 
+_NO_TOKENS = np.zeros(0, dtype=int)
+
 
-def exact_match_instance_evaluation(ann_list_1, ann_list2, tokens=None):
+def exact_match_instance_evaluation(ann_list_1, ann_list_2, tokens=None):
     exp = set(ann_list_1)
     pred = set(ann_list_2)
     tp = exp.intersection(pred)
@@ -23,27 +27,25 @@ def exact_match_token_evaluation(ann_list_1, ann_list_2, tokens=None):
 
     Sub-token annotations are expanded to full tokens. Long annotations will influence the results more than short
     annotations. Boundary errors for adjacent annotations with the same label are ignored!
+
+    Returns the number of true positives, false positives and false negatives by label.
     """
-    exp = Counter(_read_token_annotations(ann_list_1, tokens))
-    pred = Counter(_read_token_annotations(ann_list_2, tokens))
-    tp = counter2list(exp & pred)
-    fp = counter2list(pred - exp)
-    fn = counter2list(exp - pred)
-    return tp, fp, fn
+    exp = tokens.token_labels(ann_list_1)
+    pred = tokens.token_labels(ann_list_2)
+    tp, fp, fn = Counter(), Counter(), Counter()
+    num_tokens = len(tokens.tokens)
+    for key in exp.keys() | pred.keys():
+        _, label = key
+        exp_counts = np.bincount(exp.get(key, _NO_TOKENS), minlength=num_tokens)
+        pred_counts = np.bincount(pred.get(key, _NO_TOKENS), minlength=num_tokens)
+        matched = np.minimum(exp_counts, pred_counts)
+        tp[label] += int(matched.sum())
+        fp[label] += int((pred_counts - matched).sum())
+        fn[label] += int((exp_counts - matched).sum())
+    return +tp, +fp, +fn
 
 
 def counter2list(c):
     for elem, cnt in c.items():
         for i in range(cnt):
             yield (elem)
-
-
-def _read_token_annotations(ann_list, tokens):
-    """
-    Yields a new annotation for each token overlapping with an annotation. If annotations are overlapping each other,
-    there will be multiple annotations for a single token.
-    """
-    for annotation in set(ann_list):
-        for start, end in annotation.offsets:
-            for ts, te in tokens.overlapping_tokens(start, end):
-                yield Annotation(annotation.type, annotation.label, ((ts, te),))
@@ -1,63 +1,70 @@
 # (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
 
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import json
+import logging
+import multiprocessing
+import os
+import threading
+
+import redis
 import requests
-from ..bratiaa import iaa_report, compute_f1_agreement, input_generator
+from flask import current_app
+from ..bratiaa import iaa_report, compute_f1_agreement, input_generator, F1Agreement, Document
 from ..bratiaa import tokenize
 from ..bratiaa import exact_match_token_evaluation
 from collections import defaultdict
 from .. import service
+from ...job_manager.service import ServiceManager, config
 import numpy as np
 
-EVE_HEADERS = {'Content-Type': 'application/json'}
-
-def get_items(resource):
-    response = service.get(resource, headers=EVE_HEADERS)
-    if response.status_code == 200:
-        r = response.json()
-        if '_items' in r:
-            if '_links' in r and 'next' in r['_links']:
-                return r['_items'], r['_links']['next']['href']
-            else:
-                return r['_items'], None
-    return [], None
-
-
-def get_all_items(query):
-    total_items = []
-    while True:
-        items, query = get_items(query)
-        total_items.extend(items)
-        if query is None:
-            break
-    return total_items
-
-
-
-def get_doc_annotations(collection_id, exclude=None):
-    #get documents
-    resource = 'documents?where={"collection_id":"%s"}' % (collection_id)
-    docs = get_all_items(resource)
-
-    #get annotations
-    resource = 'annotations?where={"collection_id":"%s"}' % (collection_id)
-    annotations = get_all_items(resource)
-
-    combined = {}
-    for d in docs:
-        combined[d['_id']]={"_id":d['_id'], "text":d['text'], "annotations":{}}
-        if "metadata" in d:
-            combined[d['_id']]['metadata'] = d['metadata']
-
+LOGGER = logging.getLogger(__name__)
+
+# only what agreement needs is fetched: the text of documents and the annotations themselves
+DOCUMENT_PROJECTION = {"text": 1}
+ANNOTATION_PROJECTION = {"creator_id": 1, "document_id": 1, "annotation": 1, "_etag": 1}
+
+def _get_annotations(collection_id, exclude=None):
+    annotations = service.get_all_items("annotations", params=service.params({
+        "where": {"collection_id": collection_id},
+        "projection": ANNOTATION_PROJECTION
+    }))
+    return [a for a in annotations if not (exclude and a['creator_id'] in exclude)]
+
+def _get_annotations_by_document_ids(doc_ids):
+    return service.get_all_items_by_ids("annotations", doc_ids, field="document_id", params=service.params({
+        "projection": ANNOTATION_PROJECTION
+    }))
+
+def _get_agreement_texts(annotations):
+    """Returns {document ID: text} for the documents that at least two annotators annotated.  Other
+    documents contribute nothing to agreement, so they aren't fetched at all.
+    """
+    annotators = defaultdict(set)
+    for a in annotations:
+        annotators[a['document_id']].add(a['creator_id'])
+    doc_ids = [doc_id for doc_id, creators in annotators.items() if len(creators) > 1]
+    docs = service.get_all_items_by_ids("documents", doc_ids, params=service.params({
+        "projection": DOCUMENT_PROJECTION
+    }))
+    return {d['_id']: d['text'] for d in docs}
+
+def _combine_doc_annotations(texts, annotations):
+    combined = {doc_id: {"_id": doc_id, "text": text, "annotations": {}} for doc_id, text in texts.items()}
     for a in annotations:
-        creator = a['creator_id']
-        if exclude and creator in exclude :
-            continue
         docid = a['document_id']
-        anns = a['annotation']
         if docid in combined:
-            combined[docid]["annotations"][creator]=anns
+            combined[docid]["annotations"][a['creator_id']] = a['annotation']
     return combined
 
+def get_doc_annotations(collection_id, exclude=None):
+    """Returns the text and annotations (by annotator) of each document in the collection that at
+    least two annotators, other than the excluded ones, annotated.
+    """
+    annotations = _get_annotations(collection_id, exclude=exclude)
+    return _combine_doc_annotations(_get_agreement_texts(annotations), annotations)
+
 def fix_num_for_json(number):
     if np.isnan(number):
         return None
@@ -65,39 +72,186 @@ def fix_num_for_json(number):
         return number
 
 
-def getIAAReportForCollection(collection_id):
+class DocumentCountsCache(object):
+    """Redis-backed cache of each document's agreement counts, so that an IAA report update only
+    has to evaluate the documents whose annotations changed since the last one.
 
-    combined = get_doc_annotations(collection_id)
+    Each collection is a redis hash from document ID to a JSON entry holding the ETags of the
+    document's annotations (by annotator), the number of annotations per label for each annotator,
+    and the F1Agreement counts as returned by F1Agreement.get_document_counts.
+    """
 
-    labels = set()
-    for v in combined.values():
-        for ann_list in v['annotations'].values():
-            for ann in ann_list:
-                if len(ann) == 3:
-                    labels.add(ann[2])
+    def __init__(self, r_conn, key_prefix: str):
+        self.r_conn = r_conn
+        self.key_prefix = key_prefix
 
+    def _key(self, collection_id: str) -> str:
+        return self.key_prefix + collection_id
 
-    anns = []
+    def load(self, collection_id: str) -> dict:
+        return {doc_id: json.loads(entry) for (doc_id, entry) in self.r_conn.hgetall(self._key(collection_id)).items()}
 
-    for k, c in combined.items():
-        anns.append(c)
+    def save(self, collection_id: str, entries: dict, removed_doc_ids: list):
+        with self.r_conn.pipeline() as pipe:
+            if removed_doc_ids:
+                pipe.hdel(self._key(collection_id), *removed_doc_ids)
+            if entries:
+                pipe.hset(self._key(collection_id),
+                          mapping={doc_id: json.dumps(entry) for (doc_id, entry) in entries.items()})
+            pipe.execute()
 
-    token_func = tokenize
-    eval_func = exact_match_token_evaluation
+    def clear(self, collection_id: str):
+        self.r_conn.delete(self._key(collection_id))
+
+DOCUMENT_COUNTS = DocumentCountsCache(ServiceManager.r_conn, config.REDIS_PREFIX + "iaa-counts:")
+
+_PROCESS_POOL = None
+_PROCESS_POOL_PID = None
+_PROCESS_POOL_LOCK = threading.Lock()
+
+def _get_process_pool():
+    """Returns the process pool that large numbers of documents are evaluated on, or None if
+    IAA_PROCESSES is 1.  Processes are spawned rather than forked since the backend is threaded.
+    """
+    global _PROCESS_POOL, _PROCESS_POOL_PID
+    processes = current_app.config["IAA_PROCESSES"]
+    if processes <= 1:
+        return None
+    with _PROCESS_POOL_LOCK:
+        if _PROCESS_POOL is None or _PROCESS_POOL_PID != os.getpid():
+            _PROCESS_POOL = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+            _PROCESS_POOL_PID = os.getpid()
+        return _PROCESS_POOL
+
+def _reset_process_pool():
+    global _PROCESS_POOL
+    with _PROCESS_POOL_LOCK:
+        _PROCESS_POOL = None
+
+def _get_annotation_etags(collection_id):
+    """Returns {document ID: {annotator: annotation ETag}} for the whole collection."""
+    annotations = service.get_all_items("annotations", params=service.params({
+        "where": {"collection_id": collection_id},
+        "projection": {"creator_id": 1, "document_id": 1, "_etag": 1}
+    }))
+    etags = defaultdict(dict)
+    for a in annotations:
+        etags[a['document_id']][a['creator_id']] = a['_etag']
+    return etags
+
+def _count_labels(ann_lists):
+    counts = defaultdict(int)
+    for a in ann_lists:
+        if len(a) == 3:
+            counts[a[2]] += 1
+    return dict(counts)
+
+def getIAAReportForCollection(collection_id):
+    # documents without annotations aren't part of the report, so listing the annotations is enough
+    etags = _get_annotation_etags(collection_id)
+    doc_ids = sorted(etags)
 
-    labels = list(labels)
+    try:
+        cached = DOCUMENT_COUNTS.load(collection_id)
+    except redis.exceptions.RedisError:
+        LOGGER.exception("Unable to load cached IAA counts for collection {}".format(collection_id))
+        cached = None
+
+    # only documents whose annotations changed since they were cached need to be evaluated
+    entries = {}
+    changed_ids = []
+    for doc_id in doc_ids:
+        if cached and doc_id in cached and cached[doc_id]['etags'] == etags[doc_id]:
+            entries[doc_id] = cached[doc_id]
+        else:
+            changed_ids.append(doc_id)
+    removed_ids = [doc_id for doc_id in cached if doc_id not in etags] if cached else []
+
+    if len(changed_ids) > len(doc_ids) / 2:
+        annotations = _get_annotations(collection_id)
+    else:
+        annotations = _get_annotations_by_document_ids(changed_ids)
+    changed_ids = set(changed_ids)
+    annotations = [a for a in annotations if a['document_id'] in changed_ids]
+    combined = _combine_doc_annotations(_get_agreement_texts(annotations), annotations)
+    changed_etags = defaultdict(dict)
+    label_counts = defaultdict(dict)
+    for a in annotations:
+        changed_etags[a['document_id']][a['creator_id']] = a['_etag']
+        label_counts[a['document_id']][a['creator_id']] = _count_labels(a['annotation'])
+    # a document that now has two annotators but couldn't be fetched (e.g. it was just deleted) is
+    # left out rather than cached without counts
+    changed_ids = [doc_id for doc_id in changed_etags if doc_id in combined or len(changed_etags[doc_id]) < 2]
+
+    # documents where only a single annotator's annotations changed just need that annotator's pairs
+    # recomputed, starting from the cached counts; all other changed documents are recomputed fully
+    changed_annotator = {}
+    for doc_id in combined:
+        if cached and doc_id in cached:
+            old, new = cached[doc_id]['etags'], changed_etags[doc_id]
+            annotators = {a for a in set(old) | set(new) if old.get(a) != new.get(a)}
+            if len(annotators) == 1:
+                changed_annotator[doc_id] = annotators.pop()
+
+    _, changed_documents = input_generator(list(combined.values()))
+
+    annotators = set()
+    labels = set()
+    for per_annotator in [e['annotators'] for e in entries.values()] + \
+                         [label_counts[doc_id] for doc_id in changed_ids]:
+        for per, counts in per_annotator.items():
+            annotators.add(per)
+            labels.update(counts)
+    # the cached counts can't be reused if they refer to an annotator or label that is now gone
+    for doc_id in list(changed_annotator):
+        old_annotators = cached[doc_id]['annotators']
+        if not annotators.issuperset(old_annotators) or \
+           not labels.issuperset(label for counts in old_annotators.values() for label in counts):
+            del changed_annotator[doc_id]
+    agreement_ids = [doc_id for doc_id in doc_ids
+                     if doc_id in combined or (doc_id in entries and len(entries[doc_id]['annotators']) > 1)]
 
-    annotators, documents = input_generator(anns)
+    token_func = tokenize
+    eval_func = exact_match_token_evaluation
 
     try:
-        f1_agreement = compute_f1_agreement(annotators, documents, labels, eval_func=eval_func, token_func=token_func)
+        document_counts = {doc_id: e['counts'] for doc_id, e in entries.items() if len(e['annotators']) > 1}
+        document_counts.update({doc_id: cached[doc_id]['counts'] for doc_id in changed_annotator})
+        executor = None
+        if len(changed_documents) >= current_app.config["IAA_PARALLEL_MIN_DOCUMENTS"]:
+            executor = _get_process_pool()
+        f1_agreement = F1Agreement.from_document_counts(sorted(annotators),
+                                                        [Document(None, doc_id) for doc_id in agreement_ids],
+                                                        sorted(labels), document_counts,
+                                                        eval_func=eval_func, token_func=token_func, sparse=True,
+                                                        executor=executor)
+        documents_by_annotator = defaultdict(list)
+        for document in changed_documents:
+            documents_by_annotator[changed_annotator.get(document.doc_id)].append(document)
+        try:
+            for annotator, documents in documents_by_annotator.items():
+                f1_agreement.update_documents(documents, annotator=annotator)
+        except BrokenProcessPool:
+            # e.g. a worker was killed; start a new pool next time
+            _reset_process_pool()
+            raise
+
+        new_entries = {doc_id: {"etags": changed_etags[doc_id], "annotators": label_counts[doc_id],
+                                "counts": f1_agreement.get_document_counts(doc_id) if doc_id in combined else []}
+                       for doc_id in changed_ids}
+        if cached is not None:
+            try:
+                DOCUMENT_COUNTS.save(collection_id, new_entries, removed_ids)
+            except redis.exceptions.RedisError:
+                LOGGER.exception("Unable to cache IAA counts for collection {}".format(collection_id))
+        entries.update(new_entries)
+
         # Get label counts by provider
         counts = defaultdict(lambda: defaultdict(int))
-        for document in anns:
-            for per, ann_list in document['annotations'].items():
-                for a in ann_list:
-                    if len(a) == 3:
-                        counts[per][a[2]] += 1
+        for e in entries.values():
+            for per, per_counts in e['annotators'].items():
+                for label, count in per_counts.items():
+                    counts[per][label] += count
 
         # for label in labels:
         #     print(label)
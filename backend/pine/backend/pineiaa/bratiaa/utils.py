@@ -2,6 +2,7 @@
 # Modifications (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
 
 import re
+from functools import lru_cache
 
 import numpy as np
 
@@ -9,6 +10,11 @@ ENCODING = 'utf-8'
 
 TOKEN = re.compile(r'\S+')
 
+# number of documents whose tokens are kept by token_overlap
+TOKEN_OVERLAP_CACHE_SIZE = 64
+# number of annotation lists whose tokens are kept by each TokenOverlap
+TOKEN_LABELS_CACHE_SIZE = 256
+
 
 def tokenize(text):
     for match in re.finditer(TOKEN, text):
@@ -28,18 +34,16 @@ class TokenOverlap:
 
     def __init__(self, text, tokens):
         self.tokens = tokens
+        self.token_ends = np.array([end for _, end in tokens], dtype=int)
         self.char2token = self.compute_mapping(len(text), tokens)
+        # token indices of annotation lists, which are evaluated once per annotator pair
+        self._token_labels = {}
 
     @staticmethod
     def compute_mapping(text_length, tokens):
-        char2token = np.zeros(text_length, dtype=int)
-        i = 0
-        for token_idx, (start, end) in enumerate(tokens):
-            char2token[i:start] = token_idx - 1
-            char2token[start:end] = token_idx
-            i = end
-        char2token[i:text_length] = len(tokens) - 1
-        return char2token
+        # each character maps to the last token starting at or before it (-1 before the first token)
+        starts = np.array([start for start, _ in tokens], dtype=int)
+        return np.searchsorted(starts, np.arange(text_length), side='right') - 1
 
     def overlapping_tokens(self, start, end):
         assert end <= len(self.char2token), f'End index {end} > text length {len(self.char2token)}!'
@@ -54,3 +58,53 @@ class TokenOverlap:
         if end_token < 0 or end_token < start_token:
             return []
         return self.tokens[start_token:end_token + 1]
+
+    def overlapping_token_indices(self, starts, ends):
+        """
+        Vectorized overlapping_tokens: returns the index of every token overlapping with each of the
+        given spans, as a single array with one entry per span and token.
+        """
+        starts = np.asarray(starts, dtype=int)
+        ends = np.asarray(ends, dtype=int)
+        if not len(ends) or not len(self.tokens):
+            return np.zeros(0, dtype=int)
+        assert ends.max() <= len(self.char2token), f'End index {ends.max()} > text length {len(self.char2token)}!'
+        valid = (ends >= 1) & (starts < ends)
+        start_tokens = np.maximum(self.char2token[np.clip(starts, 0, len(self.char2token) - 1)], 0)
+        start_tokens += self.token_ends[start_tokens] <= starts  # start offset between two tokens
+        end_tokens = self.char2token[np.clip(ends - 1, 0, len(self.char2token) - 1)]  # end offset is exclusive
+        lengths = np.where(valid, np.maximum(end_tokens - start_tokens + 1, 0), 0)
+        offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return np.repeat(start_tokens, lengths) + np.arange(lengths.sum()) - offsets
+
+    def token_labels(self, ann_list):
+        """
+        Returns {(type, label): token indices} for the given annotations, where a token index is repeated
+        once for every annotation of that type and label overlapping with it.  Identical annotations
+        are only counted once.  Results are cached, since every annotator is evaluated against all others.
+        """
+        annotations = frozenset(ann_list)
+        # token_overlap shares this between the threads updating IAA reports, so another thread can clear
+        # the cache at any time: only ever return what was looked up or computed here
+        token_labels = self._token_labels.get(annotations)
+        if token_labels is None:
+            spans = {}
+            for annotation in annotations:
+                for start, end in annotation.offsets:
+                    starts, ends = spans.setdefault((annotation.type, annotation.label), ([], []))
+                    starts.append(start)
+                    ends.append(end)
+            token_labels = {key: self.overlapping_token_indices(starts, ends) for key, (starts, ends) in spans.items()}
+            if len(self._token_labels) >= TOKEN_LABELS_CACHE_SIZE:
+                self._token_labels.clear()
+            self._token_labels[annotations] = token_labels
+        return token_labels
+
+
+@lru_cache(maxsize=TOKEN_OVERLAP_CACHE_SIZE)
+def token_overlap(text, token_func=tokenize):
+    """
+    Returns the (cached) TokenOverlap of the given text, so that documents that are evaluated again,
+    e.g. after an annotation changed, don't need to be tokenized again.
+    """
+    return TokenOverlap(text, list(token_func(text)))
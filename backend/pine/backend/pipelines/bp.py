@@ -1,14 +1,16 @@
 # (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
 
+import json
 import logging
 import random
+import time
 import typing
 
 from flask import abort, Blueprint, jsonify, request, Response
 from werkzeug import exceptions
 
 from .. import auth, collections, models
-from ..data import service
+from ..data import next_instances, service
 from ..job_manager.service import ServiceManager, ServiceJob
 
 logger = logging.getLogger(__name__)
@@ -23,6 +25,11 @@ _cached_classifier_pipelines = {}
 
 default_model_name = "auto-trained"
 default_job_timeout = 36000 # 10 hours
+# requests for job progress tie up a (sync) gunicorn worker, which is killed after 60 seconds, so these are kept short
+default_progress_timeout = 5 # how long a long-poll for job progress waits
+max_progress_timeout = 20 # the longest a long-poll for job progress can ask to wait
+progress_stream_time = 30 # how long a job progress event stream stays open before the client has to reconnect
+final_progress_stages = frozenset({"done", "error"})
 
 def _get_classifier(classifier_id: str) -> dict:
     if classifier_id not in _cached_classifiers:
@@ -79,6 +86,33 @@ def _get_pipeline_running_jobs(pipeline: str, classifier_id: str) -> typing.List
 def _get_pipeline_job_results(pipeline: str, classifier_id: str, job_id: str, timeout_in_s) -> dict:
     return service_manager.get_job_response(pipeline, job_id, timeout_in_s)
 
+def _get_pipeline_job_progress(pipeline: str, classifier_id: str, job_id: str, last_id: str,
+                               timeout_in_s: int) -> typing.List[dict]:
+    return service_manager.get_job_progress(pipeline, job_id, last_id, timeout_in_s)
+
+def _stream_pipeline_job_progress(pipeline: str, classifier_id: str, job_id: str, last_id: str,
+                                  timeout_in_s: int):
+    """Yields the job's progress updates as server-sent events until the job is done or progress_stream_time
+    has passed.  In that case the client reconnects (EventSource does that by itself, sending Last-Event-ID)
+    and the stream continues where it left off.  A job that hasn't reported anything yet, e.g. because it's
+    still waiting for a pipeline, is waited for like one that has.
+    """
+    deadline = time.monotonic() + progress_stream_time
+    yield "retry: 1000\n\n"
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        updates = _get_pipeline_job_progress(pipeline, classifier_id, job_id, last_id,
+                                             max(1, min(timeout_in_s, int(remaining))))
+        for update in updates:
+            last_id = update["id"]
+            yield "id: {}\ndata: {}\n\n".format(last_id, json.dumps(update, separators=(",", ":")))
+            if update.get("stage") in final_progress_stages:
+                return
+        if not updates:
+            yield ": keep-alive\n\n"
+
 def _serialize_job(job: ServiceJob) -> dict:
     ret = {
         "job_id": job.job_id,
@@ -228,6 +262,23 @@ def get_job_results(classifier_id: str, job_id: str):
     
     return jsonify(_get_pipeline_job_results(pipeline, classifier_id, job_id, timeout_in_s))
 
+@bp.route("/job_progress/<classifier_id>/<job_id>", methods=["GET"])
+@auth.login_required
+def get_job_progress(classifier_id: str, job_id: str):
+    classifier = _get_classifier(classifier_id)
+    _check_permissions(classifier)
+    pipeline = _get_classifier_pipeline(classifier_id)
+    last_id = request.headers.get("Last-Event-ID", request.args.get("last_id", "0"))
+    try:
+        timeout_in_s = min(int(request.args.get("timeout_in_s", str(default_progress_timeout))), max_progress_timeout)
+    except ValueError:
+        abort(400, "timeout_in_s must be an int")
+
+    if request.accept_mimetypes.best == "text/event-stream":
+        return Response(_stream_pipeline_job_progress(pipeline, classifier_id, job_id, last_id, max(1, timeout_in_s)),
+                        mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    return jsonify(_get_pipeline_job_progress(pipeline, classifier_id, job_id, last_id, timeout_in_s))
+
 @bp.route("/train/<classifier_id>", methods=["POST"])
 def train(classifier_id: str):
     if request.is_json and request.data:
@@ -280,44 +331,31 @@ def predict(classifier_id: str):
 
 # Next instance endpointsrip
 
-def _get_next_instance(classifier_id: str):
-    _check_permissions(_get_classifier(classifier_id))
-    items = service.get_all_items("/next_instances", params=service.where_params({"classifier_id": classifier_id}))
-    if len(items) == 0:
+def _load_next_instances(classifier: dict, user_id: str):
+    classifier_id = classifier["_id"]
+    if not next_instances.QUEUES.load(classifier_id):
         raise exceptions.NotFound(description="No next instances")
-    return items[0]
-
-def _check_instance_overlap(classifier: dict, instance: dict, user_id: str):
-    if user_id not in instance["overlap_document_ids"]:
+    if not next_instances.QUEUES.has_annotator(classifier_id, user_id):
         logger.info("new user: adding to overlap document ids")
-        instance["overlap_document_ids"][user_id] = collections.get_overlap_ids(classifier["collection_id"])
-        to_patch = {
-            "_id": instance["_id"],
-            "overlap_document_ids": instance["overlap_document_ids"]
-        }
-        headers = {"If-Match": instance["_etag"]}
-        r = service.patch(["next_instances", instance["_id"]], json = to_patch, headers = headers)
-        if not r.ok:
-            abort(r.status_code, r.content)
+        next_instances.QUEUES.add_annotator(classifier_id, user_id,
+                                            collections.get_overlap_ids(classifier["collection_id"]))
 
 @bp.route("/next_document/by_classifier_id/<classifier_id>", methods = ["GET"])
 @auth.login_required
 def get_next_by_classifier(classifier_id: str):
-    instance = _get_next_instance(classifier_id)
     classifier = _get_classifier(classifier_id)
     _check_permissions(classifier)
     
     user_id = auth.get_logged_in_user()["id"]
-    _check_instance_overlap(classifier, instance, user_id)
-
-    if random.random() <= classifier["overlap"] and len(instance["overlap_document_ids"][user_id]) > 0:
-        return jsonify(instance["overlap_document_ids"][user_id].pop())
-    elif len(instance["document_ids"]) > 0:
-        return jsonify(instance["document_ids"].pop())
-    elif len(instance["overlap_document_ids"][user_id]) > 0:
-        return jsonify(instance["overlap_document_ids"][user_id].pop())
+    _load_next_instances(classifier, user_id)
+
+    (document_id, overlap_document_id) = next_instances.QUEUES.peek(classifier_id, user_id)
+    if overlap_document_id is not None and random.random() <= classifier["overlap"]:
+        return jsonify(overlap_document_id)
+    elif document_id is not None:
+        return jsonify(document_id)
     else:
-        return jsonify(None)
+        return jsonify(overlap_document_id)
 
 @bp.route("/next_document/by_classifier_id/<classifier_id>/<document_id>", methods = ["POST"])
 @auth.login_required
@@ -331,30 +369,14 @@ def advance_to_next_document_by_classifier(classifier_id: str, document_id: str)
     _check_permissions(classifier)
 
     pipeline = _get_classifier_pipeline(classifier_id)
-    instance = _get_next_instance(classifier_id)
-    
-    _check_instance_overlap(classifier, instance, user_id)
+    _load_next_instances(classifier, user_id)
 
-    data = None
     trained = False
     request_body = None
 
-    if document_id in instance["overlap_document_ids"][user_id]:
-        instance["overlap_document_ids"][user_id].remove(document_id)
-        data = {"overlap_document_ids": instance["overlap_document_ids"]}
-    elif document_id in instance["document_ids"]:
-        instance["document_ids"].remove(document_id)
-        data = {"document_ids": instance["document_ids"]}
-    else:
+    if not next_instances.QUEUES.remove(classifier_id, user_id, document_id):
         logger.info("Document {} not found in instance, document already annotated".format(document_id))
-
-    if data is not None:
-        headers = {"If-Match": instance["_etag"]}
-        r = service.patch(["next_instances", instance["_id"]], json = data, headers = headers)
-        #r = requests.patch(ENTRY_POINT + "/next_instances/" + items[0]["_id"], json.dumps(data), headers=headers)
-        if not r.ok:
-            abort(r.status_code, r.content)
-
+    else:
         classifier["annotated_document_count"] += 1
         headers = {"If-Match": classifier["_etag"]}
         service.remove_nonupdatable_fields(classifier)
@@ -381,4 +403,5 @@ def advance_to_next_document_by_classifier(classifier_id: str, document_id: str)
 
 def init_app(app):
     service_manager.start_listeners()
+    next_instances.start_persister(app)
     app.register_blueprint(bp)
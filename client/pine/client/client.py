@@ -826,7 +826,7 @@ class PineClient(BaseClient):
         :type doc_annotations: list(str)
         :param ner_annotations: NER annotations, where each annotation is either a list or a dict
         :type ner_annotations: list
-        :param update_iaa: whether to also update IAA reports related to this document, defaults to `True`
+        :param update_iaa: whether to also update IAA reports related to this document (in the background), defaults to `True`
         :type: update_iaa: bool
         
         :raises exceptions.PineClientValueException: if any of the given annotations are not valid, see :py:func:`.models.is_valid_annotation`
@@ -862,7 +862,7 @@ class PineClient(BaseClient):
                                       This should only be ``True`` if you properly set the
                                       "has_annotated" map when you created the document.
         :type skip_document_updates: bool
-        :param update_iaa: whether to also update IAA report for the collection, defaults to ``True``
+        :param update_iaa: whether to also update IAA report for the collection (in the background), defaults to ``True``
         :type update_iaa: bool
         
         :raises exceptions.PineClientValueException: if any of the given annotations are not valid, see :py:func:`.models.is_valid_doc_annotations`
@@ -1000,6 +1000,55 @@ class PineClient(BaseClient):
             "include_annotation_latest_version_only": json.dumps(include_annotation_latest_version_only)
         }).json()
 
+    def iter_collection_data(self, collection_id: str, include_collection_metadata: bool = True,
+                             include_document_metadata: bool = True, include_document_text: bool = True,
+                             include_annotations: bool = True,
+                             include_annotation_latest_version_only: bool = True) -> typing.Iterator[dict]:
+        """Streams collection data, one document at a time.
+
+        Unlike :py:func:`download_collection_data`, the collection is never held in memory all at
+        once, so this is better suited to large collections.  The first item yielded is the
+        collection itself (without a ``documents`` field); each following item is a document.
+
+        :param collection_id: the ID of the collection for which to download data
+        :type collection_id: str
+        :param include_collection_metadata: whether to include collection metadata, defaults to ``True``
+        :type include_collection_metadata: bool
+        :param include_document_metadata: whether to include document metadata, defaults to ``True``
+        :type include_document_metadata: bool
+        :param include_document_text: whether to include document text, defaults to ``True``
+        :type include_document_text: bool
+        :param include_annotations: whether to include annotations, defaults to ``True``
+        :type include_annotations: bool
+        :param include_annotation_latest_version_only: whether to include only the latest version
+                        of annotations (``True``) or all versions (``False``), defaults to ``True``
+        :type include_annotation_latest_version_only: bool
+
+        :raises exceptions.PineClientValueException: if given empty collection ID
+        :raises exceptions.PineClientAuthException: if not logged in
+        :raises exceptions.PineClientHttpException: if the HTTP request returns an error, such as if the
+                                                    collection doesn't exist
+
+        :returns: the collection followed by its documents
+        :rtype: iterator(dict)
+        """
+        self._check_login()
+        if not collection_id:
+            raise exceptions.PineClientValueException(collection_id, "str")
+        resp = self.get(["collections", "by_id", collection_id, "download"], stream=True, params={
+            "format": "ndjson",
+            "as_file": json.dumps(False),
+            "include_collection_metadata": json.dumps(include_collection_metadata),
+            "include_document_metadata": json.dumps(include_document_metadata),
+            "include_document_text": json.dumps(include_document_text),
+            "include_annotations": json.dumps(include_annotations),
+            "include_annotation_latest_version_only": json.dumps(include_annotation_latest_version_only)
+        })
+        with resp:
+            for line in resp.iter_lines():
+                if line:
+                    yield json.loads(line)
+
     def get_classifier_status(self, classifier_id: str) -> dict:
         """Returns the status for the given classifier.
         
@@ -1114,6 +1163,27 @@ class PineClient(BaseClient):
         return self.get(["pipelines", "job_results", classifier_id, job_id], params=params).json()
 
 
+    def get_classifier_job_progress(self, classifier_id: str, job_id: str, last_id: str = None,
+                                    timeout_in_s: int = None) -> typing.List[dict]:
+        """Gets the progress updates of the given classifier job, such as training folds and
+        iterations, waiting for one if there aren't any yet.
+        
+        :param classifier_id: str: classifier ID
+        :param job_id: str: job ID
+        :param last_id: str: ID of the last update already seen, or None for all updates
+        :param timeout_in_s: int: how long to wait, or None to use default
+        
+        :returns: progress updates, each with an ``"id"`` to pass as ``last_id`` next time
+        :rtype: list[dict]
+        """
+        self._check_login()
+        params = {}
+        if last_id != None:
+            params["last_id"] = last_id
+        if timeout_in_s != None:
+            params["timeout_in_s"] = timeout_in_s
+        return self.get(["pipelines", "job_progress", classifier_id, job_id], params=params).json()
+
 class LocalPineClient(PineClient):
     """A client for a local PINE instance, including an :py:class:`EveClient`.
     """
@@ -1,17 +1,22 @@
 # (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
 
+from datetime import datetime
 import logging.config
 import json
 import xml.etree.ElementTree as ET
 
 import os
+import secrets
 import subprocess
 import tempfile
 
+from bson import ObjectId
+from bson.errors import InvalidId
 import eve
 from flask import jsonify, request, send_file
 from flask import __version__ as flask_version
 from flask_cors import CORS
+from pymongo import ReturnDocument
 from werkzeug import exceptions
 
 from settings import PINE_EVE_VERSION_STR, LOGGER
@@ -71,6 +76,169 @@ def create_app():
     def ping():
         return jsonify("pong")
 
+    @app.route("/versions/<resource>", methods = ["GET"])
+    def get_all_versions(resource):
+        """Returns every version of every item in the given versioned resource that matches the
+        (optional) "where" filter, sorted by item ID and then version.  This is equivalent to
+        calling GET on each item with ?version=all but reads the shadow collection in one query,
+        so it only takes one request per page rather than one request per item.
+        """
+        if resource not in app.config["DOMAIN"] or not app.config["DOMAIN"][resource]["versioning"]:
+            raise exceptions.NotFound()
+        db = app.data.driver.db
+        id_field = app.config["DOMAIN"][resource]["id_field"]
+        id_document_field = id_field + app.config["VERSION_ID_SUFFIX"]
+        version_field = app.config["VERSION"]
+
+        where = json.loads(request.args.get("where", "{}"))
+        where = app.data._mongotize(where, resource)
+        projection = json.loads(request.args.get("projection", "null"))
+        if projection and any(projection.values()):
+            projection.update({id_document_field: 1, version_field: 1})
+        max_results = min(int(request.args.get("max_results", app.config["PAGINATION_DEFAULT"])),
+                          app.config["PAGINATION_LIMIT"])
+        page = max(int(request.args.get("page", 1)), 1)
+
+        shadow = db[resource + app.config["VERSIONS"]]
+        total = shadow.count_documents(where)
+        versions = list(shadow.find(where, projection)
+                        .sort([(id_document_field, 1), (version_field, 1)])
+                        .skip((page - 1) * max_results).limit(max_results))
+
+        # fill in the fields eve would take from the latest version of each item
+        latest = {item[id_field]: item for item in db[resource].find(
+            {id_field: {"$in": list({v[id_document_field] for v in versions})}},
+            {version_field: 1, app.config["DATE_CREATED"]: 1})}
+        items = []
+        for version in versions:
+            item_id = version.pop(id_document_field)
+            if item_id not in latest:
+                # item was deleted
+                continue
+            version[id_field] = item_id
+            version[app.config["DATE_CREATED"]] = latest[item_id].get(app.config["DATE_CREATED"])
+            version[app.config["LATEST_VERSION"]] = latest[item_id].get(version_field)
+            items.append(version)
+
+        # use eve's encoder so that object IDs and dates are rendered the same as eve does
+        return app.response_class(json.dumps({
+            "_items": items,
+            "_meta": {
+                "page": page,
+                "max_results": max_results,
+                "total": total
+            }
+        }, cls = app.data.json_encoder_class), mimetype = "application/json")
+
+    @app.route("/next_instances/add_documents", methods = ["POST"])
+    def next_instances_add_documents():
+        """Appends document IDs to a classifier's next_instances object in place, using $push, so
+        that adding documents doesn't require reading and re-writing the whole lists.  The JSON body
+        has "classifier_id", "document_ids", and "overlap_document_ids" (which are appended for
+        every annotator).
+        """
+        body = request.get_json(silent = True)
+        if not body or "classifier_id" not in body:
+            raise exceptions.UnprocessableEntity("Missing 'classifier_id' parameter")
+        db = app.data.driver.db
+        query = {"classifier_id": ObjectId(body["classifier_id"])}
+
+        push = {}
+        if body.get("document_ids"):
+            push["document_ids"] = {"$each": body["document_ids"]}
+        if body.get("overlap_document_ids"):
+            annotators = db.next_instances.aggregate([
+                {"$match": query},
+                {"$project": {"annotators": {"$map": {
+                    "input": {"$objectToArray": "$overlap_document_ids"}, "in": "$$this.k"
+                }}}}
+            ])
+            for instance in annotators:
+                for annotator in instance["annotators"]:
+                    push["overlap_document_ids." + annotator] = {"$each": body["overlap_document_ids"]}
+
+        # change the etag so that anyone holding the old one gets a 412 instead of overwriting this
+        update = {"$set": {
+            app.config["LAST_UPDATED"]: datetime.utcnow().replace(microsecond = 0),
+            app.config["ETAG"]: secrets.token_hex(20)
+        }}
+        if push:
+            update["$push"] = push
+        instance = db.next_instances.find_one_and_update(query, update,
+                                                         projection = {app.config["ETAG"]: 1},
+                                                         return_document = ReturnDocument.AFTER)
+        if instance is None:
+            raise exceptions.NotFound()
+        return jsonify({
+            "_id": str(instance["_id"]),
+            "_etag": instance[app.config["ETAG"]]
+        })
+
+    @app.route("/documents/delete_by_ids", methods = ["POST"])
+    def documents_delete_by_ids():
+        """Deletes documents, their annotations (and annotation versions), and removes them from
+        any next_instances, using a handful of bulk queries instead of one request per object.  The
+        JSON body has "document_ids".  If any of the documents don't exist, nothing is deleted.
+        Note that, unlike item DELETEs, this doesn't fire eve's delete event hooks.
+        """
+        body = request.get_json(silent = True)
+        if not body or not isinstance(body.get("document_ids"), list):
+            raise exceptions.UnprocessableEntity("Missing 'document_ids' parameter")
+        db = app.data.driver.db
+        document_ids = list(set(body["document_ids"]))
+        try:
+            document_oids = [ObjectId(doc_id) for doc_id in document_ids]
+        except InvalidId:
+            raise exceptions.NotFound()
+        documents = list(db.documents.find({"_id": {"$in": document_oids}}, {"collection_id": 1}))
+        if len(documents) != len(document_oids):
+            raise exceptions.NotFound()
+
+        # next_instances store document IDs as strings
+        next_instances_updated = []
+        classifier_ids = [c["_id"] for c in db.classifiers.find(
+            {"collection_id": {"$in": list({doc["collection_id"] for doc in documents})}}, {"_id": 1})]
+        instances = db.next_instances.aggregate([
+            {"$match": {"classifier_id": {"$in": classifier_ids}}},
+            {"$project": {"annotators": {"$map": {
+                "input": {"$objectToArray": "$overlap_document_ids"}, "in": "$$this.k"
+            }}}}
+        ])
+        for instance in instances:
+            pull = {"document_ids": {"$in": document_ids}}
+            for annotator in instance["annotators"]:
+                pull["overlap_document_ids." + annotator] = {"$in": document_ids}
+            result = db.next_instances.update_one({"_id": instance["_id"]}, {
+                "$pull": pull,
+                "$set": {
+                    app.config["LAST_UPDATED"]: datetime.utcnow().replace(microsecond = 0),
+                    app.config["ETAG"]: secrets.token_hex(20)
+                }
+            })
+            if result.modified_count > 0:
+                next_instances_updated.append(str(instance["_id"]))
+
+        # annotations and their versions (annotations store document_id as an object ID)
+        annotation_ids = [a["_id"] for a in db.annotations.find({"document_id": {"$in": document_oids}}, {"_id": 1})]
+        if annotation_ids:
+            versioned_id_field = app.config["ID_FIELD"] + app.config["VERSION_ID_SUFFIX"]
+            db["annotations" + app.config["VERSIONS"]].delete_many({versioned_id_field: {"$in": annotation_ids}})
+            db.annotations.delete_many({"_id": {"$in": annotation_ids}})
+
+        db.documents.delete_many({"_id": {"$in": document_oids}})
+
+        return jsonify({
+            "next_instances": {
+                "updated": next_instances_updated
+            },
+            "annotations": {
+                "deleted": [str(annotation_id) for annotation_id in annotation_ids]
+            },
+            "documents": {
+                "deleted": [str(doc["_id"]) for doc in documents]
+            }
+        })
+
     @app.route("/system/export", methods = ["GET"])
     def system_export():
         db = app.data.driver.db
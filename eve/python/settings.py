@@ -8,7 +8,7 @@ LOGGER = logging.getLogger("pine.eve." + __name__)
 ################
 # IMPORTANT: if you make any schema changes, you must update this version
 
-PINE_EVE_VERSION = (1, 0, 1)
+PINE_EVE_VERSION = (1, 4, 0)
 PINE_EVE_VERSION_STR = ".".join([str(x) for x in PINE_EVE_VERSION])
 
 collections = {
@@ -136,10 +136,13 @@ metrics = {
         'documents': {'type': 'list', 'required': True},
         'annotations': {'type': 'list', 'required': True},
         'folds': {'type': 'list'},
+        'fold_annotations': {'type': 'list'},
+        'fold_fingerprints': {'type': 'list'},
         'metrics': {'type': 'list'},
         'metric_averages' : {'type': 'dict'},
         'filename': {'type': 'string'},
-        'trained_classifier_db_version': {'type': 'integer'}
+        'trained_classifier_db_version': {'type': 'integer'},
+        'trainings_since_cross_validation': {'type': 'integer'}
     },
     'mongo_indexes':{'metrics_classifier_id': [('classifier_id', 1)], 'doc_collection_id':[('collection_id', 1)]},
     'item_methods':['GET', 'PUT', 'PATCH'],
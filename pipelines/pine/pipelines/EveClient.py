@@ -21,6 +21,7 @@ class EveDocsAndAnnotations:
 
 class EveClient(object):
     eve_headers = {'Content-Type': 'application/json'}
+    page_size = 5000  # eve's PAGINATION_LIMIT
 
     def __init__(self, entry_point='{}:{}'.format(config.EVE_HOST, config.EVE_PORT)):
         self.entry_point = entry_point
@@ -74,19 +75,33 @@ class EveClient(object):
                     return r['_items'], None
         return [], None
 
+    def iter_items(self, resource: str, params: dict = {}) -> typing.Iterator[dict]:
+        """Yields every item of a resource that matches the given parameters, requesting a page at a time.
+
+        Unlike get_items, this raises an exception if a page can't be retrieved instead of treating it as empty.
+
+        :param resource: str: the resource name, e.g. "documents"
+        :param params: dict: parameters to send in with each GET (e.g. "where" and "projection")
+        """
+        url = 'http://%s/%s' % (self.entry_point, resource)
+        params = dict(params, max_results=self.page_size)
+        page = 1
+        while True:
+            params["page"] = page
+            response = requests.get(url, params=params, headers=self.eve_headers)
+            response.raise_for_status()
+            r = response.json()
+            yield from r.get('_items', [])
+            if 'next' not in r.get('_links', {}):
+                break
+            page += 1
+
     def _get_documents_map(self, params: dict = {}):
-        params["projection"] = json.dumps({
+        params = dict(params, projection=json.dumps({
             "_id": 1,
             "text": 1
-        })
-        doc_map = {}
-        while True:
-            items, query = self.get_items("documents", params=params)
-            for d in items:
-                doc_map[d['_id']] = d['text']
-            if query is None:
-                break
-        return doc_map
+        }))
+        return {d['_id']: d['text'] for d in self.iter_items("documents", params=params)}
 
     def get_documents(self, collection_id: str) -> typing.Dict[str, str]:
         """Returns a document map where the document overlap is 0.
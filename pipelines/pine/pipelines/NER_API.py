@@ -1,7 +1,12 @@
 # (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
 
+import concurrent.futures
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
+import random
 import typing
 import uuid
 
@@ -14,19 +19,52 @@ from itertools import chain
 
 from .EveClient import EveClient, EveDocsAndAnnotations
 from . import RankingFunctions as rank
+from .document_ranking import IncrementalRanker
+from .model_cache import MODELS, get_untrained_pipeline
 from .pipeline import EvaluationMetrics, StatMetrics
 from .pmap_ner import NER
 from .shared.config import ConfigBuilder
+from .training_data import get_training_data
 
 logger = logging.getLogger(__name__)
 config = ConfigBuilder.get_config()
 
+def _seed_random(seed: typing.Optional[int]):
+    """Seeds the global random number generators used by the pipelines; does nothing if seed is None."""
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+
+def _perform_fold_on_fresh_pipeline(pipeline_name: str, seed: typing.Optional[int], all_labels: typing.List[str],
+                                    train_data, test_data, pipeline_parameters: dict,
+                                    progress: typing.Callable[[dict], None] = None) -> EvaluationMetrics:
+    """Trains and evaluates a single cross-validation fold on a fresh pipeline, either in this process or in
+    a worker process (where progress can't be reported).
+    """
+    _seed_random(seed)
+    model = NER(pipeline_name)
+    model.fit(train_data[0], train_data[1], all_labels, progress=progress, **pipeline_parameters)
+    return model.evaluate(test_data[0], test_data[1], all_labels)
+
+# increase if what a fold's metrics depend on changes, so that previous fold metrics aren't reused (version 2:
+# every fold is trained on a fresh pipeline; before, serial folds continued training the previous ones' model)
+FOLD_FINGERPRINT_VERSION = 2
+
+def _fold_seed(seed: typing.Optional[int], fold: int) -> typing.Optional[int]:
+    return None if seed is None else seed + fold
+
 class FiveFoldResult(object):
     
     def __init__(self):
         self.metrics: typing.List[EvaluationMetrics] = []
         # store list of documents ids per fold
         self.folds: typing.List[typing.List] = []
+        # store list of annotation ids each fold is evaluated on
+        self.fold_annotations: typing.List[typing.List[str]] = []
+        # store a hash of the data and settings each fold was trained and evaluated with
+        self.fold_fingerprints: typing.List[str] = []
+        # number of folds whose metrics were reused from the previous cross-validation
+        self.cached_folds = 0
         self.average_metrics: typing[dict, StatMetrics] = {}
     
     def serialize_metrics(self):
@@ -35,9 +73,25 @@ class FiveFoldResult(object):
     def serialize_folds(self):
         return list(self.folds) # make a copy
 
+    def serialize_fold_annotations(self):
+        return list(self.fold_annotations) # make a copy
+
+    def serialize_fold_fingerprints(self):
+        return list(self.fold_fingerprints) # make a copy
+
     def serialize_average_metrics(self):
         return {label: self.average_metrics[label].serialize() for label in self.average_metrics.keys()}
 
+class FiveFoldPlan(object):
+
+    def __init__(self):
+        # (train indices, test indices) of each fold
+        self.splits: typing.List[typing.Tuple[np.ndarray, np.ndarray]] = []
+        # hash of the data and settings each fold is trained and evaluated with
+        self.fingerprints: typing.List[str] = []
+        # metrics of the folds that can be reused from the previous cross-validation (None for the others)
+        self.cached_metrics: typing.List[typing.Optional[EvaluationMetrics]] = []
+
 class ner_api(object):
 
     def __init__(self):
@@ -46,7 +100,7 @@ class ner_api(object):
         self.eve_client = EveClient()
 
     def status(self, classifier_id: str, pipeline_name: str) -> dict:
-        classifier = NER(pipeline_name)
+        classifier = get_untrained_pipeline(pipeline_name)
         status = {
             "pipeline_name": pipeline_name,
             "classifier_id": classifier_id,
@@ -66,47 +120,171 @@ class ner_api(object):
 
         return results
 
-    def perform_five_fold(self, model: NER, all_labels: typing.List[str], documents, annotations, doc_ids: typing.List[str], **pipeline_parameters) -> FiveFoldResult:
+    @staticmethod
+    def _stage_progress(progress: typing.Callable[[dict], None], **stage) -> typing.Callable[[dict], None]:
+        """Returns a progress callback that adds the given stage information to every update."""
+        if progress is None:
+            return lambda update: None
+        return lambda update: progress(dict(stage, **update))
+
+    @staticmethod
+    def _get_cached_splits(ann_ids: typing.List[str], n_splits: int, previous_metrics: dict):
+        """Returns (train indices, test indices) of each fold that keep every annotation in the fold it was
+        evaluated in by the previous cross-validation, or None if there is no usable previous fold assignment.
+
+        New annotations are added to the smallest folds and deleted ones are dropped.
+        """
+        previous_fold_annotations = pydash.get(previous_metrics, "fold_annotations", None)
+        if not ann_ids or not previous_fold_annotations or len(previous_fold_annotations) != n_splits:
+            return None
+        previous_folds = {ann_id: fold for (fold, fold_ann_ids) in enumerate(previous_fold_annotations)
+                          for ann_id in fold_ann_ids}
+        test_indices = [[] for _ in range(n_splits)]
+        new_indices = []
+        for (i, ann_id) in enumerate(ann_ids):
+            if ann_id in previous_folds:
+                test_indices[previous_folds[ann_id]].append(i)
+            else:
+                new_indices.append(i)
+        for i in new_indices:
+            min(test_indices, key=len).append(i)
+        if not all(test_indices):
+            return None
+        all_indices = np.arange(len(ann_ids))
+        return [(np.setdiff1d(all_indices, test_index), np.array(test_index)) for test_index in test_indices]
+
+    def prepare_five_fold(self, all_labels: typing.List[str], documents, annotations, doc_ids: typing.List[str],
+                          seed: typing.Optional[int] = None, pipeline_name: str = None, n_splits: int = 5,
+                          ann_ids: typing.List[str] = None, previous_metrics: dict = None,
+                          **pipeline_parameters) -> FiveFoldPlan:
+        """Splits the documents into n_splits stratified folds and finds the folds whose metrics can be reused.
+
+        Making the splits uses (and reseeds) numpy's global random state, so this has to run on the thread that
+        trains afterwards and not alongside it.
+
+        If the annotation IDs and the previous metrics object are given, the previous fold assignment is kept and
+        the metrics of any fold whose data and settings haven't changed since are reused instead of retraining it.
+        """
+        plan = FiveFoldPlan()
+        annotations_np_array = np.array(annotations, dtype=object)
+        ann_ids_np_array = np.array(ann_ids if ann_ids is not None else [None] * len(doc_ids))
+
+        splits = self._get_cached_splits(ann_ids, n_splits, previous_metrics)
+        if splits is None:
+            ann_list = list()
+
+            for ann in annotations_np_array:
+                ann_list = ann_list + list([x[2] for x in ann])
+            # getting unique label names in annotations
+            unique_ann_list = list(set(ann_list))
+
+            # array to store multilabel values
+            multilabel_array = []
+            for ann in annotations_np_array:
+                multilabel_array.append([unique_ann_list.index(x[2]) for x in ann])
+
+            multilabel_binarizer = MultiLabelBinarizer().fit_transform(multilabel_array)
+
+            # IterativeStratification breaks ties with numpy's global random state (it can't take a random_state
+            # with the installed scikit-learn), so seed it first
+            _seed_random(seed)
+            skf = IterativeStratification(n_splits=n_splits, order=1)
+            # in entry order, like the cached splits, so the same folds get the same fingerprints
+            splits = [(np.sort(train_index), np.sort(test_index))
+                      for (train_index, test_index) in skf.split(np.array(documents), multilabel_binarizer)]
+        plan.splits = splits
+
+        # a fold's metrics can be reused as long as everything it was trained and evaluated with is the same;
+        # that's all they depend on, since every fold is trained on a fresh pipeline (see perform_five_fold)
+        entry_hashes = [hashlib.sha1(json.dumps(entry, sort_keys=True, default=str).encode()).digest()
+                        for entry in zip(ann_ids_np_array.tolist(), doc_ids, documents, annotations)]
+        def fold_fingerprint(fold, train_index, test_index):
+            fingerprint = hashlib.sha1(json.dumps([FOLD_FINGERPRINT_VERSION, pipeline_name, _fold_seed(seed, fold), all_labels,
+                                                   pipeline_parameters], sort_keys=True, default=str).encode())
+            for i in train_index:
+                fingerprint.update(entry_hashes[i])
+            fingerprint.update(b"|")
+            for i in test_index:
+                fingerprint.update(entry_hashes[i])
+            return fingerprint.hexdigest()
+
+        plan.fingerprints = [fold_fingerprint(fold, train_index, test_index)
+                             for fold, (train_index, test_index) in enumerate(splits)]
+        plan.cached_metrics = [None] * n_splits
+        if ann_ids is not None:
+            previous_fingerprints = pydash.get(previous_metrics, "fold_fingerprints", None) or []
+            previous_fold_metrics = pydash.get(previous_metrics, "metrics", None) or []
+            for fold in range(min(n_splits, len(previous_fingerprints), len(previous_fold_metrics))):
+                if previous_fingerprints[fold] == plan.fingerprints[fold]:
+                    plan.cached_metrics[fold] = EvaluationMetrics.deserialize(previous_fold_metrics[fold])
+        return plan
+
+    def perform_five_fold(self, model: NER, all_labels: typing.List[str], documents, annotations, doc_ids: typing.List[str],
+                          progress: typing.Callable[[dict], None] = None, seed: typing.Optional[int] = None,
+                          executor: concurrent.futures.Executor = None, pipeline_name: str = None,
+                          n_splits: int = 5, ann_ids: typing.List[str] = None, previous_metrics: dict = None,
+                          plan: FiveFoldPlan = None, **pipeline_parameters) -> FiveFoldResult:
+        """Splits the documents into n_splits stratified folds and trains and evaluates a model on each of them.
+
+        Each fold is trained on a fresh pipeline_name pipeline, after seeding the random number generators with
+        seed + i for fold i, and the given model is left untouched (so it can be trained on all the data
+        independently).  Without an executor the folds are run one after another in this process, with an
+        executor they're run in its worker processes; the results are the same either way and don't depend on
+        the order in which the folds finish.
+
+        The folds are made with prepare_five_fold (see there for reusing previous metrics) unless its plan is
+        given, which it has to be when this runs alongside another training.
+        """
+        if plan is None:
+            plan = self.prepare_five_fold(all_labels, documents, annotations, doc_ids, seed=seed,
+                                          pipeline_name=pipeline_name, n_splits=n_splits, ann_ids=ann_ids,
+                                          previous_metrics=previous_metrics, **pipeline_parameters)
         results = FiveFoldResult()
         # turning into numpy arrays to be able to access values with index array
         documents_np_array = np.array(documents)
         annotations_np_array = np.array(annotations, dtype=object)
         doc_ids_np_array = np.array(doc_ids)
-        ann_list = list()
-
-        for ann in annotations_np_array:
-            ann_list = ann_list + list([x[2] for x in ann])
-        # getting unique label names in annotations
-        unique_ann_list = list(set(ann_list))
-
-        # array to store multilabel values
-        multilabel_array = []
-        for ann in annotations_np_array:
-            multilabel_array.append([unique_ann_list.index(x[2]) for x in ann])
-
-        multilabel_binarizer = MultiLabelBinarizer().fit_transform(multilabel_array)
-
-        skf = IterativeStratification(n_splits=5, order=1)
+        ann_ids_np_array = np.array(ann_ids if ann_ids is not None else [None] * len(doc_ids))
+        splits = plan.splits
+        fingerprints = plan.fingerprints
+        cached_metrics = plan.cached_metrics
+
+        def fold_data(index):
+            return [documents_np_array[index].tolist(), annotations_np_array[index].tolist()]
+
+        results.cached_folds = sum(1 for fold_metrics in cached_metrics if fold_metrics is not None)
+        if results.cached_folds:
+            logger.info("Reusing metrics of {} of {} cross-validation folds".format(results.cached_folds, n_splits))
+
+        if executor is not None:
+            fold_futures = {fold: executor.submit(_perform_fold_on_fresh_pipeline, pipeline_name, _fold_seed(seed, fold), all_labels,
+                                                  fold_data(train_index), fold_data(test_index), pipeline_parameters)
+                            for fold, (train_index, test_index) in enumerate(splits) if cached_metrics[fold] is None}
+            for future in concurrent.futures.as_completed(fold_futures.values()):
+                future.result()
+                self._stage_progress(progress, stage="cross_validation", folds=n_splits)(
+                    {"completed": results.cached_folds + sum(1 for f in fold_futures.values() if f.done())})
 
         total_metrics = {}
 
-        for train_index, test_index in skf.split(documents_np_array, multilabel_binarizer):
-            # get annotations train and test datasets
-            train_annotations = annotations_np_array[train_index]
-            test_annotations = annotations_np_array[test_index]
-
-            # get documents train and test datasets
-            train_documents = documents_np_array[train_index]
-            test_documents = documents_np_array[test_index]
-
-            fold_metrics = self.perform_fold(model, all_labels,
-                                             [train_documents.tolist(), train_annotations.tolist()],
-                                             [test_documents.tolist(), test_annotations.tolist()],
-                                             **pipeline_parameters)
+        for fold, (train_index, test_index) in enumerate(splits):
+            if cached_metrics[fold] is not None:
+                fold_metrics = cached_metrics[fold]
+            elif executor is not None:
+                fold_metrics = fold_futures[fold].result()
+            else:
+                fold_progress = self._stage_progress(progress, stage="cross_validation", fold=fold + 1, folds=n_splits)
+                fold_progress({})
+                fold_metrics = _perform_fold_on_fresh_pipeline(pipeline_name, _fold_seed(seed, fold), all_labels,
+                                                               fold_data(train_index), fold_data(test_index),
+                                                               pipeline_parameters, progress=fold_progress)
 
             # saving docs used to train fold
             fold_doc_ids = doc_ids_np_array[train_index]
             results.folds.append(fold_doc_ids.tolist())
+            # saving annotations used to evaluate fold, and what it was trained with
+            results.fold_annotations.append(ann_ids_np_array[test_index].tolist())
+            results.fold_fingerprints.append(fingerprints[fold])
 
             # saving fold metrics
             results.metrics.append(fold_metrics)
@@ -123,39 +301,53 @@ class ner_api(object):
 
         for label in total_metrics.keys():
             avg_metric = StatMetrics()
-            avg_metric.fn = total_metrics[label].fn / 5
-            avg_metric.fp = total_metrics[label].fp / 5
-            avg_metric.tp = total_metrics[label].tp / 5
-            avg_metric.tn = total_metrics[label].tn / 5
+            avg_metric.fn = total_metrics[label].fn / n_splits
+            avg_metric.fp = total_metrics[label].fp / n_splits
+            avg_metric.tp = total_metrics[label].tp / n_splits
+            avg_metric.tn = total_metrics[label].tn / n_splits
             avg_metric.calc_precision_recall_f1_acc()
 
             results.average_metrics[label] = avg_metric
 
         return results
 
-    def get_document_ranking(self, model: NER, doc_map: typing.Dict[str, str], doc_ids: typing.List[str]) -> typing.List[str]:
+    def get_document_ranking(self, model: NER, doc_map: typing.Dict[str, str], doc_ids: typing.List[str],
+                             classifier_id: str = None, pipeline_name: str = None) -> typing.List[str]:
         """Calculates document rankings and returns document IDs sorted by ranking.
         
         The ranking should be which documents should be evaluated first.  This probably
         corresponds in some ways to the documents which the model is least confident about.
         
+        If the classifier ID and pipeline name are given, the scores are cached with the classifier's models
+        and the next ranking only scores the documents it needs to (see IncrementalRanker).
+        
         :param model: NER model
         :param doc_map: dict: mapping of document IDs to document text where overlap is 0
         :param doc_ids: list: IDs of documents where ???
+        :param classifier_id: str: the ID of the classifier
+        :param pipeline_name: str: the pipeline name
         
         :returns: sorted document IDs
         :rtype: list
         """
         # re rank documents
-        documents_no_anns = []
         ids_no_anns = list(set(doc_map.keys()).difference(set(doc_ids)))
+
+        if classifier_id is not None and pipeline_name is not None:
+            ranker = IncrementalRanker(os.path.join(self.model_dir, pipeline_name, classifier_id + "_ranking.msgpack"))
+            ranker.load()
+            ranks = ranker.rank(model, doc_map, ids_no_anns)
+            ranker.save()
+            return ranks
+
+        documents_no_anns = []
         for doc_id in ids_no_anns:
             documents_no_anns.append(doc_map[doc_id])
 
         # classifier.load_model(os.path.join(self.model_dir, filename))
         # ranks = classifier.next_example(documents_no_anns, ids_no_anns)
         results = model.predict_proba(documents_no_anns)
-        ranks = rank.least_confidence_squared(ids_no_anns, results)
+        ranks = rank.least_confidence_squared_vectorized(ids_no_anns, results)
         return [r[0] for r in ranks]
 
     def get_classifier_pipeline_metrics_objs(self, classifier_id):
@@ -175,38 +367,94 @@ class ner_api(object):
 
         return classifier_obj, pipeline_obj, metrics_obj
 
-    def train_model(self, custom_filename, classifier_id, pipeline_name):
+    def train_model(self, custom_filename, classifier_id, pipeline_name, progress: typing.Callable[[dict], None] = None):
         logger.info("train_model called with custom_filename='{}' classifier_id='{}' pipeline_name='{}'".format(
             custom_filename, classifier_id, pipeline_name))
 
         # get classifier object
         classifier_obj, pipeline_obj, metrics_obj = self.get_classifier_pipeline_metrics_objs(classifier_id)
         collection_id = pydash.get(classifier_obj, 'collection_id', None)
-        pipeline_parameters = pydash.get(classifier_obj, 'parameters', None)
+        pipeline_parameters = pydash.get(classifier_obj, 'parameters', None) or {}
         logger.info("train_model collection_id='{}' pipeline_parameters='{}'".format(
             collection_id, pipeline_parameters))
 
         #get pipeline name
         # pipeline_name = pipeline_obj["name"]
 
-        # get documents where overlap is 0
-        doc_map = self.eve_client.get_documents(collection_id)
-        # get documents with its annotations where overlap is 0
-        eve_data = self.eve_client.get_docs_with_annotations(collection_id, doc_map)
+        self._stage_progress(progress, stage="loading")({})
+        if config.TRAINING_DATA_DIR:
+            # get the same from the collection's local snapshot, only downloading what changed since the last time
+            doc_map, eve_data = get_training_data(self.eve_client, collection_id)
+        else:
+            # get documents where overlap is 0
+            doc_map = self.eve_client.get_documents(collection_id)
+            # get documents with its annotations where overlap is 0
+            eve_data = self.eve_client.get_docs_with_annotations(collection_id, doc_map)
+
+        # the classifier's "seed" and cross-validation parameters override the configured ones; they're not
+        # pipeline parameters
+        pipeline_parameters = dict(pipeline_parameters)
+        seed = pipeline_parameters.pop("seed", config.TRAINING_SEED)
+        seed = None if seed is None else int(seed)
+        n_splits = int(pipeline_parameters.pop("cross_validation_folds", config.CROSS_VALIDATION_FOLDS))
+        cross_validation_every = int(pipeline_parameters.pop("cross_validation_every", config.CROSS_VALIDATION_EVERY))
+
+        # cross-validate every cross_validation_every trainings, and whenever there are no metrics yet
+        trainings_since_cross_validation = pydash.get(metrics_obj, "trainings_since_cross_validation", None) or 0
+        run_cross_validation = n_splits > 1 and cross_validation_every > 0 and (
+            trainings_since_cross_validation + 1 >= cross_validation_every or not metrics_obj.get("metric_averages"))
+        if not run_cross_validation:
+            logger.info("Skipping cross-validation for classifier {}".format(classifier_id))
 
         # instantiate model
         classifier = NER(pipeline_name)
-
-        # get folds information
-        fold_results = self.perform_five_fold(classifier, eve_data.all_labels,
-                                              eve_data.documents, eve_data.annotations,
-                                              eve_data.doc_ids, **pipeline_parameters)
-
-        logger.info("Starting to train classifier for {} pipeline".format(pipeline_name))
-        fit_results = classifier.fit(eve_data.documents, eve_data.annotations, eve_data.all_labels, **pipeline_parameters)
+        fit_progress = self._stage_progress(progress, stage="training")
+
+        def fit_classifier():
+            logger.info("Starting to train classifier for {} pipeline".format(pipeline_name))
+            fit_progress({})
+            _seed_random(seed)
+            return classifier.fit(eve_data.documents, eve_data.annotations, eve_data.all_labels,
+                                  progress=fit_progress, **pipeline_parameters)
+
+        fold_results = None
+        processes = min(config.CROSS_VALIDATION_PROCESSES, n_splits)
+        if run_cross_validation and processes > 1:
+            # run the folds on fresh pipelines in their own processes while this one fits the final classifier;
+            # spawn rather than fork, since some pipelines have a JVM running that wouldn't survive a fork
+            # the folds are made here first, since that uses the global random state the fit reseeds
+            plan = self.prepare_five_fold(eve_data.all_labels, eve_data.documents, eve_data.annotations,
+                                          eve_data.doc_ids, seed=seed, pipeline_name=pipeline_name, n_splits=n_splits,
+                                          ann_ids=eve_data.ann_ids, previous_metrics=metrics_obj, **pipeline_parameters)
+            with concurrent.futures.ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn")) as fold_executor, \
+                    concurrent.futures.ThreadPoolExecutor(1) as five_fold_executor:
+                fold_results_future = five_fold_executor.submit(
+                    self.perform_five_fold, classifier, eve_data.all_labels, eve_data.documents, eve_data.annotations,
+                    eve_data.doc_ids, progress=progress, seed=seed, executor=fold_executor,
+                    pipeline_name=pipeline_name, n_splits=n_splits, ann_ids=eve_data.ann_ids,
+                    previous_metrics=metrics_obj, plan=plan, **pipeline_parameters)
+                fit_results = fit_classifier()
+                fold_results = fold_results_future.result()
+        elif run_cross_validation:
+            # get folds information
+            fold_results = self.perform_five_fold(classifier, eve_data.all_labels,
+                                                  eve_data.documents, eve_data.annotations,
+                                                  eve_data.doc_ids, progress=progress, seed=seed,
+                                                  pipeline_name=pipeline_name, n_splits=n_splits,
+                                                  ann_ids=eve_data.ann_ids, previous_metrics=metrics_obj,
+                                                  **pipeline_parameters)
+            fit_results = fit_classifier()
+        else:
+            fit_results = fit_classifier()
         results = {
             "fit": fit_results,
-            "average_metrics": fold_results.serialize_average_metrics(),
+            # without cross-validation, the averages are the ones from the last time it was run
+            "average_metrics": fold_results.serialize_average_metrics() if fold_results is not None else \
+                pydash.get(metrics_obj, "metric_averages", None) or {},
+            "cross_validation": {
+                "folds": n_splits,
+                "cached_folds": fold_results.cached_folds
+            } if fold_results is not None else None,
             "updated_objects": {}
         }
 
@@ -221,25 +469,34 @@ class ner_api(object):
         if not self.eve_client.update('classifiers', classifier_id, classifier_obj['_etag'], {'filename': model_filename}):
             raise Exception("Unable to update classifier for {}".format(filename))
         logger.info("Saved classifier for {}".format(filename))
+        # the next predictions in this process can use the trained model without loading it
+        MODELS.put(classifier_id, model_filename, classifier)
         results["updated_objects"]["classifiers"] = [classifier_id]
 
         # update classifier metrics on eve
         metrics_updated_obj = {
             'trained_classifier_db_version': classifier_obj['_version']+1,
-            'documents': list(set(chain.from_iterable(fold_results.folds))),
+            'documents': list(set(eve_data.doc_ids)),
             'annotations': list(eve_data.ann_ids),
-            'folds': fold_results.serialize_folds(),
-            'metrics': fold_results.serialize_metrics(),
-            'metric_averages': fold_results.serialize_average_metrics(),
-            'filename': filename
+            'filename': filename,
+            'trainings_since_cross_validation': 0 if fold_results is not None else trainings_since_cross_validation + 1
         }
+        if fold_results is not None:
+            metrics_updated_obj.update({
+                'folds': fold_results.serialize_folds(),
+                'fold_annotations': fold_results.serialize_fold_annotations(),
+                'fold_fingerprints': fold_results.serialize_fold_fingerprints(),
+                'metrics': fold_results.serialize_metrics(),
+                'metric_averages': fold_results.serialize_average_metrics()
+            })
         if not self.eve_client.update('metrics', metrics_obj["_id"], metrics_obj['_etag'], metrics_updated_obj):
             raise Exception("Unable to update metrics for {}".format(filename))
         logger.info("Saved classifier metrics for {}".format(filename))
         results["updated_objects"]["metrics"] = [metrics_obj["_id"]]
 
         # re rank documents
-        ranks = self.get_document_ranking(classifier, doc_map, eve_data.doc_ids)
+        self._stage_progress(progress, stage="ranking")({})
+        ranks = self.get_document_ranking(classifier, doc_map, eve_data.doc_ids, classifier_id, pipeline_name)
         logger.info("Performing document rankings")
 
         # Save updates to eve
@@ -255,6 +512,22 @@ class ner_api(object):
         return results
 
     def predict(self, classifier_id: str, pipeline_name: str, document_ids: typing.List[str], texts: typing.List[str]):
+        results = self.predict_batch(classifier_id, pipeline_name, [(document_ids, texts)])[0]
+        if "error" in results:
+            raise Exception(results["error"])
+        return results
+
+    def predict_batch(self, classifier_id: str, pipeline_name: str,
+                      requests: typing.List[typing.Tuple[typing.List[str], typing.List[str]]]) -> typing.List[dict]:
+        """Runs several predict requests for the same classifier with a single call to the model.
+
+        :param classifier_id: str: the ID of the classifier
+        :param pipeline_name: str: the pipeline name
+        :param requests: list: (document IDs, texts) of each request
+
+        :returns: the results of each request, or a dict with an "error" for requests that failed
+        :rtype: list
+        """
         classifier_obj, pipeline_obj, metrics_obj = self.get_classifier_pipeline_metrics_objs(classifier_id)
 
         if classifier_obj is None:
@@ -262,36 +535,38 @@ class ner_api(object):
         if 'filename' not in classifier_obj:
             raise Exception('No filename in classifier obj')
 
-        if document_ids == None:
-            document_ids = []
-        if texts == None:
-            texts = []
+        requests = [(document_ids or [], texts or []) for (document_ids, texts) in requests]
 
         # pipeline_name=pipeline_obj["name"]
-        
+
         # load documents
-        doc_map = self.eve_client.get_documents_by_id(document_ids)
-        documents = []
-        for document_id in document_ids:
-            if document_id not in doc_map:
-                raise Exception("Unable to find document with ID {}".format(document_id))
-            documents.append(doc_map[document_id])
+        all_document_ids = list(dict.fromkeys(chain.from_iterable(document_ids for (document_ids, _) in requests)))
+        doc_map = self.eve_client.get_documents_by_id(all_document_ids)
 
         filename = os.path.join(self.model_dir, pipeline_name, classifier_obj['filename'])
 
         if not os.path.exists(filename):
             raise FileNotFoundError("No model with {} filename has been created".format(filename))
-        classifier = NER(pipeline_name)
-        classifier.load_model(filename)
-        logger.info("Loaded classifier {}".format(classifier))
-
-        predicted_documents = classifier.predict(documents)
-        predicted_documents_by_id = {}
-        for i, doc_id in enumerate(document_ids):
-            predicted_documents_by_id[doc_id] = predicted_documents[i].serialize()
-        predicted_texts = [p.serialize() for p in classifier.predict(texts)]
-        return {
-            "documents_by_id": predicted_documents_by_id,
-            "texts": predicted_texts
-        }
-        return classifier.predict(documents, document_ids)
+        classifier = MODELS.get(classifier_id, pipeline_name, filename)
+
+        # predict each distinct document once and all texts together
+        found_document_ids = [doc_id for doc_id in all_document_ids if doc_id in doc_map]
+        all_texts = list(chain.from_iterable(texts for (_, texts) in requests))
+        predictions = classifier.predict([doc_map[doc_id] for doc_id in found_document_ids] + all_texts)
+        predicted_documents_by_id = {doc_id: predictions[i].serialize() for (i, doc_id) in enumerate(found_document_ids)}
+        predicted_texts = [p.serialize() for p in predictions[len(found_document_ids):]]
+
+        results = []
+        text_start = 0
+        for (document_ids, texts) in requests:
+            text_end = text_start + len(texts)
+            missing = [doc_id for doc_id in document_ids if doc_id not in doc_map]
+            if missing:
+                results.append({"error": "Unable to find document with ID {}".format(missing[0])})
+            else:
+                results.append({
+                    "documents_by_id": {doc_id: predicted_documents_by_id[doc_id] for doc_id in document_ids},
+                    "texts": predicted_texts[text_start:text_end]
+                })
+            text_start = text_end
+        return results
@@ -4,6 +4,10 @@ import logging
 import math
 import random
 import typing
+from itertools import chain
+from operator import attrgetter, itemgetter
+
+import numpy as np
 
 from .pipeline import DocumentPredictionProbabilities
 
@@ -22,15 +26,16 @@ def rank(document_ids: typing.List[str], results: typing.List[DocumentPrediction
 
     #Dictionary method is inefficient as it runs every method before returning one
     '''
+    # look up the function first rather than building a dict of results, which would run every method
     return {
-        'lc':least_confidence(results),
-        'ma':largest_margin(results),
-        'en':entropy_rank(results),
-        'lcs':least_confidence_squared(results),
-        'lce':least_confidence_squared_by_entity(results),
-        'ra':random_rank(results),
-        'mlp':most_of_least_popular(results)
-    }[metric]
+        'lc': least_confidence_vectorized,
+        'ma': largest_margin_vectorized,
+        'en': entropy_rank_vectorized,
+        'lcs': least_confidence_squared_vectorized,
+        'lce': least_confidence_squared_by_entity_vectorized,
+        'ra': random_rank,
+        'mlp': most_of_least_popular
+    }[metric](document_ids, results)
     
 
 def least_confidence(document_ids: typing.List[str], results: typing.List[DocumentPredictionProbabilities]) -> typing.List[typing.Tuple[str, float]]:
@@ -196,3 +201,134 @@ def most_of_least_popular(document_ids: typing.List[str], results: typing.List[D
                 break
 
     return ranking
+
+
+# Array-backed versions of the ranking functions above.  The predictions of all documents are flattened into
+# arrays once, and every score is then computed for all entities and documents at once instead of entity by
+# entity.  Sums are accumulated in the same order as above (np.bincount adds in order), so the scores match
+# exactly except for squares and logarithms, where numpy and the math module can differ in the last bit.
+
+class PredictionArrays(object):
+    """The entity predictions of several documents as arrays.
+
+    Entity i belongs to document entity_docs[i] and has prediction_counts[i] predictions.  Its probabilities
+    and label indices (into label_names) are in row i of probabilities and labels, in the order the pipeline
+    gave them, padded with -inf and -1.
+    """
+
+    def __init__(self, results: typing.List[DocumentPredictionProbabilities]):
+        self.num_documents = len(results)
+        entity_counts = np.fromiter((len(result.ner) for result in results), dtype=np.intp, count=len(results))
+        ners = list(chain.from_iterable(result.ner for result in results))
+        self.entity_docs = np.repeat(np.arange(len(results)), entity_counts)
+        ner_predictions = list(map(attrgetter("predictions"), ners))
+        self.prediction_counts = np.fromiter(map(len, ner_predictions), dtype=np.intp, count=len(ners))
+
+        predictions = list(chain.from_iterable(ner_predictions))
+        flat_label_names = list(map(itemgetter(0), predictions))
+        self.label_names = list(dict.fromkeys(flat_label_names))
+        label_indices = {label: i for (i, label) in enumerate(self.label_names)}
+        flat_labels = np.fromiter(map(label_indices.__getitem__, flat_label_names), dtype=np.intp,
+                                  count=len(predictions))
+        flat_probabilities = np.fromiter(map(itemgetter(1), predictions), dtype=float, count=len(predictions))
+
+        max_predictions = int(self.prediction_counts.max()) if len(ners) else 0
+        rows = np.repeat(np.arange(len(ners)), self.prediction_counts)
+        columns = np.arange(len(predictions)) - np.repeat(np.cumsum(self.prediction_counts) - self.prediction_counts,
+                                                          self.prediction_counts)
+        self.probabilities = np.full((len(ners), max_predictions), -np.inf)
+        self.probabilities[rows, columns] = flat_probabilities
+        self.labels = np.full((len(ners), max_predictions), -1, dtype=np.intp)
+        self.labels[rows, columns] = flat_labels
+
+    def _sum_per_document(self, values: np.ndarray, entities: np.ndarray = None) -> np.ndarray:
+        docs = self.entity_docs if entities is None else self.entity_docs[entities]
+        return np.bincount(docs, weights=values, minlength=self.num_documents)
+
+    def _count_per_document(self, entities: np.ndarray = None) -> np.ndarray:
+        docs = self.entity_docs if entities is None else self.entity_docs[entities]
+        return np.bincount(docs, minlength=self.num_documents)
+
+    @staticmethod
+    def _average(totals: np.ndarray, counts: np.ndarray) -> np.ndarray:
+        return np.divide(totals, counts, out=np.zeros(len(totals)), where=counts > 0)
+
+    def highest_predictions(self) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """Returns the label index and probability of each entity's highest prediction, like get_highest_prediction."""
+        labels = self.labels[np.arange(len(self.labels)), np.argmax(self.probabilities, axis=1)] \
+            if self.probabilities.size else np.zeros(len(self.labels), dtype=np.intp)
+        return labels, self.probabilities.max(axis=1, initial=-np.inf)
+
+    def least_confidence(self) -> np.ndarray:
+        (_, highest) = self.highest_predictions()
+        return self._average(self._sum_per_document(highest), self._count_per_document())
+
+    def least_confidence_squared(self) -> np.ndarray:
+        (_, highest) = self.highest_predictions()
+        return self._average(self._sum_per_document(np.square(highest)), self._count_per_document())
+
+    def least_confidence_squared_by_entity(self) -> np.ndarray:
+        (labels, highest) = self.highest_predictions()
+        # one group per document and predicted label, in the order each label first appears in a document
+        keys = self.entity_docs * max(len(self.label_names), 1) + labels
+        (group_keys, first_entities, groups) = np.unique(keys, return_index=True, return_inverse=True)
+        group_averages = np.bincount(groups, weights=highest, minlength=len(group_keys)) / \
+            np.bincount(groups, minlength=len(group_keys))
+        group_order = np.argsort(first_entities, kind="stable")
+        group_docs = self.entity_docs[first_entities[group_order]]
+        totals = np.bincount(group_docs, weights=np.square(group_averages[group_order]), minlength=self.num_documents)
+        return self._average(totals, np.bincount(group_docs, minlength=self.num_documents))
+
+    def largest_margin(self) -> np.ndarray:
+        # if only most confident prediction is provided, cannot calculate margin
+        entities = np.flatnonzero(self.prediction_counts > 1)
+        top_two = -np.partition(-self.probabilities[entities], 1, axis=1)[:, :2] if len(entities) else np.zeros((0, 2))
+        return self._average(self._sum_per_document(top_two[:, 0] - top_two[:, 1], entities),
+                             self._count_per_document(entities))
+
+    def entropy(self, N=None) -> np.ndarray:
+        # if only most confident prediction is provided, cannot calculate entropy
+        entities = np.flatnonzero(self.prediction_counts > 1)
+        sorted_probabilities = -np.sort(-self.probabilities[entities], axis=1)
+        if N is not None:
+            sorted_probabilities = sorted_probabilities[:, :N]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            terms = np.where(np.isfinite(sorted_probabilities), sorted_probabilities * np.log(sorted_probabilities), 0.0)
+        # entropy_rank adds each entity's terms to a running total and negates it after every entity, so go
+        # through the k-th entities of all documents together to add things up in the same order
+        docs = self.entity_docs[entities]
+        counts = np.bincount(docs, minlength=self.num_documents)
+        positions = np.arange(len(entities)) - (np.cumsum(counts) - counts)[docs]
+        by_position = np.argsort(positions, kind="stable")
+        position_counts = np.bincount(positions)
+        position_ends = np.cumsum(position_counts)
+        entropies = np.zeros(self.num_documents)
+        for (start, end) in zip(position_ends - position_counts, position_ends):
+            at_position = by_position[start:end]
+            totals = entropies[docs[at_position]]
+            for column in range(terms.shape[1]):
+                totals += terms[at_position, column]
+            entropies[docs[at_position]] = -totals
+        return self._average(entropies, counts)
+
+def _rank_by_scores(document_ids: typing.List[str], scores: np.ndarray, reverse: bool = False) -> typing.List[typing.Tuple[str, float]]:
+    # stable, like list.sort (which also keeps equal items in order when reversed)
+    order = np.argsort(-scores if reverse else scores, kind="stable")
+    return [(document_ids[i], score) for (i, score) in zip(order.tolist(), scores[order].tolist())]
+
+def least_confidence_vectorized(document_ids: typing.List[str], results: typing.List[DocumentPredictionProbabilities]) -> typing.List[typing.Tuple[str, float]]:
+    return _rank_by_scores(document_ids, PredictionArrays(results).least_confidence())
+
+def least_confidence_squared_vectorized(document_ids: typing.List[str], results: typing.List[DocumentPredictionProbabilities]) -> typing.List[typing.Tuple[str, float]]:
+    return _rank_by_scores(document_ids, PredictionArrays(results).least_confidence_squared())
+
+def least_confidence_squared_by_entity_vectorized(document_ids: typing.List[str], results: typing.List[DocumentPredictionProbabilities]) -> typing.List[typing.Tuple[str, float]]:
+    return _rank_by_scores(document_ids, PredictionArrays(results).least_confidence_squared_by_entity())
+
+#WARNING: REQUIRES PROBABLITIES FOR ALL POSSIBLE LABELS PER TOKEN INSTEAD OF JUST MOST LIKELY
+def largest_margin_vectorized(document_ids: typing.List[str], results: typing.List[DocumentPredictionProbabilities]) -> typing.List[typing.Tuple[str, float]]:
+    return _rank_by_scores(document_ids, PredictionArrays(results).largest_margin())
+
+#WARNING: REQUIRES PROBABLITIES FOR ALL POSSIBLE LABELS PER TOKEN INSTEAD OF JUST MOST LIKELY
+def entropy_rank_vectorized(document_ids: typing.List[str], results: typing.List[DocumentPredictionProbabilities], N=None) -> typing.List[typing.Tuple[str, float]]:
+    return _rank_by_scores(document_ids, PredictionArrays(results).entropy(N), reverse=True)
@@ -12,8 +12,11 @@
 # **********************************************************************
 
 import atexit
+import collections
 import json
 import logging
+import os
+import socket
 import threading
 import traceback
 import typing
@@ -73,6 +76,12 @@ class ServiceListener(object):
     registration_poll = timedelta(seconds=config.SERVICE_REGISTRATION_FREQUENCY)  # re-register every x seconds
     listener_poll = timedelta(seconds=config.SERVICE_LISTENING_FREQUENCY)  # Listen to messages every x seconds
     processor_poll = timedelta(seconds=config.SERVICE_LISTENING_FREQUENCY)  # Listen to queue every x seconds
+    # If blocking, jobs are picked up as soon as they arrive and the polls are only how often the exit events
+    # are checked
+    blocking = config.SERVICE_LISTENING_BLOCKING
+    predict_batch_window = timedelta(seconds=config.SERVICE_PREDICT_BATCH_WINDOW)  # Wait for more predict jobs for x seconds
+    predict_batch_size = config.SERVICE_PREDICT_BATCH_SIZE
+    reclaim_poll = timedelta(seconds=config.SERVICE_RECLAIM_FREQUENCY)  # Reclaim jobs from crashed workers every x seconds
     processing_limit = timedelta(minutes=config.SERVICE_HANDLER_TIMEOUT)  # Timeout for processing a job...
 
     # Scheduled Keys
@@ -80,16 +89,26 @@ class ServiceListener(object):
     processing_queue_key_timeout = timedelta(seconds=config.SERVICE_HANDLER_TIMEOUT * 2)  # Timeout for queueing processing a job...
     results_queue_key = config.REDIS_PREFIX + config.PIPELINE + ":work-results"
     results_queue_key_timeout_s = config.SERVICE_HANDLER_TIMEOUT * 2
+    progress_stream_key = config.REDIS_PREFIX + config.PIPELINE + ":work-progress"
+    progress_stream_maxlen = 1000  # (approximate) number of progress updates kept per job
     running_jobs_key = config.REDIS_PREFIX + config.PIPELINE + ":running-jobs"
     classifiers_training_key = config.REDIS_PREFIX + config.PIPELINE + ":classifiers-training"
 
+    # Work Streams (must match the backend's ServiceManager)
+    # "<prefix>:registration:work-stream:<service_name>" <-- STREAM of jobs, read through the consumer group
+    # "<prefix>:registration:consumers:<consumer_name>" <-- heartbeat of a live consumer, expires if it crashes
+    work_stream_key_prefix = config.REDIS_PREFIX + "registration:work-stream:"
+    work_stream_group = "pipelines"
+    consumer_key_prefix = config.REDIS_PREFIX + "registration:consumers:"
+    consumer_key_timeout = reclaim_poll * 3
+
+    # Next Instances (must match the backend's NextInstanceQueues)
+    # "<prefix>:next-instances:<classifier_id>:reload" <-- set after a training writes a new ranking to eve
+    next_instances_key_prefix = config.REDIS_PREFIX + "next-instances:"
+
     # Mutexes Keys
     processing_lock_key = config.REDIS_PREFIX + "locks:processing"
     processing_lock_key_timeout = timedelta(minutes=config.SERVICE_HANDLER_TIMEOUT)
-    preprocessing_lock_key = config.REDIS_PREFIX + "locks:preprocessing"
-    preprocessing_lock_key_timeout = int(timedelta(seconds=config.SERVICE_HANDLER_TIMEOUT).total_seconds())
-    preprocessing_worker_lock_key = config.REDIS_PREFIX + "locks:preprocessing_worker"
-    preprocessing_worker_lock_key_timeout = int(timedelta(seconds=config.SERVICE_HANDLER_TIMEOUT).total_seconds())
 
     # Channels
     registration_channel = config.SERVICE_REGISTRATION_CHANNEL or "registration"
@@ -100,21 +119,25 @@ class ServiceListener(object):
         """
         self.is_running = False
         self.registration_exit_event = threading.Event()
-        self.channel_exit_event = threading.Event()
         self.listener_exit_event = threading.Event()
         self.queue_processor_exit_event = threading.Event()
         self.registration_thread = None
-        self.channel_thread = None
         self.listener_thread = None
         self.queue_processor_thread = None
-        self.r_pubsub = self.r_conn.pubsub(ignore_subscribe_messages=True)
         self.services = services if isinstance(services, list) else list()
+        # every pipeline container (and process) is its own consumer in the consumer group, and keeps
+        # the jobs it has read but not yet started in its own queue so that crashes can't lose them
+        self.consumer_name = "{}:{}".format(socket.gethostname(), os.getpid())
+        self.consumer_key = self.consumer_key_prefix + self.consumer_name
+        self.processing_queue_key = self.processing_queue_key + ":" + self.consumer_name
+        self.work_stream_keys = [self.work_stream_key_prefix + service.name for service in self.services]
+        # jobs taken off the processing queue while collecting a batch of other jobs
+        self._deferred_jobs = collections.deque()
         # make sure things are stopped properly
         atexit.register(self.stop_workers)
 
     def start_workers(self):
         is_registration_thread_alive = isinstance(self.registration_thread, threading.Thread) and self.registration_thread.is_alive()
-        is_channel_thread_alive = isinstance(self.channel_thread, threading.Thread) and self.channel_thread.is_alive()
         is_listener_thread_alive = isinstance(self.listener_thread, threading.Thread) and self.listener_thread.is_alive()
         is_queue_processor_alive = isinstance(self.queue_processor_thread, threading.Thread) and self.queue_processor_thread.is_alive()
         if not is_registration_thread_alive:
@@ -124,15 +147,11 @@ class ServiceListener(object):
             # Start Registration Thread
             self.registration_thread = threading.Thread(target=self._start_registration_task, name="Active Learning Redis Registration Worker", daemon=True)
             self.registration_thread.start()
-        if not is_channel_thread_alive:
-            logger.info("Starting Channel Watchdog")
-            # Clear Exit Event
-            self.channel_exit_event.clear()
-            # Start Channel Watchdog Thread
-            self.channel_thread = threading.Thread(target=self._start_channel_task, name="Active Learning Redis Channel Worker", daemon=True)
-            self.channel_thread.start()
         if not is_listener_thread_alive:
             logger.info("Starting Message Listener")
+            # pick up where a previous run with the same consumer name left off
+            self._create_consumer_groups()
+            self._recover_pending_jobs()
             # Clear Exit Event
             self.listener_exit_event.clear()
             # Start Listener Thread
@@ -149,17 +168,12 @@ class ServiceListener(object):
 
     def stop_workers(self):
         is_registration_thread_alive = isinstance(self.registration_thread, threading.Thread) and self.registration_thread.is_alive()
-        is_channel_thread_alive = isinstance(self.channel_thread, threading.Thread) and self.channel_thread.is_alive()
         is_listener_thread_alive = isinstance(self.listener_thread, threading.Thread) and self.listener_thread.is_alive()
         is_queue_processor_alive = isinstance(self.queue_processor_thread, threading.Thread) and self.queue_processor_thread.is_alive()
         if is_registration_thread_alive:
             logger.info("Exiting Registration Worker")
             self.registration_exit_event.set()
             self.registration_thread.join()
-        if is_channel_thread_alive:
-            logger.info("Exiting Channel Watchdog")
-            self.channel_exit_event.set()
-            self.channel_thread.join()
         if is_listener_thread_alive:
             logger.info("Exiting Message Listener")
             self.listener_exit_event.set()
@@ -171,63 +185,96 @@ class ServiceListener(object):
         # clear-out any redis-locks...
         if self.r_conn.exists(self.processing_lock_key):
             self.r_conn.delete(self.processing_lock_key)
-        if self.r_conn.exists(self.preprocessing_lock_key):
-            self.r_conn.delete(self.preprocessing_lock_key)
         self.is_running = False
 
-    def pre_process_message(self, message_channel, message_data):
+    def pre_process_message(self, stream_key, entry_id, entry_fields):
         """
-        :type message_channel: str
-        :type message_data: str | bytes
+        :type stream_key: str
+        :type entry_id: str
+        :type entry_fields: dict
         :rtype: bool | dict
         """
         try:
-            decoded_message = json.loads(message_data)
+            decoded_message = json.loads(pydash.get(entry_fields, "job", None))
         except (json.JSONDecodeError, TypeError):
             logger.warning("Invalid Processing Message")
             return False
-        publish_job_id = pydash.get(decoded_message, "job_id", None)
-        publish_job_type = pydash.get(decoded_message, "job_type", None)
-        publish_job_queue = pydash.get(decoded_message, "job_queue", None)
-        is_valid_msg = isinstance(publish_job_id, str) and publish_job_type == "request" and isinstance(publish_job_queue, str)
+        job_id = pydash.get(decoded_message, "job_id", None)
+        job_type = pydash.get(decoded_message, "job_type", None)
+        job_data = pydash.get(decoded_message, "job_data", None)
+        is_valid_msg = isinstance(job_id, str) and job_type == "request" and isinstance(job_data, dict)
         if not is_valid_msg:
             logger.warning("Invalid Processing Message")
             return False
+        logger.info("New Job with id %s received over stream %s", job_id, stream_key)
+        job_data.update({"job_id": job_id, "job_queue": stream_key, "job_entry_id": entry_id})  # making sure it has the proper Job ID
+        return job_data
 
-        with self.r_conn.lock(self.preprocessing_lock_key, timeout=self.preprocessing_lock_key_timeout):
-            logger.info("Received new job to process with id %s", publish_job_id)
-            queue_data = self.r_conn.lrange(publish_job_queue, 0, -1)
-            idx_found = None
-            for idx, data in enumerate(queue_data):
-                try:
-                    decoded_message = json.loads(data)
-                    job_id = pydash.get(decoded_message, "job_id", None)
-                    if job_id == publish_job_id:
-                        idx_found = idx
-                except (json.JSONDecodeError, TypeError):
+    def _create_consumer_groups(self):
+        for stream_key in self.work_stream_keys:
+            try:
+                self.r_conn.xgroup_create(stream_key, self.work_stream_group, id="0", mkstream=True)
+            except redis.ResponseError as e:
+                if not str(e).startswith("BUSYGROUP"):  # group already exists
+                    raise
+
+    def _queue_job(self, stream_key, entry_id, entry_fields):
+        job_details = self.pre_process_message(stream_key, entry_id, entry_fields)
+        if not job_details:
+            # it can never be processed, so don't leave it pending
+            self.acknowledge_job(stream_key, entry_id)
+            return
+        logger.info("Adding Job with ID %s to Service Queue", job_details["job_id"])
+        self.r_conn.rpush(self.processing_queue_key, json.dumps(job_details, separators=(",", ":")))
+        self.r_conn.expire(self.processing_queue_key, self.processing_queue_key_timeout)
+
+    def acknowledge_job(self, stream_key, entry_id):
+        with self.r_conn.pipeline() as pipe:
+            pipe.xack(stream_key, self.work_stream_group, entry_id)
+            pipe.xdel(stream_key, entry_id)
+            pipe.execute()
+
+    def _recover_pending_jobs(self):
+        """
+        Re-queues the jobs that this consumer had read but not acknowledged before it was restarted.
+        """
+        self.r_conn.delete(self.processing_queue_key)
+        streams = self.r_conn.xreadgroup(self.work_stream_group, self.consumer_name,
+                                         {stream_key: "0" for stream_key in self.work_stream_keys})
+        for (stream_key, entries) in streams or []:
+            for (entry_id, entry_fields) in entries:
+                logger.warning("Recovering job %s", entry_id)
+                self._queue_job(stream_key, entry_id, entry_fields or {})
+
+    def _reclaim_pending_jobs(self):
+        """
+        Claims the jobs that consumers without a heartbeat (i.e. crashed pipeline containers) had read but
+        not acknowledged, and queues them for processing here.
+        """
+        for stream_key in self.work_stream_keys:
+            for consumer in self.r_conn.xinfo_consumers(stream_key, self.work_stream_group):
+                consumer_name = consumer["name"]
+                if consumer_name == self.consumer_name or self.r_conn.exists(self.consumer_key_prefix + consumer_name):
                     continue
-            if not isinstance(idx_found, int):
-                logger.warning("Unable to find message in the Queue")
-                return False
-            self.r_conn.lset(publish_job_queue, idx_found, b"TO_BE_DELETED")
-            self.r_conn.lrem(publish_job_queue, 1, b"TO_BE_DELETED")
-
-        final_job_data = queue_data[idx_found]
-        try:
-            decoded_message = json.loads(final_job_data)
-        except (json.JSONDecodeError, TypeError):
-            logger.warning("Invalid Processing Message in Queue")
-            return False
-
-        job_id = pydash.get(decoded_message, "job_id", None)
-        job_data = pydash.get(decoded_message, "job_data", None)
-        valid_queued_job = isinstance(job_id, str) and isinstance(job_data, dict) and job_id == publish_job_id
-        if not valid_queued_job:
-            logger.warning("Invalid Processing Message in Queue")
-            return False
-        logger.info("New Job received over channel %s", message_channel)
-        job_data.update({"job_id": job_id, "job_channel": message_channel, "job_queue": publish_job_queue})  # making sure it has the proper Job ID
-        return job_data
+                if consumer["pending"] > 0:
+                    pending = self.r_conn.xpending_range(stream_key, self.work_stream_group, "-", "+",
+                                                         consumer["pending"], consumername=consumer_name)
+                    # the idle time guards against another consumer that claimed the same jobs just now
+                    entry_ids = self.r_conn.xclaim(stream_key, self.work_stream_group, self.consumer_name,
+                                                   int(self.reclaim_poll.total_seconds() * 1000),
+                                                   [entry["message_id"] for entry in pending], justid=True)
+                    for entry_id in entry_ids:
+                        logger.warning("Reclaiming job %s from consumer %s", entry_id, consumer_name)
+                        entries = self.r_conn.xrange(stream_key, entry_id, entry_id, count=1)
+                        if entries:
+                            self._queue_job(stream_key, *entries[0])
+                        else:
+                            # trimmed from the stream
+                            self.acknowledge_job(stream_key, entry_id)
+                remaining = self.r_conn.xpending_range(stream_key, self.work_stream_group, "-", "+", 1,
+                                                       consumername=consumer_name)
+                if not remaining:
+                    self.r_conn.xgroup_delconsumer(stream_key, self.work_stream_group, consumer_name)
 
     @staticmethod
     def do_with_redis(callback: typing.Callable[[redis.StrictRedis], typing.Any]):
@@ -260,6 +307,24 @@ class ServiceListener(object):
                 local_redis.expire(response_key, timedelta(seconds=expire_timeout))
         ServiceListener.do_with_redis(callback)
 
+    @staticmethod
+    def push_progress(job_id: str, progress: dict, expire_timeout=results_queue_key_timeout_s):
+        """
+        Adds a progress update to the job's progress stream.  Unlike results, progress is best-effort, doesn't
+        take the processing lock, and is never consumed so that several clients can follow the same job.
+        """
+        progress_key = ServiceListener.progress_stream_key + ":" + job_id
+        try:
+            with ServiceListener.r_conn.pipeline() as pipe:
+                # default=float because some pipelines report numpy losses
+                pipe.xadd(progress_key, {"progress": json.dumps(progress, separators=(",", ":"), default=float)},
+                          maxlen=ServiceListener.progress_stream_maxlen, approximate=True)
+                if expire_timeout != None and expire_timeout > 0:
+                    pipe.expire(progress_key, timedelta(seconds=expire_timeout))
+                pipe.execute()
+        except redis.RedisError:
+            logger.exception("Unable to push progress for job %s", job_id)
+
     @staticmethod
     def wait_until_classifier_isnt_training(classifier_id: str, job_id: str):
         def callback(local_redis: redis.StrictRedis) -> bool:
@@ -277,6 +342,12 @@ class ServiceListener(object):
             return local_redis.hdel(ServiceListener.classifiers_training_key, classifier_id)
         return ServiceListener.do_with_redis(callback)
 
+    @staticmethod
+    def reload_next_instances(classifier_id: str):
+        def callback(local_redis: redis.StrictRedis):
+            return local_redis.set(ServiceListener.next_instances_key_prefix + classifier_id + ":reload", 1)
+        return ServiceListener.do_with_redis(callback)
+
     @staticmethod
     def process_message(job_id: str, job_details):
         logger.info("process_message starting for job %s", job_id)
@@ -293,17 +364,23 @@ class ServiceListener(object):
                 ServiceListener.wait_until_classifier_isnt_training(classifier_id, job_id)
                 results_expire_timeout = pydash.get(job_details, "results_expire_timeout",
                                                     ServiceListener.results_queue_key_timeout_s)
+                def progress(update: dict):
+                    ServiceListener.push_progress(job_id, update, results_expire_timeout)
                 try:
                     logger.info("fit %s running", job_id)
                     pipeline = ner_api()
-                    results = pipeline.train_model(model_name, classifier_id, job_framework)
+                    results = pipeline.train_model(model_name, classifier_id, job_framework, progress=progress)
                     logger.info("fit %s finished", job_id)
+                    if pydash.get(results, "updated_objects.next_instances"):
+                        ServiceListener.reload_next_instances(classifier_id)
                     ServiceListener.push_results(job_id, results, results_expire_timeout)
+                    progress({"stage": "done"})
                 except Exception as e:
                     results = {
                         "error": str(e)
                     }
                     ServiceListener.push_results(job_id, results, results_expire_timeout)
+                    progress({"stage": "error", "error": str(e)})
                     raise e
                 finally:
                     ServiceListener.classifier_is_done_training(classifier_id)
@@ -343,6 +420,27 @@ class ServiceListener(object):
             logger.exception("Exception processing %s job", job_type)
             raise e
 
+    @staticmethod
+    def process_predict_batch(jobs: typing.List[dict]):
+        """
+        Runs the predict jobs, which are all for the same classifier, as a single batch and pushes each job's results.
+        """
+        job_ids = [job["job_id"] for job in jobs]
+        logger.info("predict batch %s running", job_ids)
+        job_framework = pydash.get(jobs[0], "framework", None)
+        classifier_id = pydash.get(jobs[0], "classifier_id", None)
+        requests = [(pydash.get(job, "document_ids", []), pydash.get(job, "texts", [])) for job in jobs]
+        try:
+            pipeline = ner_api()
+            results = pipeline.predict_batch(classifier_id, job_framework, requests)
+        except Exception as e:
+            logger.exception("Exception processing predict batch")
+            results = [{"error": str(e)}] * len(jobs)
+        for (job, job_results) in zip(jobs, results):
+            ServiceListener.push_results(job["job_id"], job_results,
+                                         pydash.get(job, "results_expire_timeout", ServiceListener.results_queue_key_timeout_s))
+        logger.info("predict batch %s finished", job_ids)
+
     def _start_registration_task(self):
         while not self.registration_exit_event.is_set():
             for service in self.services:
@@ -350,59 +448,114 @@ class ServiceListener(object):
                 self.r_conn.publish(self.registration_channel, registration_msg)
             self.registration_exit_event.wait(self.registration_poll.seconds)
 
-    def _start_channel_task(self):
-        while not self.channel_exit_event.is_set():
-            should_resubscribe = len(self.r_pubsub.channels) < len(self.services)
-            if should_resubscribe:
-                for service in self.services:
-                    # Skip registration channel
-                    if service.channel == self.registration_channel:
-                        continue
-                    if service.channel not in self.r_pubsub.channels:
-                        self.r_pubsub.subscribe(service.channel)
-            self.channel_exit_event.wait(self.listener_poll.seconds)
-
     def _start_listener_task(self):
+        next_reclaim = 0
         while not self.listener_exit_event.is_set():
-            if not self.r_pubsub.subscribed:
+            if time.monotonic() >= next_reclaim:
+                self.r_conn.setex(self.consumer_key, self.consumer_key_timeout, self.consumer_name)
+                self._reclaim_pending_jobs()
+                next_reclaim = time.monotonic() + self.reclaim_poll.total_seconds()
+            try:
+                streams = self.r_conn.xreadgroup(self.work_stream_group, self.consumer_name,
+                                                 {stream_key: ">" for stream_key in self.work_stream_keys}, count=1,
+                                                 block=max(1, int(self.listener_poll.total_seconds() * 1000)) if self.blocking else None)
+            except redis.ResponseError as e:
+                if not str(e).startswith("NOGROUP"):
+                    raise
+                # the stream was deleted from under us
+                self._create_consumer_groups()
+                continue
+            for (stream_key, entries) in streams or []:
+                for (entry_id, entry_fields) in entries:
+                    self._queue_job(stream_key, entry_id, entry_fields)
+            if not self.blocking:
                 self.listener_exit_event.wait(self.listener_poll.seconds)
+
+    def _decode_job(self, msg_in_queue):
+        try:
+            job_details = json.loads(msg_in_queue)
+        except (json.JSONDecodeError, TypeError):
+            logger.warning("Invalid Job Details Message")
+            return None
+        if "job_id" not in job_details:
+            job_details["job_id"] = str(uuid.uuid4())
+        return job_details
+
+    def _pop_job(self):
+        """
+        Returns the next job to process, or None if there isn't one yet.
+        """
+        if self._deferred_jobs:
+            return self._deferred_jobs.popleft()
+        if self.blocking:
+            popped = self.r_conn.blpop(self.processing_queue_key, timeout=max(1, int(self.processor_poll.total_seconds())))
+            msg_in_queue = popped[1] if popped else None
+        else:
+            msg_in_queue = self.r_conn.lpop(self.processing_queue_key)
+        return self._decode_job(msg_in_queue) if msg_in_queue else None
+
+    def _is_batchable(self, job_details) -> bool:
+        return self.predict_batch_window.total_seconds() > 0 and self.predict_batch_size > 1 and \
+            pydash.get(job_details, "type", None) == "predict" and bool(pydash.get(job_details, "classifier_id", None))
+
+    def _collect_predict_batch(self, job_details) -> typing.List[dict]:
+        """
+        Collects the predict jobs for the same classifier that arrive within the batch window.  Other jobs are
+        deferred until the batch has been scheduled.
+        """
+        batch_key = (job_details.get("classifier_id"), job_details.get("framework"))
+        batch = [job_details]
+        deadline = time.monotonic() + self.predict_batch_window.total_seconds()
+        while len(batch) < self.predict_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            msg_in_queue = self.r_conn.lpop(self.processing_queue_key)
+            if not msg_in_queue:
+                self.queue_processor_exit_event.wait(min(remaining, 0.005))
+                continue
+            other_details = self._decode_job(msg_in_queue)
+            if other_details is None:
                 continue
-            msg = self.r_pubsub.get_message()
-            valid_msg = msg and "type" in msg and "channel" in msg and "data" in msg
-            if valid_msg and msg["type"] == "message":
-                job_details = self.pre_process_message(msg["channel"], msg["data"])
-                if job_details:
-                    logger.info("Adding Job with ID %s to Service Queue", job_details["job_id"])
-                    self.r_conn.rpush(self.processing_queue_key, json.dumps(job_details, separators=(",", ":")))
-                    self.r_conn.expire(self.processing_queue_key, self.processing_queue_key_timeout)
-            self.listener_exit_event.wait(self.listener_poll.seconds)
+            if self._is_batchable(other_details) and \
+                    (other_details.get("classifier_id"), other_details.get("framework")) == batch_key:
+                batch.append(other_details)
+            else:
+                self._deferred_jobs.append(other_details)
+        return batch
+
+    def _schedule_jobs(self, pool, jobs: typing.List[dict]):
+        job_ids = [job["job_id"] for job in jobs]
+        try:
+            logger.info("Received job ids/details: %s/%s", job_ids, jobs)
+            self.r_conn.sadd(self.running_jobs_key, *job_ids)
+            if len(jobs) == 1:
+                future = pool.schedule(ServiceListener.process_message, args=(job_ids[0], jobs[0]))
+            else:
+                future = pool.schedule(ServiceListener.process_predict_batch, args=(jobs,))
+            logger.debug("Got future for %s: %s", job_ids, future)
+            def finished(f):
+                logger.info("Jobs %s have finished; removing from running jobs list", job_ids)
+                self.r_conn.srem(self.running_jobs_key, *job_ids)
+                for job in jobs:
+                    self.acknowledge_job(job["job_queue"], job["job_entry_id"])
+            future.add_done_callback(finished)
+        except Exception:
+            logger.exception("Exception processing message")
 
     def _start_queue_processor_task(self):
-        with ProcessPool(max_workers=config.REDIS_MAX_PROCESSES) as pool:
-            self.r_conn.delete(self.running_jobs_key) # clear out running jobs since this is a new startup
+        # the worker processes are never recycled (max_tasks=0) so that their model caches stay warm between jobs
+        with ProcessPool(max_workers=config.REDIS_MAX_PROCESSES, max_tasks=0) as pool:
             while not self.queue_processor_exit_event.is_set():
-                msg_in_queue = self.r_conn.lpop(self.processing_queue_key)
-                if not msg_in_queue:
-                    self.queue_processor_exit_event.wait(self.processor_poll.seconds)
-                    continue
-                try:
-                    job_details = json.loads(msg_in_queue)
-                except (json.JSONDecodeError, TypeError):
-                    logger.warning("Invalid Job Details Message")
+                job_details = self._pop_job()
+                if not job_details:
+                    if not self.blocking:
+                        self.queue_processor_exit_event.wait(self.processor_poll.seconds)
                     continue
-                if "job_id" not in job_details:
-                    job_details["job_id"] = str(uuid.uuid4())
-                job_id = pydash.get(job_details, "job_id")
-                try:
-                    logger.info("Received job id/details: %s/%s", job_id, job_details)
-                    self.r_conn.sadd(self.running_jobs_key, job_id)
-                    future = pool.schedule(ServiceListener.process_message, args=(job_id, job_details))
-                    logger.debug("Got future for %s: %s", job_id, future)
-                    def finished(f):
-                        logger.info("Job %s has finished; removing from running jobs list", job_id)
-                        self.r_conn.srem(self.running_jobs_key, job_id)
-                    future.add_done_callback(finished)
-                except Exception:
-                    logger.exception("Exception processing message")
-                    
-                self.queue_processor_exit_event.wait(self.processor_poll.seconds)
+                if self._is_batchable(job_details):
+                    self._schedule_jobs(pool, self._collect_predict_batch(job_details))
+                else:
+                    self._schedule_jobs(pool, [job_details])
+
+                if not self.blocking:
+                    self.queue_processor_exit_event.wait(self.processor_poll.seconds)
@@ -0,0 +1,137 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+"""
+Incremental ranking of the documents that haven't been annotated yet.
+
+After every training, the unannotated documents are ranked so that the ones the model is least confident
+about are annotated first.  Scoring a document means running the model over it, so for large collections
+scoring every document after every training takes much longer than the training itself.  Annotators only
+ever work through the front of the ranking before the next training, so most of those scores are wasted.
+
+IncrementalRanker keeps the scores and ranking of each classifier on disk.  After a training it scores a
+rotating sample of the documents and compares the scores with the cached ones:
+
+* if they moved more than RANKING_MAX_SCORE_CHANGE on average (or there's no cache yet), the model has
+  changed too much and every document is scored and sorted, like before;
+* otherwise only the cached top RANKING_TOP_K documents and any new documents are scored again.  The new
+  top K are selected with a heap and the rest of the documents keep their previous order.
+
+Since the sample rotates through all documents, every cached score is refreshed every so often anyway.
+"""
+
+import heapq
+import logging
+import os
+import typing
+
+import srsly
+
+from . import RankingFunctions as rank
+from .pmap_ner import NER
+from .shared.config import ConfigBuilder
+
+logger = logging.getLogger(__name__)
+config = ConfigBuilder.get_config()
+
+class IncrementalRanker(object):
+    # increase if the file format or the ranking function change, so old caches aren't used
+    version = 1
+
+    def __init__(self, filename: str, top_k: int = config.RANKING_TOP_K, sample_size: int = config.RANKING_SAMPLE_SIZE,
+                 max_score_change: float = config.RANKING_MAX_SCORE_CHANGE):
+        self.filename = filename
+        self.top_k = top_k
+        self.sample_size = sample_size
+        self.max_score_change = max_score_change
+        # document ID -> score (lower is ranked first)
+        self.scores: typing.Dict[str, float] = {}
+        # the last ranking
+        self.order: typing.List[str] = []
+        # where the next rotating sample starts
+        self.cursor = 0
+
+    def load(self) -> bool:
+        """Loads the cached scores from disk, returning whether there were usable ones."""
+        if not os.path.isfile(self.filename):
+            return False
+        try:
+            data = srsly.read_msgpack(self.filename)
+            if data["version"] != self.version:
+                return False
+            self.scores = dict(zip(data["ids"], data["scores"]))
+            self.order = data["order"]
+            self.cursor = data["cursor"]
+            return True
+        except Exception:
+            logger.exception("Unable to load ranking cache {}; ranking all documents".format(self.filename))
+            self.scores = {}
+            self.order = []
+            self.cursor = 0
+            return False
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        temp_filename = "{}.{}.tmp".format(self.filename, os.getpid())
+        srsly.write_msgpack(temp_filename, {
+            "version": self.version,
+            "ids": list(self.scores.keys()),
+            "scores": list(self.scores.values()),
+            "order": self.order,
+            "cursor": self.cursor
+        })
+        os.replace(temp_filename, self.filename)
+
+    @staticmethod
+    def _score(model: NER, doc_map: typing.Dict[str, str], doc_ids: typing.List[str]) -> typing.Dict[str, float]:
+        if not doc_ids:
+            return {}
+        results = model.predict_proba([doc_map[doc_id] for doc_id in doc_ids])
+        return dict(rank.least_confidence_squared_vectorized(doc_ids, results))
+
+    def _get_sample(self, doc_ids: typing.List[str]) -> typing.List[str]:
+        start = self.cursor % len(doc_ids)
+        self.cursor = (start + self.sample_size) % len(doc_ids)
+        return (doc_ids[start:] + doc_ids[:start])[:self.sample_size]
+
+    def rank(self, model: NER, doc_map: typing.Dict[str, str], doc_ids: typing.List[str]) -> typing.List[str]:
+        """Returns the given document IDs in the order they should be annotated in.
+
+        :param model: NER model
+        :param doc_map: dict: mapping of document IDs to document text
+        :param doc_ids: list: IDs of the documents to rank
+        """
+        doc_ids = sorted(doc_ids)
+        cached_scores = {doc_id: self.scores[doc_id] for doc_id in doc_ids if doc_id in self.scores}
+
+        if self.top_k <= 0 or len(doc_ids) <= self.top_k + self.sample_size or not cached_scores:
+            self.scores = self._score(model, doc_map, doc_ids)
+            self.order = sorted(doc_ids, key=self.scores.get)
+            return self.order
+
+        sample_scores = self._score(model, doc_map, self._get_sample(doc_ids))
+        compared_ids = [doc_id for doc_id in sample_scores if doc_id in cached_scores]
+        score_change = sum(abs(sample_scores[doc_id] - cached_scores[doc_id]) for doc_id in compared_ids) / \
+            len(compared_ids) if compared_ids else float("inf")
+
+        if score_change > self.max_score_change:
+            logger.info("Ranking all {} documents (scores changed by {:.3f} on average)".format(len(doc_ids), score_change))
+            self.scores = dict(sample_scores, **self._score(model, doc_map,
+                                                            [doc_id for doc_id in doc_ids if doc_id not in sample_scores]))
+            self.order = sorted(doc_ids, key=self.scores.get)
+            return self.order
+
+        # the model hasn't changed much, so only what's likely to be annotated next needs to be scored again
+        cached_top_ids = heapq.nsmallest(self.top_k, cached_scores, key=cached_scores.get)
+        rescore_ids = [doc_id for doc_id in cached_top_ids if doc_id not in sample_scores] + \
+                      [doc_id for doc_id in doc_ids if doc_id not in cached_scores and doc_id not in sample_scores]
+        logger.info("Ranking {} of {} documents (scores changed by {:.3f} on average)".format(
+            len(sample_scores) + len(rescore_ids), len(doc_ids), score_change))
+        self.scores = dict(cached_scores, **sample_scores)
+        self.scores.update(self._score(model, doc_map, rescore_ids))
+
+        top_ids = heapq.nsmallest(self.top_k, doc_ids, key=self.scores.get)
+        ranked_ids = set(top_ids)
+        self.order = top_ids + [doc_id for doc_id in self.order if doc_id in self.scores and doc_id not in ranked_ids]
+        ranked_ids.update(self.order)
+        self.order += [doc_id for doc_id in doc_ids if doc_id not in ranked_ids]
+        return self.order
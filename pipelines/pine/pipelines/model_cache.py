@@ -0,0 +1,90 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+"""
+Per-process cache of loaded models.
+
+Loading a trained model from disk is the most expensive part of a predict job (spaCy models, JVM
+class lookups for CoreNLP/OpenNLP, whole transformers for simpletransformers), so each pipeline worker
+process keeps the models it has loaded in a least-recently-used cache.  Models are keyed by classifier
+ID and model filename; since training always writes a new filename, a newly trained model is never
+confused with a stale one, and loading it evicts the classifier's older models.
+
+The size of a model in memory isn't known, so its size on disk is used to keep the cache within its
+budget.  MODEL_CACHE_MAX_MB is the budget of the whole container, so each of the REDIS_MAX_PROCESSES
+worker processes gets its share of it.
+"""
+
+import collections
+import functools
+import logging
+import os
+import threading
+import typing
+
+from .pmap_ner import NER
+from .shared.config import ConfigBuilder
+
+logger = logging.getLogger(__name__)
+config = ConfigBuilder.get_config()
+
+def _disk_size(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    size = 0
+    for (dirpath, _, filenames) in os.walk(path):
+        for filename in filenames:
+            size += os.path.getsize(os.path.join(dirpath, filename))
+    return size
+
+class ModelCache(object):
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        # (classifier_id, model_filename) -> (NER, size)
+        self._models: typing.Dict[typing.Tuple[str, str], typing.Tuple[NER, int]] = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, classifier_id: str, pipeline_name: str, model_filename: str) -> NER:
+        """Returns the classifier's model from the cache, loading it from disk if it isn't there."""
+        key = (classifier_id, model_filename)
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key][0]
+        classifier = NER(pipeline_name)
+        classifier.load_model(model_filename)
+        logger.info("Loaded classifier {} from {}".format(classifier_id, model_filename))
+        self.put(classifier_id, model_filename, classifier)
+        return classifier
+
+    def put(self, classifier_id: str, model_filename: str, classifier: NER):
+        """Adds a loaded (or just trained) model, evicting the classifier's other models."""
+        if self.max_bytes <= 0:
+            return
+        size = _disk_size(model_filename)
+        with self._lock:
+            self.invalidate(classifier_id)
+            if size > self.max_bytes:
+                logger.info("Not caching classifier {}: {} bytes is over the budget".format(classifier_id, size))
+                return
+            self._models[(classifier_id, model_filename)] = (classifier, size)
+            self.num_bytes += size
+            while self.num_bytes > self.max_bytes:
+                (evicted, (_, evicted_size)) = self._models.popitem(last=False)
+                self.num_bytes -= evicted_size
+                logger.info("Evicted classifier {} from {}".format(*evicted))
+
+    def invalidate(self, classifier_id: str):
+        """Removes all of the classifier's models."""
+        with self._lock:
+            for key in [key for key in self._models if key[0] == classifier_id]:
+                (_, size) = self._models.pop(key)
+                self.num_bytes -= size
+
+MODELS = ModelCache(config.MODEL_CACHE_MAX_MB * 2 ** 20 // max(1, config.REDIS_MAX_PROCESSES))
+
+@functools.lru_cache(maxsize=None)
+def get_untrained_pipeline(pipeline_name: str) -> NER:
+    """Returns a shared, untrained instance of the pipeline, e.g. for its status.  Don't fit it."""
+    return NER(pipeline_name)
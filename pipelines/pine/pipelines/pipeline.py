@@ -41,6 +41,11 @@ class StatMetrics(object):
         return {"precision": self.precision, "recall": self.recall, "f1": self.f1, "TP": self.tp,
                 "FP": self.fp, "FN": self.fn, "TN": self.tn, "acc": self.acc}
 
+    @staticmethod
+    def deserialize(d: dict) -> "StatMetrics":
+        return StatMetrics(precision=d["precision"], recall=d["recall"], f1=d["f1"], tp=d["TP"],
+                           fp=d["FP"], fn=d["FN"], tn=d["TN"], acc=d["acc"])
+
 class EvaluationMetrics(object):
     
     def __init__(self):
@@ -61,6 +66,14 @@ class EvaluationMetrics(object):
         d["Totals"] = self.totals.serialize()
         return d
 
+    @staticmethod
+    def deserialize(d: dict) -> "EvaluationMetrics":
+        metrics = EvaluationMetrics()
+        metrics.labels = {key: StatMetrics.deserialize(d[key]) for key in d if key != "Totals"}
+        if "Totals" in d:
+            metrics.totals = StatMetrics.deserialize(d["Totals"])
+        return metrics
+
 class NerPrediction(object):
     def __init__(self, offset_start: int, offset_end: int, label: str):
         self.offset_start: int = offset_start
@@ -121,6 +134,8 @@ class Pipeline(object, metaclass=abc.ABCMeta):
 
     # fit(X, y)
     # internal state is changed
+    # params may include "progress", a callable that pipelines can call with a dict of training progress
+    # (e.g. {"iteration": 1, "iterations": 100, "losses": {...}}); pipelines that don't report progress ignore it
     @abc.abstractmethod
     def fit(self, X: typing.Iterable[str], y, all_labels: typing.Iterable[str], **params) -> dict:
         raise NotImplementedError('Must define fit to use Pipeline Base Class')
@@ -67,7 +67,11 @@ class BaseConfig(object):
     SERVICE_REGISTRATION_CHANNEL = "registration"
     SERVICE_REGISTRATION_FREQUENCY = 60  # unit: seconds
     SERVICE_LISTENING_FREQUENCY = 1  # unit: seconds
+    SERVICE_LISTENING_BLOCKING = True  # block on redis for new jobs instead of polling every SERVICE_LISTENING_FREQUENCY
     SERVICE_HANDLER_TIMEOUT = 60  # unit: seconds
+    SERVICE_RECLAIM_FREQUENCY = 30  # unit: seconds (how often to reclaim jobs from crashed workers)
+    SERVICE_PREDICT_BATCH_WINDOW = 0.02  # unit: seconds (how long to wait for more predict jobs for the same classifier; 0 disables batching)
+    SERVICE_PREDICT_BATCH_SIZE = 32  # most predict jobs to run as one batch
     SERVICE_LIST = [
         dict(
             name="corenlp",
@@ -110,6 +114,22 @@ class BaseConfig(object):
 
     # Models
     MODELS_DIR = ROOT_DIR + r"/models"
+    MODEL_CACHE_MAX_MB = 4096  # unit: megabytes (on disk) of trained models kept loaded per container, split evenly between the REDIS_MAX_PROCESSES worker processes; 0 disables
+
+    # Training data snapshots
+    TRAINING_DATA_DIR = ROOT_DIR + r"/training_data"  # set to null to always download all training data from eve
+    TRAINING_DATA_UPDATED_MARGIN = 60  # unit: seconds (how far before the latest _updated time to look for changes)
+
+    # Training
+    CROSS_VALIDATION_PROCESSES = 1  # processes to run the cross-validation folds in; 1 runs them sequentially
+    CROSS_VALIDATION_FOLDS = 5  # folds to cross-validate with; less than 2 skips cross-validation
+    CROSS_VALIDATION_EVERY = 1  # cross-validate every N trainings (and reuse the last metrics in between); 0 never does
+    TRAINING_SEED = None  # seed for cross-validation splits and training; a classifier's "seed" parameter overrides it
+
+    # Ranking
+    RANKING_TOP_K = 1000  # documents at the front of the ranking that are always scored again; 0 always scores all
+    RANKING_SAMPLE_SIZE = 1000  # documents scored again as a rotating sample to tell how much the model changed
+    RANKING_MAX_SCORE_CHANGE = 0.05  # average change of sample scores above which all documents are scored again
 
     def __init__(self, root_dir=None):
 
@@ -113,6 +113,8 @@ class spacy_NER(Pipeline):
                         losses=losses)
                 logger.info("[{}/{}] completed: losses={}".format((itn + 1), default_params["iterations"], losses))
                 all_losses.append(losses)
+                if callable(params.get("progress")):
+                    params["progress"]({"iteration": itn + 1, "iterations": default_params["iterations"], "losses": losses})
         return {
             "iterations": default_params["iterations"],
             "losses": all_losses
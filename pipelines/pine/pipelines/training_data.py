@@ -0,0 +1,172 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+"""
+Local snapshots of each collection's training data.
+
+Training needs the text of every non-overlapping document in a collection and all of its annotations,
+which for large collections is far more data than changes between two trainings.  The pipelines keep a
+snapshot of that data per collection on disk and only bring it up to date with eve before training:
+
+* the IDs of the matching documents and annotations are listed to find out what was deleted;
+* everything whose ``_updated`` time is at or after the latest one in the snapshot (less a margin for
+  writes that were in flight during the last refresh) is downloaded again;
+* anything else that is listed but isn't in the snapshot is downloaded by ID.
+
+Snapshots are stored column-wise in msgpack files (with srsly, which comes with spaCy) and are replaced
+atomically, so several processes can refresh the same collection's snapshot at once.
+"""
+
+import email.utils
+import json
+import logging
+import os
+import typing
+from datetime import timedelta
+
+import srsly
+
+from .EveClient import EveClient, EveDocsAndAnnotations
+from .shared.config import ConfigBuilder
+
+logger = logging.getLogger(__name__)
+config = ConfigBuilder.get_config()
+
+# eve's DATE_FORMAT
+DATE_FORMAT = "%a, %d %b %Y %H:%M:%S GMT"
+
+class TrainingDataSnapshot(object):
+    # increase if the file format or the stored fields change, so old snapshots are downloaded again
+    version = 1
+    # how many items to download by ID per request
+    id_batch_size = 100
+    # the fields that are kept of each resource (besides _id and _updated)
+    document_fields = ["text"]
+    annotation_fields = ["document_id", "annotation"]
+
+    def __init__(self, collection_id: str, directory: str = config.TRAINING_DATA_DIR):
+        self.collection_id = collection_id
+        self.filename = os.path.join(directory, "{}.msgpack".format(collection_id))
+        # ID -> item with the stored fields and _updated
+        self.documents: typing.Dict[str, dict] = {}
+        self.annotations: typing.Dict[str, dict] = {}
+
+    @staticmethod
+    def _to_columns(items: typing.Dict[str, dict], fields: typing.List[str]) -> dict:
+        columns = {"_id": list(items.keys())}
+        for field in ["_updated"] + fields:
+            columns[field] = [item[field] for item in items.values()]
+        return columns
+
+    @staticmethod
+    def _from_columns(columns: dict, fields: typing.List[str]) -> typing.Dict[str, dict]:
+        fields = ["_updated"] + fields
+        return {item_id: dict(zip(fields, values))
+                for (item_id, *values) in zip(columns["_id"], *[columns[field] for field in fields])}
+
+    def load(self) -> bool:
+        """Loads the snapshot from disk, returning whether there was a usable one."""
+        if not os.path.isfile(self.filename):
+            return False
+        try:
+            data = srsly.read_msgpack(self.filename)
+            if data["version"] != self.version or data["collection_id"] != self.collection_id:
+                return False
+            self.documents = self._from_columns(data["documents"], self.document_fields)
+            self.annotations = self._from_columns(data["annotations"], self.annotation_fields)
+            return True
+        except Exception:
+            logger.exception("Unable to load training data snapshot {}; downloading it again".format(self.filename))
+            self.documents = {}
+            self.annotations = {}
+            return False
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        temp_filename = "{}.{}.tmp".format(self.filename, os.getpid())
+        srsly.write_msgpack(temp_filename, {
+            "version": self.version,
+            "collection_id": self.collection_id,
+            "documents": self._to_columns(self.documents, self.document_fields),
+            "annotations": self._to_columns(self.annotations, self.annotation_fields)
+        })
+        os.replace(temp_filename, self.filename)
+
+    @staticmethod
+    def _refresh_items(eve_client: EveClient, resource: str, where: dict, fields: typing.List[str],
+                       items: typing.Dict[str, dict]) -> int:
+        """Brings items up to date with the resource's items matching where, returning how many were downloaded."""
+        projection = json.dumps(dict({"_id": 1, "_updated": 1}, **{field: 1 for field in fields}))
+        def download(download_where: dict) -> int:
+            count = 0
+            for item in eve_client.iter_items(resource, {"where": json.dumps(download_where), "projection": projection}):
+                items[item["_id"]] = {field: item.get(field, None) for field in ["_updated"] + fields}
+                count += 1
+            return count
+
+        if not items:
+            return download(where)
+
+        # list what's there first, so that anything added after this is downloaded below and not deleted
+        item_ids = set(item["_id"] for item in eve_client.iter_items(resource, {
+            "where": json.dumps(where),
+            "projection": json.dumps({"_id": 1})
+        }))
+        for item_id in set(items.keys()) - item_ids:
+            del items[item_id]
+
+        latest_updated = max(email.utils.parsedate_to_datetime(item["_updated"]) for item in items.values()) \
+            if items else None
+        if latest_updated is None:
+            count = download(where)
+        else:
+            since = latest_updated - timedelta(seconds=config.TRAINING_DATA_UPDATED_MARGIN)
+            count = download(dict(where, _updated={"$gte": since.strftime(DATE_FORMAT)}))
+
+        missing_ids = sorted(item_ids - set(items.keys()))
+        for i in range(0, len(missing_ids), TrainingDataSnapshot.id_batch_size):
+            count += download(dict(where, _id={"$in": missing_ids[i:i + TrainingDataSnapshot.id_batch_size]}))
+        return count
+
+    def refresh(self, eve_client: EveClient):
+        """Brings the snapshot up to date with eve."""
+        documents_count = self._refresh_items(eve_client, "documents", {
+            "collection_id": self.collection_id,
+            "overlap": 0
+        }, self.document_fields, self.documents)
+        annotations_count = self._refresh_items(eve_client, "annotations", {
+            "collection_id": self.collection_id
+        }, self.annotation_fields, self.annotations)
+        logger.info("Refreshed training data snapshot for collection {}: downloaded {} of {} documents and {} of {} annotations".format(
+            self.collection_id, documents_count, len(self.documents), annotations_count, len(self.annotations)))
+
+    def get_documents(self) -> typing.Dict[str, str]:
+        """Returns a mapping from document ID to document text for non-overlap documents, like EveClient.get_documents."""
+        return {doc_id: document["text"] for (doc_id, document) in self.documents.items()}
+
+    def get_docs_with_annotations(self, all_labels: typing.List[str]) -> EveDocsAndAnnotations:
+        """Returns the data of the annotations of non-overlap documents, like EveClient.get_docs_with_annotations."""
+        data = EveDocsAndAnnotations()
+        data.all_labels = all_labels
+        # in creation order, which is the order eve returns them in
+        for ann_id in sorted(self.annotations.keys()):
+            annotation = self.annotations[ann_id]
+            docid = annotation["document_id"]
+            # remove overlaps
+            if docid not in self.documents:
+                continue
+            data.doc_ids.append(docid)
+            data.documents.append(self.documents[docid]["text"])
+            data.ann_ids.append(ann_id)
+            data.annotations.append(annotation["annotation"])
+        return data
+
+def get_training_data(eve_client: EveClient, collection_id: str) -> typing.Tuple[typing.Dict[str, str], EveDocsAndAnnotations]:
+    """Returns the document map and annotation data of a collection, like EveClient.get_documents and
+    EveClient.get_docs_with_annotations, from its refreshed snapshot.
+    """
+    snapshot = TrainingDataSnapshot(collection_id)
+    snapshot.load()
+    snapshot.refresh(eve_client)
+    snapshot.save()
+    all_labels = eve_client.get_obj("collections", collection_id)["labels"]
+    return snapshot.get_documents(), snapshot.get_docs_with_annotations(all_labels)
@@ -0,0 +1,40 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+import time
+
+import common
+
+# batch sizes to compare; the time per document should go down as the batches get bigger
+# (this only reports the timings: they depend too much on the machine to assert on)
+BATCH_SIZES = [1, 10, 100, 500]
+
+def test_benchmark_delete_documents():
+    client = common.login_with_test_user(common.client())
+
+    collection_id = common.get_collection_id(client, "Trial Collection")
+    assert collection_id != None
+
+    results = []
+    for batch_size in BATCH_SIZES:
+        doc_ids = client.add_documents([{
+            "text": "This is benchmark document {} to be deleted.".format(i),
+            "overlap": 0
+        } for i in range(batch_size)], collection_id=collection_id)
+        assert len(doc_ids) == batch_size
+        # give half of them an annotation so that annotation deletion is included
+        for doc_id in doc_ids[::2]:
+            client.annotate_document(doc_id, [], [])
+
+        start = time.perf_counter()
+        delete_resp = client.delete_documents(doc_ids)
+        elapsed = time.perf_counter() - start
+
+        assert delete_resp["success"]
+        assert sorted(delete_resp["changed_objs"]["documents"]["deleted"]) == sorted(doc_ids)
+        assert len(delete_resp["changed_objs"]["annotations"]["deleted"]) == len(doc_ids[::2])
+        results.append((batch_size, elapsed))
+
+    print()
+    print("{:>10} {:>12} {:>14}".format("batch size", "seconds", "ms/document"))
+    for (batch_size, elapsed) in results:
+        print("{:>10} {:>12.3f} {:>14.2f}".format(batch_size, elapsed, 1000 * elapsed / batch_size))